@@ -3,12 +3,21 @@
 Простой FastAPI сервис для работы с RAG системой
 """
 
+import time
+
+# Точка отсчета времени старта (до тяжелых импортов)
+PROCESS_STARTED = time.monotonic()
+
+import asyncio
 import os
+import re
+import threading
 import warnings
 from pathlib import Path
 from typing import Optional
 
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 
@@ -20,57 +29,278 @@ sys_path = str(Path(__file__).parent)
 import sys
 sys.path.insert(0, sys_path)
 
+from collections import OrderedDict
+from functools import partial
+from RAG.rag.config import DEFAULT_CONFIG
+from RAG.rag.embedding_service import EmbeddingService
+from RAG.rag.markdown_chunker import get_token_counter
 from RAG.rag.rag_pipeline import RAGPipeline
+from RAG.rag.reembed import CHECKPOINT_PREFIX, ReembedError, ReembedMigration
+from RAG.rag.replication import SnapshotFollower, SnapshotPublisher
+from RAG.rag.snapshot import (
+    SnapshotError, export_snapshot, import_snapshot, latest_snapshot, list_snapshots
+)
+from RAG.rag.vector_store import VectorStore, DEFAULT_COLLECTION
 from RAG.llm_provider.llm_provider import LLMProvider
 
 app = FastAPI(title="RAG API", description="API для работы с RAG системой")
 
+startup_timings = {"import_seconds": round(time.monotonic() - PROCESS_STARTED, 3)}
+
+# Пайплайны по коллекциям (тенантам) с LRU-вытеснением; модель и клиент ChromaDB общие
+MAX_OPEN_COLLECTIONS = int(os.getenv('RAG_MAX_OPEN_COLLECTIONS', '8'))
+COLLECTION_NAME_RE = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_-]{1,40}[a-zA-Z0-9]$')
+_pipelines: "OrderedDict[str, RAGPipeline]" = OrderedDict()
+_pipelines_lock = threading.Lock()
+_shared = {"embedding_service": None, "client": None}
+
+
+def get_pipeline(collection: Optional[str] = None) -> RAGPipeline:
+    """Общий для процесса пайплайн коллекции: модель, кэши и FAQ живут между запросами"""
+    collection = collection or DEFAULT_COLLECTION
+    if not COLLECTION_NAME_RE.match(collection) or "__" in collection:
+        raise HTTPException(status_code=400, detail=f"Недопустимое имя коллекции: {collection}")
+    with _pipelines_lock:
+        pipeline = _pipelines.get(collection)
+        if pipeline is not None:
+            _pipelines.move_to_end(collection)
+            return pipeline
+        if _shared["embedding_service"] is None:
+            _shared["embedding_service"] = EmbeddingService(DEFAULT_CONFIG.embedding)
+        if _shared["client"] is None:
+            _shared["client"] = VectorStore.create_client(
+                str(Path(os.getenv('CHROMA_DB_PATH', '/app/data/chroma_db')).resolve())
+            )
+        pipeline = RAGPipeline(
+            collection_name=collection,
+            embedding_service=_shared["embedding_service"],
+            client=_shared["client"],
+        )
+        _pipelines[collection] = pipeline
+        while len(_pipelines) > MAX_OPEN_COLLECTIONS:
+            evicted, _ = _pipelines.popitem(last=False)
+            print(f"Коллекция {evicted} вытеснена из кэша открытых коллекций")
+        return pipeline
+
+
+def preload_embedding_model() -> EmbeddingService:
+    """Загружает общую модель эмбеддингов без открытия ChromaDB (для мастера pre-fork)"""
+    with _pipelines_lock:
+        if _shared["embedding_service"] is None:
+            _shared["embedding_service"] = EmbeddingService(DEFAULT_CONFIG.embedding)
+    if _shared["embedding_service"].client is None:
+        _shared["embedding_service"].model
+    return _shared["embedding_service"]
+
+
+# Репликация: единственный писатель публикует снапшоты, реплики только читают и подтягивают их
+IS_REPLICA = DEFAULT_CONFIG.snapshot.role == "replica"
+snapshot_publisher = SnapshotPublisher(DEFAULT_CONFIG.snapshot)
+snapshot_follower = SnapshotFollower(
+    get_pipeline, DEFAULT_CONFIG.snapshot, os.getenv('CHROMA_DB_PATH', '/app/data/chroma_db')
+)
+
+
+def require_writer():
+    """Изменения принимает только писатель"""
+    if IS_REPLICA:
+        raise HTTPException(status_code=403, detail="Реплика только для чтения: изменения принимает писатель")
+
+
+def notify_write(pipeline: RAGPipeline):
+    """После изменения коллекции писатель публикует снапшот для реплик"""
+    if DEFAULT_CONFIG.snapshot.publish_on_write and not IS_REPLICA:
+        snapshot_publisher.schedule(pipeline)
+
+
+# Миграции коллекций на другую модель эмбеддингов
+_migrations: Dict[str, ReembedMigration] = {}
+
+
+def get_migration(collection: Optional[str] = None) -> ReembedMigration:
+    pipeline = get_pipeline(collection)
+    alias = pipeline.vector_store.collection_name
+    with _pipelines_lock:
+        migration = _migrations.get(alias)
+        if migration is None or migration.vector_store is not pipeline.vector_store:
+            migration = ReembedMigration(pipeline.vector_store, _shared["embedding_service"], DEFAULT_CONFIG.reembed)
+            _migrations[alias] = migration
+        return migration
+
+
+def require_alias_free(collection: Optional[str] = None):
+    """Замена коллекции под алиасом запрещена, пока миграция эмбеддингов ссылается на нее"""
+    try:
+        get_migration(collection).ensure_alias_free()
+    except ReembedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+def require_incremental_writes(collection: Optional[str] = None):
+    """Пока миграция ждет переключения, изменения документов попали бы только в старую коллекцию"""
+    try:
+        get_migration(collection).ensure_incremental_writes()
+    except ReembedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+def resume_migrations():
+    """Продолжает миграции, прерванные перезапуском (выполнит один из воркеров)"""
+    db_path = Path(os.getenv('CHROMA_DB_PATH', '/app/data/chroma_db'))
+    for path in db_path.glob(f"{CHECKPOINT_PREFIX}*.json"):
+        try:
+            migration = get_migration(path.stem[len(CHECKPOINT_PREFIX):])
+            state = migration.status()
+            if state and state["status"] == "running" and not state["active"]:
+                print(f"Продолжение миграции эмбеддингов {state['collection']} на {state['target_model']}")
+                migration.resume()
+        except Exception as e:
+            print(f"Не удалось продолжить миграцию {path.name}: {e}")
+
+
+# Состояние прогрева для /readyz
+LLM_TOKEN_CHECK_INTERVAL = 20 * 60  # Токен GigaChat живет 30 минут
+readiness = {"model": False, "collection": False, "llm": False, "errors": {}}
+_llm_checked_at = 0.0
+
+
+def _check_llm() -> bool:
+    """Проверяет токен LLM не чаще раза в LLM_TOKEN_CHECK_INTERVAL"""
+    global _llm_checked_at
+    if readiness["llm"] and time.monotonic() - _llm_checked_at < LLM_TOKEN_CHECK_INTERVAL:
+        return True
+    try:
+        LLMProvider().check_token()
+        readiness["llm"] = True
+        readiness["errors"].pop("llm", None)
+        _llm_checked_at = time.monotonic()
+    except Exception as e:
+        readiness["llm"] = False
+        readiness["errors"]["llm"] = str(e)
+    return readiness["llm"]
+
+
+def warm_up(retry_interval: float = 5.0):
+    """Загружает и прогревает модель, открывает коллекцию и проверяет LLM"""
+    while not (readiness["model"] and readiness["collection"] and readiness["llm"]):
+        try:
+            pipeline = get_pipeline()
+            if not readiness["model"]:
+                started = time.perf_counter()
+                pipeline.embedding_service.encode_query("прогрев модели")
+                readiness["model"] = True
+                readiness["errors"].pop("model", None)
+                startup_timings["model_warmup_seconds"] = round(time.perf_counter() - started, 3)
+                print(f"Модель эмбеддингов прогрета за {time.perf_counter() - started:.1f} с")
+            if not readiness["collection"]:
+                if IS_REPLICA and not snapshot_follower.sync(DEFAULT_COLLECTION):
+                    raise RuntimeError(f"Нет опубликованного снапшота в {DEFAULT_CONFIG.snapshot.dir}")
+                vector_store = pipeline.vector_store
+                if vector_store.collection.count() and not vector_store.centroids.count():
+                    print(f"Построено центроидов документов: {vector_store.rebuild_centroids()}")
+                if not vector_store.index_settings_match():
+                    print("Параметры индекса коллекции отличаются от RetrievalConfig, "
+                          "выполните POST /admin/migrate_index")
+                readiness["collection"] = True
+                readiness["errors"].pop("collection", None)
+        except Exception as e:
+            key = "model" if not readiness["model"] else "collection"
+            readiness["errors"][key] = str(e)
+            print(f"Ошибка прогрева ({key}): {e}")
+        _check_llm()
+        if not (readiness["model"] and readiness["collection"] and readiness["llm"]):
+            time.sleep(retry_interval)
+    startup_timings["ready_after_seconds"] = round(time.monotonic() - PROCESS_STARTED, 3)
+    print(f"RAG API готов: {startup_timings}")
+
+
+@app.on_event("startup")
+def start_warm_up():
+    threading.Thread(target=warm_up, daemon=True).start()
+    get_pipeline().embedding_service.start_idle_watcher()
+    if IS_REPLICA:
+        snapshot_follower.start()
+    else:
+        threading.Thread(target=resume_migrations, daemon=True).start()
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: процесс жив"""
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: модель прогрета, коллекция открыта, у LLM есть валидный токен"""
+    if readiness["model"] and readiness["collection"]:
+        await asyncio.get_running_loop().run_in_executor(None, _check_llm)
+    ready = readiness["model"] and readiness["collection"] and readiness["llm"]
+    body = {
+        "status": "ready" if ready else "not ready",
+        "model": readiness["model"],
+        "collection": readiness["collection"],
+        "llm": readiness["llm"],
+        "role": DEFAULT_CONFIG.snapshot.role,
+        "errors": readiness["errors"],
+        "startup": startup_timings,
+    }
+    if IS_REPLICA:
+        body["snapshots"] = snapshot_follower.state()
+        body["snapshot_error"] = snapshot_follower.last_error
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+
+HISTORY_MAX_TOKENS = int(os.getenv('HISTORY_MAX_TOKENS', '800'))
+
 
 def format_conversation_history(history: Optional[List[Dict[str, str]]]) -> str:
-    """Форматировать историю диалога в читаемый текст"""
+    """Форматировать историю диалога в читаемый текст в пределах бюджета токенов
+    
+    Краткое содержание (role="summary") сохраняется всегда, из сообщений при
+    превышении бюджета отбрасываются самые старые.
+    """
     if not history:
         return "История диалога отсутствует"
     
+    summary_lines = []
     formatted_lines = []
     for msg in history:
         role = msg.get("role", "")
         text = msg.get("text", "")
         
-        if role == "user":
+        if role == "summary":
+            summary_lines.append(f"Краткое содержание предыдущего диалога: {text}")
+        elif role == "user":
             formatted_lines.append(f"Пользователь: {text}")
         elif role == "assistant":
             formatted_lines.append(f"Ассистент: {text}")
         else:
             formatted_lines.append(f"{role}: {text}")
     
-    return "\n".join(formatted_lines) if formatted_lines else "История диалога отсутствует"
-
-
-class QueryRequest(BaseModel):
-    question: str
-    conversation_history: Optional[List[Dict[str, str]]] = None
-
-
-class QueryResponse(BaseModel):
-    question: str
-    avg_similirity: float
-    llm_answer: Optional[str] = None
+    count_tokens = get_token_counter(DEFAULT_CONFIG.chunking.tokenizer_name)
+    used = sum(count_tokens(line) for line in summary_lines)
+    kept = []
+    for line in reversed(formatted_lines):
+        tokens = count_tokens(line)
+        if used + tokens > HISTORY_MAX_TOKENS:
+            break
+        kept.append(line)
+        used += tokens
+    
+    lines = summary_lines + list(reversed(kept))
+    return "\n".join(lines) if lines else "История диалога отсутствует"
 
 
-@app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest):
-    """Выполнить запрос к RAG системе"""
-    pipeline = RAGPipeline()
-    result = pipeline.query(request.question)
-    
-    if not result.get("sources"):
-        return QueryResponse(
-            question=request.question,
-            avg_similirity=0.0,
-            llm_answer="Извините, я не обладаю такой информацией! Все детали вы можете уточнить у менеджера!"
-        )
+NO_INFO_ANSWER = "Извините, я не обладаю такой информацией! Все детали вы можете уточнить у менеджера!"
 
 
+def generate_llm_answer(
+    question: str,
+    context: str,
+    conversation_history: Optional[List[Dict[str, str]]] = None
+) -> str:
+    """Сгенерировать ответ LLM по найденному контексту"""
     try:
         # Определяем путь к промптам относительно файла API
         prompts_dir = Path(__file__).parent / "prompts"
@@ -84,12 +314,12 @@ async def query(request: QueryRequest):
             user_prompt = file.read()
             
             # Форматируем историю диалога
-            conversation_history_text = format_conversation_history(request.conversation_history)
+            conversation_history_text = format_conversation_history(conversation_history)
             
             user_prompt = user_prompt.format(
                 conversation_history=conversation_history_text,
-                answer=result['answer'],
-                question=request.question
+                answer=context,
+                question=question
             )
             print(user_prompt)
 
@@ -103,13 +333,91 @@ async def query(request: QueryRequest):
         error_details = traceback.format_exc()
         print(f"Ошибка LLM: {error_details}")
         llm_answer = "Извините, произошла ошибка при обработке запроса. Попробуйте позже."
+    return llm_answer
+
+
+class QueryRequest(BaseModel):
+    question: str
+    conversation_history: Optional[List[Dict[str, str]]] = None
+    collection: Optional[str] = None
+
+
+class QueryResponse(BaseModel):
+    question: str
+    avg_similirity: float
+    llm_answer: Optional[str] = None
+    intent: Optional[str] = None
+
+
+class QueryBatchRequest(BaseModel):
+    questions: List[QueryRequest]
+    generate: bool = False  # Генерировать ли ответы LLM (по умолчанию только retrieval)
+    max_concurrency: int = 4  # Сколько LLM вызовов выполняется параллельно
+    n_results: Optional[int] = None
+    collection: Optional[str] = None
+
+
+class QueryBatchItem(BaseModel):
+    question: str
+    avg_similirity: float
+    sources: List[Dict] = []
+    llm_answer: Optional[str] = None
+
+
+class QueryBatchResponse(BaseModel):
+    results: List[QueryBatchItem]
+
+
+@app.post("/query", response_model=QueryResponse)
+async def query(request: QueryRequest):
+    """Выполнить запрос к RAG системе"""
+    pipeline = get_pipeline(request.collection)
+    
+    # Самый быстрый путь: приветствия и болтовня получают шаблонный ответ
+    query_embedding = None
+    if pipeline.config.intents.enabled:
+        route = pipeline.intent_router.route(request.question)
+        if route["reply"] is not None:
+            return QueryResponse(
+                question=request.question,
+                avg_similirity=route["score"],
+                llm_answer=route["reply"],
+                intent=route["intent"]
+            )
+        query_embedding = route["embedding"]
+    
+    # Быстрый путь: курируемый FAQ отвечает без поиска и LLM
+    if pipeline.config.faq.enabled:
+        if query_embedding is None:
+            # Один эмбеддинг вопроса на FAQ и поиск
+            query_embedding = pipeline.embedding_service.encode_query(request.question)
+        faq_match = pipeline.faq_index.match(request.question, query_embedding)
+        if faq_match:
+            entry, score = faq_match
+            return QueryResponse(
+                question=request.question,
+                avg_similirity=score,
+                llm_answer=entry["answer"]
+            )
+    
+    result = pipeline.query(request.question, query_embedding=query_embedding)
+    
+    if not result.get("sources") and not result.get("table_direct"):
+        return QueryResponse(
+            question=request.question,
+            avg_similirity=0.0,
+            llm_answer=NO_INFO_ANSWER
+        )
+
+    llm_answer = generate_llm_answer(request.question, result['answer'], request.conversation_history)
 
     print(result)
-    if result['avg_similarity'] < 0.3:
+    threshold = pipeline.config.retrieval.similarity_threshold(pipeline.vector_store.distance_space)
+    if result['avg_similarity'] < threshold and not result.get("table_direct"):
         return QueryResponse(
             question=request.question,
             avg_similirity=result['avg_similarity'],
-            llm_answer="Извините, я не обладаю такой информацией! Все детали вы можете уточнить у менеджера!"
+            llm_answer=NO_INFO_ANSWER
         )
     
     return QueryResponse(
@@ -119,9 +427,318 @@ async def query(request: QueryRequest):
     )
 
 
+@app.post("/query_batch", response_model=QueryBatchResponse)
+async def query_batch(request: QueryBatchRequest):
+    """Пакетный запрос: одно батч-кодирование и один multi-vector поиск на вопросы каждой коллекции
+
+    Коллекция вопроса берется из его поля collection, иначе из collection пакета.
+    """
+    groups: Dict[str, List[int]] = {}
+    for position, item in enumerate(request.questions):
+        groups.setdefault(item.collection or request.collection or DEFAULT_COLLECTION, []).append(position)
+    pipelines = {collection: get_pipeline(collection) for collection in groups}
+
+    results: List[Optional[Dict]] = [None] * len(request.questions)
+    item_pipelines: List[Optional[RAGPipeline]] = [None] * len(request.questions)
+    for collection, positions in groups.items():
+        pipeline = pipelines[collection]
+        questions = [request.questions[position].question for position in positions]
+        try:
+            group_results = pipeline.query_batch(questions, n_results=request.n_results)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка поиска: {str(e)}")
+        for position, result in zip(positions, group_results):
+            results[position] = result
+            item_pipelines[position] = pipeline
+
+    items = [
+        QueryBatchItem(
+            question=result["question"],
+            avg_similirity=result.get("avg_similarity", 0.0),
+            sources=result["sources"],
+        )
+        for result in results
+    ]
+
+    if request.generate:
+        semaphore = asyncio.Semaphore(max(1, request.max_concurrency))
+        loop = asyncio.get_running_loop()
+
+        async def generate(item: QueryBatchItem, result: Dict, history, pipeline: RAGPipeline):
+            threshold = pipeline.config.retrieval.similarity_threshold(pipeline.vector_store.distance_space)
+            if not result.get("table_direct") and (not result.get("sources") or result["avg_similarity"] < threshold):
+                item.llm_answer = NO_INFO_ANSWER
+                return
+            async with semaphore:
+                item.llm_answer = await loop.run_in_executor(
+                    None, generate_llm_answer, item.question, result["answer"], history
+                )
+
+        await asyncio.gather(*[
+            generate(item, result, req.conversation_history, pipeline)
+            for item, result, req, pipeline in zip(items, results, request.questions, item_pipelines)
+        ])
+
+    return QueryBatchResponse(results=items)
+
+
+class FAQEntryRequest(BaseModel):
+    questions: List[str]
+    answer: str
+
+
+class FAQEntryUpdate(BaseModel):
+    questions: Optional[List[str]] = None
+    answer: Optional[str] = None
+
+
+@app.post("/admin/migrate_index")
+async def migrate_index(collection: Optional[str] = None):
+    """Перестроить коллекцию с параметрами HNSW и метрикой из RetrievalConfig"""
+    require_writer()
+    vector_store = get_pipeline(collection).vector_store
+    if vector_store.index_settings_match():
+        return {"message": "Параметры индекса уже актуальны", "migrated": False}
+    require_alias_free(collection)
+    try:
+        count = await asyncio.get_running_loop().run_in_executor(None, vector_store.migrate_index)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка миграции индекса: {str(e)}")
+    notify_write(get_pipeline(collection))
+    return {"message": "Индекс перестроен", "migrated": True, "chunks": count}
+
+
+@app.post("/admin/snapshot")
+async def create_snapshot(collection: Optional[str] = None):
+    """Записать согласованный сжатый снапшот коллекции (чанки, эмбеддинги, каталог, FAQ, модель)"""
+    require_writer()
+    pipeline = get_pipeline(collection)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, export_snapshot, pipeline.vector_store, pipeline.faq_index,
+            pipeline.config.embedding, pipeline.config.snapshot, pipeline.table_index,
+        )
+    except SnapshotError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка создания снапшота: {str(e)}")
+
+
+@app.get("/admin/snapshots")
+async def get_snapshots(collection: Optional[str] = None):
+    """Список снапшотов коллекции и последний опубликованный"""
+    pipeline = get_pipeline(collection)
+    alias = pipeline.vector_store.collection_name
+    return {
+        "snapshots": list_snapshots(pipeline.config.snapshot, alias),
+        "latest": latest_snapshot(pipeline.config.snapshot, alias),
+    }
+
+
+@app.post("/admin/snapshot/restore")
+async def restore_snapshot(
+    collection: Optional[str] = None,
+    name: Optional[str] = None,
+    file: Optional[UploadFile] = File(None)
+):
+    """Загрузить снапшот без пересчета эмбеддингов: загруженный файл, имя из каталога снапшотов или последний"""
+    require_writer()
+    require_alias_free(collection)
+    pipeline = get_pipeline(collection)
+    snapshot_config = pipeline.config.snapshot
+    temp_path = None
+    if file is not None:
+        temp_path = Path(f"/tmp/{Path(file.filename).name}")
+        with open(temp_path, "wb") as f:
+            f.write(await file.read())
+        path = temp_path
+    else:
+        if name is None:
+            latest = latest_snapshot(snapshot_config, pipeline.vector_store.collection_name)
+            if latest is None:
+                raise HTTPException(status_code=404, detail="Снапшоты коллекции не найдены")
+            name = latest["file"]
+        path = Path(snapshot_config.dir) / Path(name).name
+        if not path.exists():
+            raise HTTPException(status_code=404, detail=f"Снапшот {name} не найден")
+    try:
+        manifest = await asyncio.get_running_loop().run_in_executor(
+            None, partial(
+                import_snapshot, path, pipeline.vector_store, pipeline.faq_index, pipeline.config.embedding,
+                table_index=pipeline.table_index,
+            )
+        )
+        notify_write(pipeline)
+        return {"message": "Снапшот загружен", **manifest}
+    except SnapshotError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка загрузки снапшота: {str(e)}")
+    finally:
+        if temp_path is not None and temp_path.exists():
+            temp_path.unlink()
+
+
+class ReembedRequest(BaseModel):
+    model_name: str
+
+
+def _reembed_action(collection: Optional[str], action: str) -> Dict:
+    require_writer()
+    migration = get_migration(collection)
+    try:
+        state = getattr(migration, action)()
+    except ReembedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if action in ("switch", "rollback"):
+        notify_write(get_pipeline(collection))
+    return state
+
+
+@app.post("/admin/reembed")
+async def start_reembed(request: ReembedRequest, collection: Optional[str] = None):
+    """Начать фоновую перекодировку коллекции новой моделью (или продолжить прерванную)"""
+    require_writer()
+    migration = get_migration(collection)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, migration.start, request.model_name)
+    except ReembedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка запуска миграции: {str(e)}")
+
+
+@app.get("/admin/reembed")
+async def get_reembed_status(collection: Optional[str] = None):
+    """Состояние миграции коллекции: прогресс, модели, исходная и новая коллекции"""
+    migration = get_migration(collection)
+    state = migration.status()
+    if state is None:
+        return {"status": "none", "embedding_model": migration.vector_store.embedding_model}
+    if state["total"]:
+        state["progress"] = round(min(1.0, state["offset"] / state["total"]), 4)
+    return state
+
+
+@app.post("/admin/reembed/switch")
+async def switch_reembed(collection: Optional[str] = None):
+    """Переключить запросы на перекодированную коллекцию (если auto_switch выключен)"""
+    return _reembed_action(collection, "switch")
+
+
+@app.post("/admin/reembed/rollback")
+async def rollback_reembed(collection: Optional[str] = None):
+    """Вернуть запросы на коллекцию прежней модели"""
+    return _reembed_action(collection, "rollback")
+
+
+@app.post("/admin/reembed/cancel")
+async def cancel_reembed(collection: Optional[str] = None):
+    """Остановить миграцию и удалить недостроенную коллекцию"""
+    return await asyncio.get_running_loop().run_in_executor(None, _reembed_action, collection, "cancel")
+
+
+@app.delete("/admin/reembed")
+async def cleanup_reembed(collection: Optional[str] = None):
+    """Удалить ненужную после переключения или отката коллекцию"""
+    return _reembed_action(collection, "cleanup")
+
+
+@app.get("/collections")
+async def list_collections():
+    """Список коллекций (тенантов) и открытых в кэше"""
+    vector_store = get_pipeline().vector_store
+    return {
+        "collections": vector_store.list_aliases(),
+        "open": list(_pipelines.keys()),
+        "max_open": MAX_OPEN_COLLECTIONS,
+    }
+
+
+@app.get("/embedding/stats")
+async def embedding_stats():
+    """Состояние модели эмбеддингов: загрузка/выгрузка, RSS, латентность загрузки"""
+    return get_pipeline().embedding_service.get_stats()
+
+
+@app.get("/faq")
+async def list_faq(collection: Optional[str] = None):
+    """Список FAQ"""
+    return {"faq": get_pipeline(collection).faq_index.list()}
+
+
+@app.get("/faq/stats")
+async def faq_stats(collection: Optional[str] = None):
+    """Статистика попаданий в FAQ"""
+    return get_pipeline(collection).faq_index.stats()
+
+
+@app.post("/faq")
+async def create_faq(request: FAQEntryRequest, collection: Optional[str] = None):
+    """Добавить FAQ"""
+    require_writer()
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="Нужен хотя бы один вариант вопроса")
+    pipeline = get_pipeline(collection)
+    entry = pipeline.faq_index.create(request.questions, request.answer)
+    notify_write(pipeline)
+    return entry
+
+
+@app.put("/faq/{entry_id}")
+async def update_faq(entry_id: str, request: FAQEntryUpdate, collection: Optional[str] = None):
+    """Обновить FAQ"""
+    require_writer()
+    pipeline = get_pipeline(collection)
+    entry = pipeline.faq_index.update(entry_id, request.questions, request.answer)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="FAQ не найден")
+    notify_write(pipeline)
+    return entry
+
+
+@app.delete("/faq/{entry_id}")
+async def delete_faq(entry_id: str, collection: Optional[str] = None):
+    """Удалить FAQ"""
+    require_writer()
+    pipeline = get_pipeline(collection)
+    if not pipeline.faq_index.delete(entry_id):
+        raise HTTPException(status_code=404, detail="FAQ не найден")
+    notify_write(pipeline)
+    return {"message": "FAQ удален"}
+
+
+@app.get("/intents/stats")
+async def intents_stats(collection: Optional[str] = None):
+    """Счетчики маршрутизатора интентов: сколько сообщений обработано без RAG и LLM"""
+    return get_pipeline(collection).intent_router.stats()
+
+
+@app.get("/tables")
+async def list_tables(collection: Optional[str] = None):
+    """Таблицы из документов в структурированном индексе"""
+    return {"tables": get_pipeline(collection).table_index.list()}
+
+
+@app.get("/tables/stats")
+async def tables_stats(collection: Optional[str] = None):
+    """Статистика индекса таблиц: строки, ключи, доля запросов с совпадением"""
+    return get_pipeline(collection).table_index.stats()
+
+
 @app.post("/documents")
-async def upload_document(file: UploadFile = File(...), replace_all: bool = True):
+async def upload_document(
+    file: UploadFile = File(...),
+    replace_all: bool = True,
+    collection: Optional[str] = None
+):
     """Загрузить документ"""
+    require_writer()
+    if replace_all:
+        require_alias_free(collection)
+    else:
+        require_incremental_writes(collection)
+    pipeline = get_pipeline(collection)
     # Сохраняем файл временно
     temp_path = Path(f"/tmp/{file.filename}")
     try:
@@ -129,8 +746,8 @@ async def upload_document(file: UploadFile = File(...), replace_all: bool = True
             content = await file.read()
             f.write(content)
         
-        pipeline = RAGPipeline()
         count = pipeline.ingest_document(str(temp_path), replace_all=replace_all)
+        notify_write(pipeline)
         
         return {"message": "Документ загружен", "filename": file.filename, "chunks": count}
     except Exception as e:
@@ -141,10 +758,10 @@ async def upload_document(file: UploadFile = File(...), replace_all: bool = True
 
 
 @app.get("/documents")
-async def list_documents():
+async def list_documents(collection: Optional[str] = None):
     """Список всех документов"""
+    pipeline = get_pipeline(collection)
     try:
-        pipeline = RAGPipeline()
         doc_names = pipeline.list_documents()
         vector_store = pipeline.vector_store
         
@@ -168,17 +785,20 @@ async def list_documents():
 
 
 @app.put("/documents/{document_name}")
-async def update_document(document_name: str, file: UploadFile = File(...)):
+async def update_document(document_name: str, file: UploadFile = File(...), collection: Optional[str] = None):
     """Обновить документ"""
+    require_writer()
+    require_incremental_writes(collection)
+    pipeline = get_pipeline(collection)
     temp_path = Path(f"/tmp/{file.filename}")
     try:
         with open(temp_path, "wb") as f:
             content = await file.read()
             f.write(content)
         
-        pipeline = RAGPipeline()
         deleted = pipeline.delete_document(document_name)
         count = pipeline.ingest_document(str(temp_path), replace_all=False)
+        notify_write(pipeline)
         
         return {
             "message": "Документ обновлен",
@@ -193,11 +813,14 @@ async def update_document(document_name: str, file: UploadFile = File(...)):
 
 
 @app.delete("/documents/{document_name}")
-async def delete_document(document_name: str):
+async def delete_document(document_name: str, collection: Optional[str] = None):
     """Удалить документ"""
+    require_writer()
+    require_incremental_writes(collection)
+    pipeline = get_pipeline(collection)
     try:
-        pipeline = RAGPipeline()
         count = pipeline.delete_document(document_name)
+        notify_write(pipeline)
         return {
             "message": "Документ удален",
             "deleted_chunks": count
@@ -212,11 +835,34 @@ async def root():
     return {
         "message": "RAG API",
         "endpoints": {
+            "GET /healthz": "Liveness",
+            "GET /readyz": "Readiness",
             "POST /query": "Выполнить запрос",
+            "POST /query_batch": "Пакетный запрос",
             "POST /documents": "Загрузить документ",
             "GET /documents": "Список документов",
             "PUT /documents/{name}": "Обновить документ",
-            "DELETE /documents/{name}": "Удалить документ"
+            "DELETE /documents/{name}": "Удалить документ",
+            "POST /admin/migrate_index": "Перестроить индекс с параметрами HNSW из конфигурации",
+            "POST /admin/snapshot": "Создать снапшот коллекции",
+            "GET /admin/snapshots": "Список снапшотов",
+            "POST /admin/snapshot/restore": "Загрузить снапшот без пересчета эмбеддингов",
+            "POST /admin/reembed": "Перекодировать коллекцию новой моделью в фоне",
+            "GET /admin/reembed": "Прогресс миграции на новую модель",
+            "POST /admin/reembed/switch": "Переключить запросы на новую модель",
+            "POST /admin/reembed/rollback": "Вернуть прежнюю модель",
+            "POST /admin/reembed/cancel": "Отменить миграцию",
+            "DELETE /admin/reembed": "Удалить ненужную после миграции коллекцию",
+            "GET /collections": "Список коллекций (тенантов)",
+            "GET /embedding/stats": "Состояние модели эмбеддингов",
+            "GET /faq": "Список FAQ",
+            "POST /faq": "Добавить FAQ",
+            "PUT /faq/{id}": "Обновить FAQ",
+            "DELETE /faq/{id}": "Удалить FAQ",
+            "GET /faq/stats": "Статистика FAQ",
+            "GET /intents/stats": "Статистика маршрутизации приветствий и болтовни",
+            "GET /tables": "Таблицы из документов",
+            "GET /tables/stats": "Статистика индекса таблиц"
         }
     }
 
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Запуск RAG API в несколько воркеров по схеме pre-fork
+
+Мастер загружает модель эмбеддингов до fork, поэтому веса разделяются
+воркерами copy-on-write, а не загружаются в каждом процессе заново.
+Число потоков torch/OMP на воркер: EMBEDDING_TORCH_THREADS или ядра / воркеры.
+ChromaDB, кэш эмбеддингов и прогрев открываются уже в воркерах.
+
+Несколько воркеров допустимы с VECTOR_STORE_BACKEND=pgvector или на реплике
+(RAG_ROLE=replica). Писатель на локальном ChromaDB работает в одном
+процессе: PersistentClient каждого воркера держит свою копию HNSW индекса,
+поэтому дозагрузки одного воркера не видны остальным, а одновременные записи
+нескольких процессов в один каталог повреждают индекс.
+
+Использование: RAG_WORKERS=4 python -m RAG.api.serve
+"""
+
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+from RAG.rag.config import DEFAULT_CONFIG
+
+
+def resolve_torch_threads(workers: int) -> int:
+    """Потоки torch на воркер: из конфигурации или поровну делим ядра"""
+    if DEFAULT_CONFIG.embedding.torch_threads > 0:
+        return DEFAULT_CONFIG.embedding.torch_threads
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def run_worker(sock: socket.socket, torch_threads: int):
+    """Тело воркера: собственный event loop uvicorn на унаследованном сокете"""
+    import torch
+    import uvicorn
+    from RAG.api.rag_api import app
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    torch.set_num_threads(torch_threads)
+    print(f"Воркер {os.getpid()} запущен, потоков torch: {torch_threads}")
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def main():
+    workers = int(os.getenv('RAG_WORKERS', '1'))
+    host = os.getenv('RAG_HOST', '0.0.0.0')
+    port = int(os.getenv('RAG_PORT', '8000'))
+    torch_threads = resolve_torch_threads(workers)
+
+    # До импорта torch: размер пулов OpenMP/MKL наследуется воркерами
+    os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+    os.environ['MKL_NUM_THREADS'] = str(torch_threads)
+    # Пул потоков tokenizers после fork небезопасен
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+    if workers <= 1:
+        import torch
+        import uvicorn
+        from RAG.api.rag_api import app
+        torch.set_num_threads(torch_threads)
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    from RAG.rag.vector_store import VECTOR_STORE_BACKEND
+
+    if VECTOR_STORE_BACKEND == "chroma" and DEFAULT_CONFIG.snapshot.role != "replica":
+        # Реплика пишет только под блокировкой и в новую коллекцию с переключением алиаса,
+        # которое остальные воркеры подхватывают; писатель меняет коллекцию на месте
+        raise SystemExit(
+            f"RAG_WORKERS={workers} недоступен для писателя на ChromaDB: запустите один воркер, "
+            "используйте VECTOR_STORE_BACKEND=pgvector или реплики (RAG_ROLE=replica)"
+        )
+
+    if DEFAULT_CONFIG.embedding.idle_unload_minutes > 0:
+        # Перезагрузка после выгрузки дала бы каждому воркеру собственную копию весов
+        print("Выгрузка модели по простою отключена в режиме нескольких воркеров")
+        DEFAULT_CONFIG.embedding.idle_unload_minutes = 0
+
+    from RAG.api.rag_api import preload_embedding_model
+
+    started = time.perf_counter()
+    preload_embedding_model()
+    print(f"Модель загружена в мастере за {time.perf_counter() - started:.1f} с")
+    # Объекты, созданные до fork, не трогаются сборщиком мусора в воркерах
+    gc.collect()
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, torch_threads)
+            finally:
+                os._exit(0)
+        children[pid] = time.monotonic()
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print(f"RAG API: {workers} воркеров на {host}:{port}, потоков torch на воркер: {torch_threads}")
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started_at = children.pop(pid, None)
+        if stopping or started_at is None:
+            continue
+        print(f"Воркер {pid} завершился (статус {status}), перезапуск")
+        # Не перезапускаем в цикле воркер, падающий сразу при старте
+        if time.monotonic() - started_at < 5:
+            time.sleep(5)
+        spawn()
+
+    sock.close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,3 +25,7 @@ class LLMProvider:
         response_content = prompt.choices[0].message.content
         return response_content
 
+    def check_token(self) -> bool:
+        """Проверяет, что клиент может получить валидный токен (легкий запрос списка моделей)"""
+        self.giga.get_models()
+        return True
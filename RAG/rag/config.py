@@ -1,9 +1,14 @@
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List
+import os
 
 @dataclass
 class ChunkingConfig:
     """Конфигурация разбиения текста на чанки"""
+    # "markdown" - по структуре документа с лимитом в токенах, "recursive" - старый символьный сплиттер
+    strategy: str = "markdown"
+    max_tokens: int = 240  # Лимит all-MiniLM-L6-v2 - 256 токенов, оставляем запас
+    tokenizer_name: str = None  # По умолчанию токенизатор модели эмбеддингов
     chunk_size: int = 500
     chunk_overlap: int = 100
     separators: List[str] = None
@@ -19,8 +24,33 @@ class EmbeddingConfig:
     # all-MiniLM-L6-v2: ~80MB, быстрая, без ONNX оптимизаций
     # paraphrase-multilingual-mpnet-base-v2: ~420MB, лучше качество, но есть ONNX версии
     model_name: str = "sentence-transformers/all-MiniLM-L6-v2"
+    # Локальная копия модели (собирается в образ scripts/bundle_model.py), приоритетнее model_name
+    model_path: str = os.getenv('EMBEDDING_MODEL_PATH', '')
     normalize_embeddings: bool = True
     batch_size: int = 8  # Уменьшено с 32 для экономии памяти (2GB RAM)
+    # Персистентный кэш эмбеддингов (SQLite), переживает перезапуски и пересборки
+    use_cache: bool = True
+    cache_path: str = None  # По умолчанию EMBEDDING_CACHE_PATH или /app/data/embedding_cache.sqlite
+    cache_max_entries: int = 200_000  # ~300MB для 384-мерных векторов
+    # Многопроцессное кодирование для больших переиндексаций (0 или 1 - выключено)
+    num_workers: int = int(os.getenv('EMBEDDING_NUM_WORKERS', '0'))
+    worker_torch_threads: int = 1
+    worker_memory_mb: int = 400  # Оценка RSS одного воркера с моделью
+    pool_memory_budget_mb: int = int(os.getenv('EMBEDDING_POOL_MEMORY_MB', '3200'))
+    parallel_min_texts: int = 256  # Меньшие объемы кодируются в текущем процессе
+    # "local" - модель в процессе, "server" - общий сервер эмбеддингов (RAG/rag/embedding_server.py)
+    backend: str = os.getenv('EMBEDDING_BACKEND', 'local')
+    server_socket: str = os.getenv('EMBEDDING_SERVER_SOCKET', '/run/embedding/embedding.sock')
+    server_max_batch: int = 64  # Максимум текстов в общем батче сервера
+    server_max_wait_ms: float = 5.0  # Сколько сервер ждет запросы других клиентов для батча
+    # Потоки torch/OMP процесса API (0 - ядра / число воркеров RAG_WORKERS)
+    torch_threads: int = int(os.getenv('EMBEDDING_TORCH_THREADS', '0'))
+    # Понижение размерности хранимых векторов: "" - нет, "pca" - PCA по корпусу, "truncate" - Matryoshka
+    projection: str = os.getenv('EMBEDDING_PROJECTION', '')
+    projection_dim: int = int(os.getenv('EMBEDDING_PROJECTION_DIM', '0'))
+    # Выгрузка модели после простоя (0 - никогда) и окно предзагрузки, например "9-21"
+    idle_unload_minutes: float = float(os.getenv('EMBEDDING_IDLE_UNLOAD_MINUTES', '0'))
+    preload_hours: str = os.getenv('EMBEDDING_PRELOAD_HOURS', '')
 
 @dataclass
 class RetrievalConfig:
@@ -29,7 +59,105 @@ class RetrievalConfig:
     use_reranking: bool = True
     rerank_top_k: int = 5  # Сколько результатов re-rank
     use_multi_query: bool = True
-    min_similarity_threshold: float = 0.3  # Минимальный порог релевантности
+    # Минимальный порог релевантности по метрике коллекции: сходство 1 - d (cosine, ip)
+    # и 1 / (1 + d) (l2) несопоставимы. Реранкер всегда отдает косинус, поэтому его
+    # оценки сравниваются с порогом "cosine" в любой коллекции
+    min_similarity_thresholds: Dict[str, float] = None
+    # Параметры HNSW индекса коллекции (применяются при создании, для старых - migrate_index)
+    distance_space: str = "cosine"  # cosine, ip или l2
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 100
+    hnsw_ef_search: int = 50
+    # Через сколько удаляется старая коллекция после переключения алиаса: запросы в полете
+    # (другие потоки и воркеры pre-fork) дочитывают ее по старому хэндлу
+    drop_grace_seconds: float = 30.0
+    # Иерархический поиск: сначала top-M документов по центроидам, потом чанки внутри них (0 - выключено).
+    # По умолчанию выключен: отсечение по центроидам теряет ответы из документов вне top-M,
+    # включать для больших корпусов, где полный поиск заметно дороже
+    hierarchical_top_m: int = 0
+    # Кэш результатов поиска по LSH-сигнатуре эмбеддинга запроса
+    use_result_cache: bool = True
+    result_cache_bits: int = 24  # Больше бит - точнее совпадение, меньше попаданий
+    result_cache_size: int = 1024
+
+    def __post_init__(self):
+        if self.min_similarity_thresholds is None:
+            # cosine: та же шкала, по которой отсекались переранжированные результаты;
+            # l2: прежнее значение для старых коллекций (1 / (1 + d))
+            self.min_similarity_thresholds = {"cosine": 0.3, "ip": 0.3, "l2": 0.3}
+
+    def similarity_threshold(self, space: str) -> float:
+        """Порог релевантности для сходства в метрике space"""
+        return self.min_similarity_thresholds.get(space, self.min_similarity_thresholds["cosine"])
+
+@dataclass
+class DedupConfig:
+    """Конфигурация схлопывания почти-дубликатов чанков при загрузке"""
+    enabled: bool = True
+    threshold: float = 0.85  # Оценка Jaccard по MinHash, выше которой чанки считаются копиями
+    num_perm: int = 64
+    bands: int = 16  # 16 полос по 4 строки: кандидаты начиная с Jaccard ~0.5
+    shingle_size: int = 3  # Словесные n-граммы
+    seed: int = 42
+
+@dataclass
+class FAQConfig:
+    """Конфигурация быстрых ответов по курируемым FAQ"""
+    enabled: bool = True
+    threshold: float = 0.9  # Косинусное сходство с вариантом вопроса для прямого ответа
+    path: str = None  # По умолчанию faq.json рядом с ChromaDB
+
+@dataclass
+class IntentConfig:
+    """Конфигурация маршрутизации приветствий и болтовни до RAG и LLM"""
+    enabled: bool = True
+    rule_max_words: int = 4  # Словарные правила проверяются только для коротких сообщений
+    use_centroids: bool = True
+    centroid_max_words: int = 5  # Длинные сообщения всегда считаются вопросами
+    threshold: float = 0.8  # Косинус с центроидом интента для шаблонного ответа
+
+@dataclass
+class TableConfig:
+    """Конфигурация структурированного индекса таблиц из документов"""
+    enabled: bool = True
+    path: str = None  # По умолчанию tables.sqlite рядом с ChromaDB
+    min_rows: int = 1  # Таблицы с меньшим числом строк не индексируются
+    max_key_words: int = 5  # Ячейки длиннее (в словах) не становятся ключами
+    max_key_length: int = 60  # То же в символах: описания и примечания не ключи
+    stem_length: int = 6  # Слова усекаются до стольких символов ("робототехника" ~ "робототехнике"), 0 - нет
+    max_rows: int = 8  # Сколько строк попадает в контекст
+    # Совпадение по стольким колонкам сразу отвечает строками таблиц без векторного поиска (0 - поиск всегда)
+    direct_min_columns: int = 2
+
+@dataclass
+class ContextConfig:
+    """Конфигурация сборки контекста для LLM"""
+    max_tokens: int = 1200  # Бюджет токенов на контекст в промпте
+    max_passages: int = 5
+    mmr_lambda: float = 0.7  # 1.0 - только релевантность, 0.0 - только разнообразие
+    redundancy_threshold: float = 0.95  # Косинус, выше которого пассаж считается копией
+
+@dataclass
+class SnapshotConfig:
+    """Конфигурация снапшотов индекса (бэкапы и разворачивание новых узлов)"""
+    dir: str = os.getenv('RAG_SNAPSHOT_DIR', '/app/data/snapshots')
+    keep: int = int(os.getenv('RAG_SNAPSHOT_KEEP', '5'))  # Сколько последних снапшотов коллекции хранить
+    # "writer" - единственный экземпляр, принимающий изменения; "replica" - только чтение из снапшотов
+    role: str = os.getenv('RAG_ROLE', 'writer')
+    publish_on_write: bool = os.getenv('RAG_SNAPSHOT_ON_WRITE', '0') == '1'  # Писатель публикует снапшот после изменений
+    publish_delay_seconds: float = 10.0  # Серия изменений за это время дает один снапшот
+    poll_seconds: float = float(os.getenv('RAG_SNAPSHOT_POLL_SECONDS', '30'))  # Как часто реплика проверяет снапшоты
+    swap_grace_seconds: float = 30.0  # Через сколько реплика удаляет старую коллекцию после переключения
+
+@dataclass
+class ReembedConfig:
+    """Конфигурация фоновой миграции эмбеддингов на другую модель"""
+    batch_size: int = 64  # Чанков за шаг, после каждого шага сохраняется контрольная точка
+    pause_seconds: float = 0.5  # Пауза между шагами, чтобы миграция не отнимала CPU у запросов
+    auto_switch: bool = True  # Переключить запросы на новую коллекцию сразу после завершения
+    # Каталог собранных в образ дополнительных моделей: <каталог>/<org>--<name>
+    # (ARG EXTRA_EMBEDDING_MODELS в RAG/Dockerfile); в офлайн-образе другие модели не загрузятся
+    models_dir: str = os.getenv('EMBEDDING_MODELS_DIR', '/app/models')
 
 @dataclass
 class RAGConfig:
@@ -37,6 +165,13 @@ class RAGConfig:
     chunking: ChunkingConfig = None
     embedding: EmbeddingConfig = None
     retrieval: RetrievalConfig = None
+    dedup: DedupConfig = None
+    faq: FAQConfig = None
+    intents: IntentConfig = None
+    tables: TableConfig = None
+    context: ContextConfig = None
+    snapshot: SnapshotConfig = None
+    reembed: ReembedConfig = None
     
     def __post_init__(self):
         if self.chunking is None:
@@ -45,6 +180,25 @@ class RAGConfig:
             self.embedding = EmbeddingConfig()
         if self.retrieval is None:
             self.retrieval = RetrievalConfig()
+        if self.dedup is None:
+            self.dedup = DedupConfig()
+        if self.faq is None:
+            self.faq = FAQConfig()
+        if self.intents is None:
+            self.intents = IntentConfig()
+        if self.tables is None:
+            self.tables = TableConfig()
+        if self.context is None:
+            self.context = ContextConfig()
+        if self.snapshot is None:
+            self.snapshot = SnapshotConfig()
+        if self.reembed is None:
+            self.reembed = ReembedConfig()
+        if self.chunking.tokenizer_name is None:
+            if self.embedding.model_path and os.path.isdir(self.embedding.model_path):
+                self.chunking.tokenizer_name = self.embedding.model_path
+            else:
+                self.chunking.tokenizer_name = self.embedding.model_name
 
 
 DEFAULT_CONFIG = RAGConfig()
@@ -0,0 +1,126 @@
+from typing import Dict, List
+import numpy as np
+from RAG.rag.config import ContextConfig
+from RAG.rag.markdown_chunker import get_token_counter
+
+
+def merge_overlapping(first: str, second: str, max_overlap: int = 500) -> str:
+    """Склеивает соседние чанки, убирая повтор на стыке (суффикс first == префикс second)"""
+    limit = min(len(first), len(second), max_overlap)
+    for size in range(limit, 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+
+def mmr_select(
+    embeddings: np.ndarray,
+    relevance: np.ndarray,
+    k: int,
+    lambda_mult: float,
+    redundancy_threshold: float
+) -> List[int]:
+    """Maximal Marginal Relevance: отбирает релевантные и непохожие друг на друга пассажи"""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-8
+    normalized = embeddings / norms
+    pairwise = normalized @ normalized.T
+
+    selected: List[int] = []
+    candidates = list(range(len(relevance)))
+    while candidates and len(selected) < k:
+        cand = np.array(candidates)
+        if selected:
+            redundancy = pairwise[np.ix_(cand, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(cand))
+        # Почти полные копии уже выбранных пассажей отбрасываются сразу
+        keep = redundancy < redundancy_threshold
+        cand, redundancy = cand[keep], redundancy[keep]
+        if not len(cand):
+            break
+        scores = lambda_mult * relevance[cand] - (1 - lambda_mult) * redundancy
+        best = int(cand[int(np.argmax(scores))])
+        selected.append(best)
+        candidates = [c for c in cand.tolist() if c != best]
+    return selected
+
+
+class ContextBuilder:
+    """Собирает контекст для LLM: MMR, склейка соседних чанков, упаковка в бюджет токенов"""
+
+    def __init__(self, embedding_service, config: ContextConfig = None, tokenizer_name: str = None):
+        if config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            config = DEFAULT_CONFIG.context
+            tokenizer_name = tokenizer_name or DEFAULT_CONFIG.chunking.tokenizer_name
+        self.config = config
+        self.embedding_service = embedding_service
+        self.tokenizer_name = tokenizer_name
+
+    def build(self, sources: List[Dict], embeddings: List = None) -> str:
+        """Строит контекст из источников (content, metadata, similarity)
+
+        embeddings - векторы источников, уже полученные из векторной БД при поиске;
+        если их нет, пассажи кодируются заново.
+        """
+        if not sources:
+            return ""
+
+        # 1. MMR по эмбеддингам пассажей
+        if len(sources) > 1:
+            if embeddings is None or any(e is None for e in embeddings):
+                embeddings = self.embedding_service.encode([s["content"] for s in sources])
+            relevance = np.array([s["similarity"] for s in sources], dtype=np.float32)
+            order = mmr_select(
+                np.asarray(embeddings, dtype=np.float32),
+                relevance,
+                self.config.max_passages,
+                self.config.mmr_lambda,
+                self.config.redundancy_threshold,
+            )
+            sources = [sources[i] for i in order]
+
+        # 2. Склейка соседних чанков одного документа
+        passages = self._merge_adjacent(sources)
+
+        # 3. Упаковка в бюджет токенов, начиная с самых релевантных
+        count_tokens = get_token_counter(self.tokenizer_name)
+        packed, used = [], 0
+        for passage in passages:
+            tokens = count_tokens(passage["content"])
+            if used + tokens > self.config.max_tokens:
+                continue
+            packed.append(passage["content"])
+            used += tokens
+        if not packed:
+            # Даже самый релевантный пассаж не влез - берем его начало
+            packed.append(passages[0]["content"][:self.config.max_tokens * 4])
+        return "\n\n".join(packed)
+
+    def _merge_adjacent(self, sources: List[Dict]) -> List[Dict]:
+        """Объединяет выбранные чанки одного документа с соседними chunk_index"""
+        passages: List[Dict] = []
+        by_document: Dict[str, List[Dict]] = {}
+        for source in sources:
+            metadata = source.get("metadata") or {}
+            by_document.setdefault(metadata.get("document", ""), []).append(source)
+
+        for document_name, items in by_document.items():
+            items.sort(key=lambda s: (s.get("metadata") or {}).get("chunk_index", 0))
+            current = None
+            for item in items:
+                index = (item.get("metadata") or {}).get("chunk_index")
+                if current is not None and index is not None and index - current["last_index"] <= 1:
+                    current["content"] = merge_overlapping(current["content"], item["content"])
+                    current["similarity"] = max(current["similarity"], item["similarity"])
+                    current["last_index"] = index
+                    continue
+                current = {
+                    "content": item["content"],
+                    "similarity": item["similarity"],
+                    "last_index": index if index is not None else -10,
+                }
+                passages.append(current)
+
+        passages.sort(key=lambda p: p["similarity"], reverse=True)
+        return passages
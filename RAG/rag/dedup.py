@@ -0,0 +1,187 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from collections import defaultdict
+from pathlib import Path
+import base64
+import re
+import zlib
+import numpy as np
+from RAG.rag.config import DedupConfig
+
+SOURCES_SEPARATOR = "|"
+# Флаг "документ - источник чанка" в метаданных: Chroma не умеет искать подстроку в metadata["sources"]
+SOURCE_FLAG_PREFIX = "src:"
+# Сигнатура и хэши полос LSH хранятся в метаданных чанка, чтобы дозагрузка не пересчитывала корпус
+SIGNATURE_KEY = "minhash"
+BAND_KEY_PREFIX = "lsh_"
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def split_sources(sources: Optional[str]) -> List[str]:
+    """Разбирает строку источников чанка из метаданных"""
+    if not sources:
+        return []
+    return [s for s in sources.split(SOURCES_SEPARATOR) if s]
+
+
+def join_sources(sources: Iterable[str]) -> str:
+    """Собирает список источников в строку для метаданных Chroma"""
+    return SOURCES_SEPARATOR.join(dict.fromkeys(sources))
+
+
+def source_flag(document_name: str) -> str:
+    return f"{SOURCE_FLAG_PREFIX}{document_name}"
+
+
+def set_sources(metadata: Dict, sources: List[str], removed: Iterable[str] = ()):
+    """Записывает источники чанка: строку sources и флаги src:<документ> для фильтров where
+
+    Снятый источник помечается 0, а не удаляется: update в Chroma сливает метаданные.
+    """
+    metadata["sources"] = join_sources(sources)
+    for document_name in removed:
+        metadata[source_flag(document_name)] = 0
+    for document_name in sources:
+        metadata[source_flag(document_name)] = 1
+
+
+def sources_filter(document_names: List[str]) -> Dict:
+    """Фильтр where: чанки, у которых документ - основной или один из источников"""
+    clauses = [{"document": {"$in": list(document_names)}}]
+    clauses.extend({source_flag(name): 1} for name in document_names)
+    return {"$or": clauses}
+
+
+def public_metadata(metadata: Dict) -> Dict:
+    """Метаданные чанка без служебных полей дедупликации (для ответов API)"""
+    return {
+        key: value for key, value in (metadata or {}).items()
+        if key != SIGNATURE_KEY and not key.startswith((BAND_KEY_PREFIX, SOURCE_FLAG_PREFIX))
+    }
+
+
+class MinHashIndex:
+    """MinHash + LSH индекс для поиска почти-дубликатов текста"""
+
+    def __init__(self, config: DedupConfig):
+        if config.num_perm % config.bands != 0:
+            raise ValueError("num_perm должен делиться на bands без остатка")
+        self.config = config
+        self.rows = config.num_perm // config.bands
+        rng = np.random.RandomState(config.seed)
+        self._a = rng.randint(1, 1 << 31, size=config.num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, _MAX_HASH, size=config.num_perm, dtype=np.uint64)
+        self._buckets: Dict[Tuple[int, bytes], List[str]] = defaultdict(list)
+        self._signatures: Dict[str, np.ndarray] = {}
+
+    def _shingles(self, text: str) -> np.ndarray:
+        words = _WORD_RE.findall(text.lower())
+        k = self.config.shingle_size
+        if len(words) < k:
+            grams = [' '.join(words)] if words else [text]
+        else:
+            grams = [' '.join(words[i:i + k]) for i in range(len(words) - k + 1)]
+        return np.array(
+            sorted({zlib.crc32(g.encode('utf-8')) for g in grams}),
+            dtype=np.uint64,
+        )
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash-сигнатура текста (векторизовано по перестановкам)"""
+        shingles = self._shingles(text)
+        # (a * x + b) mod p: x < 2^32 и a < 2^31, поэтому произведение не переполняет uint64
+        hashed = (np.outer(shingles, self._a) + self._b) % _MERSENNE_PRIME
+        return (hashed & _MAX_HASH).min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.config.bands):
+            part = signature[band * self.rows:(band + 1) * self.rows]
+            yield band, part.tobytes()
+
+    def band_hashes(self, signature: np.ndarray) -> List[int]:
+        """Хэши полос LSH для индексируемых полей метаданных (коллизии дают лишь лишних кандидатов)"""
+        return [zlib.crc32(key) for _, key in self._band_keys(signature)]
+
+    def to_metadata(self, signature: np.ndarray) -> Dict:
+        metadata = {SIGNATURE_KEY: base64.b64encode(signature.astype(np.uint32).tobytes()).decode("ascii")}
+        for band, band_hash in enumerate(self.band_hashes(signature)):
+            metadata[f"{BAND_KEY_PREFIX}{band}"] = band_hash
+        return metadata
+
+    def from_metadata(self, metadata: Dict) -> Optional[np.ndarray]:
+        """Сигнатура из метаданных или None, если ее нет или она посчитана с другим num_perm"""
+        encoded = (metadata or {}).get(SIGNATURE_KEY)
+        if not encoded:
+            return None
+        signature = np.frombuffer(base64.b64decode(encoded), dtype=np.uint32)
+        return signature if signature.shape[0] == self.config.num_perm else None
+
+    def add(self, key: str, signature: np.ndarray):
+        self._signatures[key] = signature
+        for band_key in self._band_keys(signature):
+            self._buckets[band_key].append(key)
+
+    def query(self, signature: np.ndarray) -> Optional[str]:
+        """Возвращает ключ самого похожего текста выше порога или None"""
+        candidates = set()
+        for band_key in self._band_keys(signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        best_key, best_score = None, self.config.threshold
+        for key in candidates:
+            score = float(np.mean(self._signatures[key] == signature))
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+
+def collapse_near_duplicates(
+    chunks: List[Dict],
+    config: DedupConfig,
+    find_candidates: Optional[Callable[[Dict[int, List[int]]], Iterable[Tuple[str, Dict]]]] = None,
+) -> Tuple[List[Dict], Dict[str, List[str]]]:
+    """Схлопывает почти-дубликаты среди новых чанков и относительно уже сохраненных
+
+    Args:
+        chunks: Новые чанки документа
+        config: Параметры MinHash/LSH
+        find_candidates: Поиск сохраненных чанков по хэшам полос LSH (полоса -> хэши);
+            возвращает пары (id, метаданные с сигнатурой). None - сравнивать только новые чанки
+
+    Returns:
+        Уникальные новые чанки (источники и сигнатура в metadata) и словарь
+        id сохраненного чанка -> документы, которые нужно добавить в его источники
+    """
+    index = MinHashIndex(config)
+    signatures = [index.signature(chunk["content"]) for chunk in chunks]
+    if find_candidates is not None and signatures:
+        # Один индексированный запрос по полосам вместо чтения и перехэширования всего корпуса
+        band_hashes: Dict[int, List[int]] = defaultdict(list)
+        for signature in signatures:
+            for band, band_hash in enumerate(index.band_hashes(signature)):
+                band_hashes[band].append(band_hash)
+        for chunk_id, metadata in find_candidates(dict(band_hashes)):
+            signature = index.from_metadata(metadata)
+            if signature is not None:
+                index.add(f"existing:{chunk_id}", signature)
+
+    unique: List[Dict] = []
+    attach: Dict[str, List[str]] = defaultdict(list)
+    for chunk, signature in zip(chunks, signatures):
+        document_name = Path(chunk["source"]).name
+        match = index.query(signature)
+        if match is None:
+            metadata = chunk.setdefault("metadata", {})
+            set_sources(metadata, [document_name])
+            metadata.update(index.to_metadata(signature))
+            index.add(f"new:{len(unique)}", signature)
+            unique.append(chunk)
+        elif match.startswith("existing:"):
+            attach[match[len("existing:"):]].append(document_name)
+        else:
+            kept = unique[int(match[len("new:"):])]
+            set_sources(kept["metadata"], split_sources(kept["metadata"]["sources"]) + [document_name])
+
+    if len(unique) < len(chunks):
+        print(f"Схлопнуто почти-дубликатов: {len(chunks) - len(unique)} из {len(chunks)}")
+    return unique, dict(attach)
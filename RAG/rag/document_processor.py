@@ -1,16 +1,25 @@
 from pathlib import Path
 from typing import Dict, List
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from RAG.rag.config import ChunkingConfig
-from markitdown import MarkItDown
+from RAG.rag.markdown_chunker import chunk_markdown, get_token_counter
 
-md_converter = MarkItDown()
+# markitdown и langchain тяжелые, импортируются только при загрузке документов
+_md_converter = None
+
+
+def get_md_converter():
+    """Ленивое создание конвертера MarkItDown"""
+    global _md_converter
+    if _md_converter is None:
+        from markitdown import MarkItDown
+        _md_converter = MarkItDown()
+    return _md_converter
 
 
 def document_to_markdown(document_path: str) -> Dict[str, str]:
     """Конвертирует документ в markdown текст"""
     try:
-        result = md_converter.convert(document_path)
+        result = get_md_converter().convert(document_path)
         content = result.text_content
     except Exception as e:
         raise ValueError(f"Ошибка при чтении документа {document_path}: {e}")
@@ -27,14 +36,25 @@ def split_document(document: Dict[str, str], config: ChunkingConfig = None) -> L
         from RAG.rag.config import DEFAULT_CONFIG
         config = DEFAULT_CONFIG.chunking
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=config.chunk_size,
-        chunk_overlap=config.chunk_overlap,
-        separators=config.separators,
-        length_function=len,
-    )
+    if config.strategy == "markdown":
+        count_tokens = get_token_counter(config.tokenizer_name)
+        md_chunks = chunk_markdown(document["content"], config.max_tokens, count_tokens)
+        doc_chunks = [c["content"] for c in md_chunks]
+        extra_metadata = [
+            {"heading_path": c["heading_path"], "chunk_tokens": c["tokens"]}
+            for c in md_chunks
+        ]
+    else:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-    doc_chunks = text_splitter.split_text(document["content"])
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=config.chunk_size,
+            chunk_overlap=config.chunk_overlap,
+            separators=config.separators,
+            length_function=len,
+        )
+        doc_chunks = text_splitter.split_text(document["content"])
+        extra_metadata = [{} for _ in doc_chunks]
 
     chunks = []
     for i, chunk_text in enumerate(doc_chunks):
@@ -47,6 +67,7 @@ def split_document(document: Dict[str, str], config: ChunkingConfig = None) -> L
                 "total_chunks": len(doc_chunks),
                 "document_name": Path(document["source"]).name,
                 "chunk_length": len(chunk_text),
+                **extra_metadata[i],
             }
         }
         chunks.append(chunk)
@@ -0,0 +1,109 @@
+from typing import Dict, List
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+
+class EmbeddingCache:
+    """Персистентный кэш эмбеддингов в SQLite с LRU-вытеснением
+
+    Ключ - хэш от (модель, флаг нормализации, текст), значение - float32 вектор в BLOB.
+    """
+
+    # Ограничение SQLite на число параметров в одном запросе
+    _MAX_VARS = 500
+
+    def __init__(self, path: str, max_entries: int = 200_000):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, dim INTEGER NOT NULL, "
+            "vector BLOB NOT NULL, last_access INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name: str, normalize: bool, text: str) -> str:
+        """Формирует ключ кэша для текста"""
+        payload = f"{model_name}\0{int(bool(normalize))}\0{text}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Возвращает найденные в кэше векторы и обновляет время доступа"""
+        found = {}
+        now = time.time_ns()
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), self._MAX_VARS):
+                part = unique_keys[start:start + self._MAX_VARS]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    part,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_access = ? WHERE key IN ({placeholders})",
+                        [now, *part],
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        """Сохраняет векторы в кэш и вытесняет самые старые записи при переполнении"""
+        if not items:
+            return
+        now = time.time_ns()
+        rows = []
+        for key, vector in items.items():
+            vector = np.ascontiguousarray(vector, dtype=np.float32)
+            rows.append((key, vector.shape[0], vector.tobytes(), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vector, last_access) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Удаляет наименее востребованные записи сверх лимита"""
+        if not self.max_entries:
+            return
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (excess,),
+            )
+
+    def count(self) -> int:
+        """Количество записей в кэше"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def clear(self):
+        """Очищает кэш"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
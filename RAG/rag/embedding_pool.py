@@ -0,0 +1,71 @@
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import os
+import numpy as np
+from RAG.rag.config import EmbeddingConfig
+
+# Модель, загруженная в процессе-воркере (у каждого воркера своя копия)
+_worker_model = None
+_worker_batch_size = 8
+
+
+def _init_worker(model_name: str, cache_dir: str, torch_threads: int, batch_size: int):
+    """Инициализация воркера: ограничение потоков torch и загрузка модели"""
+    global _worker_model, _worker_batch_size
+    os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+    os.environ['MKL_NUM_THREADS'] = str(torch_threads)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(torch_threads)
+    _worker_model = SentenceTransformer(model_name, device="cpu", cache_folder=cache_dir)
+    _worker_model.eval()
+    _worker_batch_size = batch_size
+
+
+def _encode_shard(texts: List[str], normalize: bool) -> np.ndarray:
+    """Кодирует шард текстов в процессе-воркере"""
+    return _worker_model.encode(
+        texts,
+        normalize_embeddings=normalize,
+        batch_size=_worker_batch_size,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+    ).astype(np.float32, copy=False)
+
+
+def resolve_num_workers(config: EmbeddingConfig) -> int:
+    """Число воркеров с учетом ядер и бюджета памяти"""
+    if config.num_workers <= 1:
+        return 0
+    by_cores = max(1, (os.cpu_count() or 1) // max(1, config.worker_torch_threads))
+    by_memory = max(1, config.pool_memory_budget_mb // max(1, config.worker_memory_mb))
+    workers = min(config.num_workers, by_cores, by_memory)
+    return workers if workers > 1 else 0
+
+
+def encode_parallel(texts: List[str], config: EmbeddingConfig, normalize: bool, cache_dir: str) -> np.ndarray:
+    """Шардирует тексты по процессам и собирает эмбеддинги в исходном порядке"""
+    num_workers = resolve_num_workers(config)
+    # Несколько шардов на воркер, чтобы выровнять нагрузку при разной длине текстов
+    num_shards = min(len(texts), num_workers * 4)
+    shard_size = -(-len(texts) // num_shards)
+    shards = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+
+    # Локальная копия модели из образа приоритетнее загрузки по имени
+    model_source = config.model_path if config.model_path and os.path.isdir(config.model_path) else config.model_name
+
+    print(f"Параллельное кодирование: {len(texts)} текстов, {num_workers} процессов, {len(shards)} шардов")
+    # spawn вместо fork: torch небезопасен после fork с инициализированными потоками
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(model_source, cache_dir, config.worker_torch_threads, config.batch_size),
+    ) as executor:
+        results = list(executor.map(_encode_shard, shards, [normalize] * len(shards)))
+
+    return np.vstack(results)
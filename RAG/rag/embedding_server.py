@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Отдельный процесс-сервер эмбеддингов поверх Unix-сокета
+
+Сервер держит единственную копию модели и объединяет запросы разных клиентов
+в общие батчи. Тексты передаются в JSON-заголовке, векторы - через разделяемую
+память клиента (float32), без сериализации чисел в JSON.
+
+Протокол: кадр = 4 байта длины (big-endian) + JSON.
+  {"op": "info"} -> {"model_name", "dim"}
+  {"op": "encode", "texts": [...], "normalize": bool, "shm": имя, "capacity": байт}
+      -> {"shape": [n, dim]} либо {"error": "..."}
+
+Использование: python -m RAG.rag.embedding_server [--socket /run/embedding/embedding.sock]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List
+
+import numpy as np
+
+from RAG.rag.config import EmbeddingConfig
+
+HEADER = struct.Struct(">I")
+
+
+def _attach_shm(name: str) -> SharedMemory:
+    """Подключение к чужому сегменту без регистрации в resource_tracker
+
+    Иначе трекер этого процесса удалит сегмент клиента при своем завершении.
+    """
+    shm = SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+class EmbeddingServer:
+    """Сервер модели с кросс-клиентским батчингом запросов"""
+
+    def __init__(self, config: EmbeddingConfig = None):
+        from RAG.rag.embedding_service import EmbeddingService
+
+        if config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            config = DEFAULT_CONFIG.embedding
+        self.config = config
+        # Сервер всегда кодирует локально, даже если в окружении выбран клиентский бэкенд
+        self.service = EmbeddingService(replace(config, backend="local"))
+        self.dim = None
+        self._queue: asyncio.Queue = None
+        # Модель вызывается из одного потока, event loop остается свободным
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.requests_served = 0
+        self.batches_run = 0
+
+    async def _batch_loop(self):
+        """Собирает запросы в окне server_max_wait_ms и кодирует их одним вызовом модели"""
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.config.server_max_wait_ms / 1000
+            while size < self.config.server_max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            for normalize in (True, False):
+                group = [item for item in pending if item[1] == normalize]
+                if not group:
+                    continue
+                texts = [text for item in group for text in item[0]]
+                try:
+                    embeddings = await loop.run_in_executor(
+                        self._executor, self.service.encode, texts, normalize
+                    )
+                except Exception as e:
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.batches_run += 1
+                start = 0
+                for item_texts, _, future in group:
+                    if not future.done():
+                        future.set_result(embeddings[start:start + len(item_texts)])
+                    start += len(item_texts)
+
+    async def _encode(self, texts: List[str], normalize: bool) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, normalize, future))
+        return await future
+
+    async def _handle_request(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "info":
+            return {"model_name": self.config.model_name, "dim": self.dim}
+        if op == "stats":
+            return {
+                "requests_served": self.requests_served,
+                "batches_run": self.batches_run,
+                **self.service.get_stats(),
+            }
+        if op != "encode":
+            return {"error": f"Неизвестная операция: {op}"}
+
+        texts = request["texts"]
+        if len(texts) * self.dim * 4 > request["capacity"]:
+            return {"error": "Недостаточный размер разделяемой памяти клиента"}
+        embeddings = await self._encode(texts, request.get("normalize", True))
+        shm = _attach_shm(request["shm"])
+        try:
+            out = np.ndarray(embeddings.shape, dtype=np.float32, buffer=shm.buf)
+            out[:] = embeddings
+            del out
+        finally:
+            shm.close()
+        self.requests_served += 1
+        return {"shape": list(embeddings.shape)}
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+                    request = json.loads(await reader.readexactly(length))
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    response = await self._handle_request(request)
+                except Exception as e:
+                    response = {"error": str(e)}
+                payload = json.dumps(response).encode("utf-8")
+                writer.write(HEADER.pack(len(payload)) + payload)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str):
+        started = time.perf_counter()
+        self.dim = int(self.service.encode(["прогрев модели"]).shape[1])
+        print(f"Модель эмбеддингов загружена за {time.perf_counter() - started:.1f} с, размерность {self.dim}")
+
+        self._queue = asyncio.Queue()
+        asyncio.get_running_loop().create_task(self._batch_loop())
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+        server = await asyncio.start_unix_server(self._handle_client, path=socket_path)
+        os.chmod(socket_path, 0o660)
+        print(f"Сервер эмбеддингов слушает {socket_path}")
+        async with server:
+            await server.serve_forever()
+
+
+class EmbeddingClient:
+    """Клиент сервера эмбеддингов: одно соединение и буфер разделяемой памяти на поток"""
+
+    def __init__(self, socket_path: str, timeout: float = 60.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._info = None
+
+    def _call(self, request: dict) -> dict:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        payload = json.dumps(request, ensure_ascii=False).encode("utf-8")
+        try:
+            sock.sendall(HEADER.pack(len(payload)) + payload)
+            (length,) = HEADER.unpack(self._recv_exactly(sock, HEADER.size))
+            response = json.loads(self._recv_exactly(sock, length))
+        except Exception:
+            # Соединение в неизвестном состоянии: следующий вызов переподключится
+            sock.close()
+            self._local.sock = None
+            raise
+        if "error" in response:
+            raise RuntimeError(f"Сервер эмбеддингов: {response['error']}")
+        return response
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Сервер эмбеддингов закрыл соединение")
+            data.extend(chunk)
+        return bytes(data)
+
+    @property
+    def info(self) -> dict:
+        if self._info is None:
+            self._info = self._call({"op": "info"})
+        return self._info
+
+    def _buffer(self, size: int) -> SharedMemory:
+        """Переиспользуемый сегмент разделяемой памяти потока, растет по мере надобности"""
+        shm = getattr(self._local, "shm", None)
+        if shm is None or shm.size < size:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = SharedMemory(create=True, size=max(size, 1 << 20))
+            self._local.shm = shm
+        return shm
+
+    def encode(self, texts: List[str], normalize: bool = True) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.info["dim"]), dtype=np.float32)
+        shm = self._buffer(len(texts) * self.info["dim"] * 4)
+        response = self._call({
+            "op": "encode",
+            "texts": list(texts),
+            "normalize": normalize,
+            "shm": shm.name,
+            "capacity": shm.size,
+        })
+        shape = tuple(response["shape"])
+        return np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy()
+
+    def stats(self) -> dict:
+        return self._call({"op": "stats"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", default=None, help="Путь Unix-сокета (по умолчанию EMBEDDING_SERVER_SOCKET)")
+    args = parser.parse_args()
+
+    from RAG.rag.config import DEFAULT_CONFIG
+
+    server = EmbeddingServer(DEFAULT_CONFIG.embedding)
+    asyncio.run(server.serve(args.socket or DEFAULT_CONFIG.embedding.server_socket))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
-from typing import List
+from typing import Dict, List, TYPE_CHECKING
+from dataclasses import replace
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from RAG.rag.config import EmbeddingConfig
+from RAG.rag.embedding_cache import EmbeddingCache
+from RAG.rag.embedding_pool import encode_parallel, resolve_num_workers
 import gc
 import os
+import threading
+import time
+from datetime import datetime
+
+if TYPE_CHECKING:
+    # torch и sentence_transformers импортируются только при загрузке модели
+    from sentence_transformers import SentenceTransformer
 
 class EmbeddingService:
     """Сервис для создания эмбеддингов"""
@@ -15,67 +24,116 @@ class EmbeddingService:
         
         self.config = config
         self._model = None
+        self._cache = None
+        self._client = None
+        self._load_lock = threading.RLock()
+        self._last_used = time.monotonic()
+        self._idle_thread = None
+        self.load_count = 0
+        self.unload_count = 0
+        self.last_load_seconds = None
     
     @property
-    def model(self) -> SentenceTransformer:
-        """Ленивая загрузка модели с оптимизацией для CPU"""
-        if self._model is None:
-            os.environ['TRANSFORMERS_NO_ADVISORY_WARNINGS'] = '1'
-            os.environ['HF_HUB_DISABLE_EXPERIMENTAL_WARNING'] = '1'
-            os.environ['HF_HUB_DISABLE_SYMLINKS_WARNING'] = '1'
-            os.environ['HF_HUB_DISABLE_PROGRESS_BARS'] = '1'
-
-            # Определяем путь к кэшу моделей из переменной окружения
-            cache_dir = os.getenv('HF_HOME', '/app/data/models')
-            
-            print(f"Загрузка модели {self.config.model_name}...")
-            print(f"Используется кэш: {cache_dir}")
-            self._model = SentenceTransformer(
-                self.config.model_name,
-                device="cpu",
-                cache_folder=cache_dir
+    def cache(self) -> EmbeddingCache:
+        """Ленивое открытие персистентного кэша эмбеддингов"""
+        if self._cache is None and self.config.use_cache:
+            cache_path = self.config.cache_path or os.getenv(
+                'EMBEDDING_CACHE_PATH', '/app/data/embedding_cache.sqlite'
             )
+            self._cache = EmbeddingCache(cache_path, self.config.cache_max_entries)
+        return self._cache
+    
+    @property
+    def client(self):
+        """Клиент сервера эмбеддингов, если выбран бэкенд server"""
+        if self._client is None and self.config.backend == "server":
+            from RAG.rag.embedding_server import EmbeddingClient
+            self._client = EmbeddingClient(self.config.server_socket)
+        return self._client
+    
+    @property
+    def model(self) -> "SentenceTransformer":
+        """Ленивая загрузка модели; после выгрузки по простою загружается прозрачно"""
+        self._last_used = time.monotonic()
+        # Локальная ссылка: фоновая выгрузка не должна отдать None посреди вызова
+        model = self._model
+        if model is None:
+            with self._load_lock:
+                if self._model is None:
+                    started = time.perf_counter()
+                    self._model = self._load_model()
+                    self.last_load_seconds = time.perf_counter() - started
+                    self.load_count += 1
+                model = self._model
+        return model
+    
+    def _load_model(self) -> "SentenceTransformer":
+        """Загрузка модели с оптимизацией для CPU"""
+        from sentence_transformers import SentenceTransformer
 
+        # Модель, собранная в образ: грузим напрямую с диска без обращений к HF Hub
+        if self.config.model_path and os.path.isdir(self.config.model_path):
+            print(f"Загрузка модели из {self.config.model_path}...")
+            model = SentenceTransformer(self.config.model_path, device="cpu")
+            model.eval()
+            return model
 
-            try:
-                from pathlib import Path
-                cache_dir = os.getenv('HF_HOME', os.path.expanduser('~/.cache/huggingface'))
-                model_cache = Path(cache_dir) / "hub" / f"models--{self.config.model_name.replace('/', '--')}"
-                
-                if model_cache.exists():
-                    deleted_count = 0
-                    # Удаляем ONNX файлы
-                    for onnx_file in model_cache.rglob("*.onnx"):
-                        try:
-                            onnx_file.unlink()
+        os.environ['TRANSFORMERS_NO_ADVISORY_WARNINGS'] = '1'
+        os.environ['HF_HUB_DISABLE_EXPERIMENTAL_WARNING'] = '1'
+        os.environ['HF_HUB_DISABLE_SYMLINKS_WARNING'] = '1'
+        os.environ['HF_HUB_DISABLE_PROGRESS_BARS'] = '1'
+
+        # Определяем путь к кэшу моделей из переменной окружения
+        cache_dir = os.getenv('HF_HOME', '/app/data/models')
+
+        print(f"Загрузка модели {self.config.model_name}...")
+        print(f"Используется кэш: {cache_dir}")
+        model = SentenceTransformer(
+            self.config.model_name,
+            device="cpu",
+            cache_folder=cache_dir
+        )
+
+
+        try:
+            from pathlib import Path
+            cache_dir = os.getenv('HF_HOME', os.path.expanduser('~/.cache/huggingface'))
+            model_cache = Path(cache_dir) / "hub" / f"models--{self.config.model_name.replace('/', '--')}"
+
+            if model_cache.exists():
+                deleted_count = 0
+                # Удаляем ONNX файлы
+                for onnx_file in model_cache.rglob("*.onnx"):
+                    try:
+                        onnx_file.unlink()
+                        deleted_count += 1
+                    except:
+                        pass
+                # Удаляем OpenVINO файлы
+                for openvino_file in model_cache.rglob("*openvino*"):
+                    try:
+                        if openvino_file.is_file():
+                            openvino_file.unlink()
+                            deleted_count += 1
+                    except:
+                        pass
+                # Удаляем quantized файлы
+                for quant_file in model_cache.rglob("*quantized*"):
+                    try:
+                        if quant_file.is_file():
+                            quant_file.unlink()
                             deleted_count += 1
-                        except:
-                            pass
-                    # Удаляем OpenVINO файлы
-                    for openvino_file in model_cache.rglob("*openvino*"):
-                        try:
-                            if openvino_file.is_file():
-                                openvino_file.unlink()
-                                deleted_count += 1
-                        except:
-                            pass
-                    # Удаляем quantized файлы
-                    for quant_file in model_cache.rglob("*quantized*"):
-                        try:
-                            if quant_file.is_file():
-                                quant_file.unlink()
-                                deleted_count += 1
-                        except:
-                            pass
-                    if deleted_count > 0:
-                        print(f"Удалено {deleted_count} оптимизированных файлов (ONNX/OpenVINO) из кэша")
-            except Exception as cleanup_error:
-                print(f"Не удалось очистить оптимизированные файлы: {cleanup_error}")
-            
-            # Оптимизация модели для CPU
-            if hasattr(self._model, 'eval'):
-                self._model.eval()
-        return self._model
+                    except:
+                        pass
+                if deleted_count > 0:
+                    print(f"Удалено {deleted_count} оптимизированных файлов (ONNX/OpenVINO) из кэша")
+        except Exception as cleanup_error:
+            print(f"Не удалось очистить оптимизированные файлы: {cleanup_error}")
+
+        # Оптимизация модели для CPU
+        if hasattr(model, 'eval'):
+            model.eval()
+        return model
     
     def encode(
         self, 
@@ -87,6 +145,8 @@ class EmbeddingService:
         """Создает эмбеддинги для списка текстов"""
         if normalize is None:
             normalize = self.config.normalize_embeddings
+        if self.client is not None:
+            return self.client.encode(texts, normalize)
         if batch_size is None:
             batch_size = self.config.batch_size
         
@@ -105,7 +165,44 @@ class EmbeddingService:
         return self.encode([query], show_progress=False)[0]
     
     def encode_batch(self, texts: List[str], batch_size: int = None) -> np.ndarray:
-        """Создает эмбеддинги батчами для больших объемов данных с оптимизацией памяти"""
+        """Создает эмбеддинги батчами для больших объемов данных с оптимизацией памяти
+        
+        Перед запуском модели проверяет персистентный кэш, кодирует только промахи.
+        """
+        cache = self.cache
+        if cache is None or not texts:
+            return self._encode_batches(texts, batch_size)
+        
+        normalize = self.config.normalize_embeddings
+        keys = [EmbeddingCache.make_key(self.config.model_name, normalize, t) for t in texts]
+        cached = cache.get_many(keys)
+        
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        
+        if missing:
+            new_embeddings = self._encode_batches(list(missing.values()), batch_size)
+            computed = dict(zip(missing.keys(), new_embeddings))
+            cache.put_many(computed)
+            cached.update(computed)
+        print(f"Кэш эмбеддингов: {len(texts) - len(missing)} попаданий, {len(missing)} промахов")
+        
+        return np.vstack([cached[key] for key in keys]).astype(np.float32, copy=False)
+    
+    def _encode_batches(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """Кодирует тексты моделью батчами с периодической очисткой памяти"""
+        if self.client is not None:
+            # Батчингом занимается сервер, отправляем крупными порциями
+            step = self.config.server_max_batch
+            return np.vstack([self.client.encode(texts[i:i + step], self.config.normalize_embeddings)
+                              for i in range(0, len(texts), step)])
+        
+        if len(texts) >= self.config.parallel_min_texts and resolve_num_workers(self.config):
+            cache_dir = os.getenv('HF_HOME', '/app/data/models')
+            return encode_parallel(texts, self.config, self.config.normalize_embeddings, cache_dir)
+        
         if batch_size is None:
             batch_size = self.config.batch_size
         
@@ -131,9 +228,149 @@ class EmbeddingService:
         return result
     
     def clear_cache(self):
-        """Очищает кэш модели"""
-        if self._model is not None:
-            del self._model
-            self._model = None
+        """Выгружает модель и возвращает память torch операционной системе"""
+        with self._load_lock:
+            if self._model is not None:
+                del self._model
+                self._model = None
+                self.unload_count += 1
         gc.collect()
+        try:
+            # glibc не отдает освобожденную память без malloc_trim
+            import ctypes
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except Exception:
+            pass
+    
+    def _in_preload_hours(self) -> bool:
+        """Попадает ли текущее время в окно предзагрузки (например "9-21")"""
+        if not self.config.preload_hours:
+            return False
+        start, end = (int(h) for h in self.config.preload_hours.split("-"))
+        hour = datetime.now().hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+    
+    def _idle_loop(self, check_interval: float):
+        while True:
+            time.sleep(check_interval)
+            try:
+                idle_seconds = time.monotonic() - self._last_used
+                if self._in_preload_hours():
+                    if self._model is None:
+                        print("Предзагрузка модели по расписанию")
+                        self.model
+                elif self._model is not None and idle_seconds > self.config.idle_unload_minutes * 60:
+                    print(f"Модель простаивает {idle_seconds / 60:.0f} мин, выгружаем")
+                    self.clear_cache()
+            except Exception as e:
+                print(f"Ошибка в политике простоя модели: {e}")
+    
+    def start_idle_watcher(self, check_interval: float = 30.0):
+        """Запускает фоновую выгрузку модели по простою (если idle_unload_minutes > 0)"""
+        if self.config.idle_unload_minutes <= 0 or self._idle_thread is not None or self.client is not None:
+            return
+        self._idle_thread = threading.Thread(
+            target=self._idle_loop, args=(check_interval,), daemon=True
+        )
+        self._idle_thread.start()
+    
+    def get_stats(self) -> dict:
+        """Текущее состояние модели: загружена ли, RSS процесса, счетчики загрузок/выгрузок"""
+        rss_mb = None
+        pss_mb = None
+        try:
+            with open("/proc/self/statm") as f:
+                rss_mb = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+            # PSS делит разделяемые страницы между процессами: для pre-fork воркеров честнее RSS
+            with open("/proc/self/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        pss_mb = int(line.split()[1]) / 1024
+                        break
+        except Exception:
+            pass
+        if self.client is not None:
+            try:
+                server = self.client.stats()
+            except Exception as e:
+                server = {"error": str(e)}
+            return {
+                "model_name": self.config.model_name,
+                "backend": "server",
+                "socket": self.config.server_socket,
+                "pid": os.getpid(),
+                "rss_mb": rss_mb,
+                "pss_mb": pss_mb,
+                "server": server,
+            }
+        return {
+            "model_name": self.config.model_name,
+            "backend": "local",
+            "pid": os.getpid(),
+            "loaded": self._model is not None,
+            "rss_mb": rss_mb,
+            "pss_mb": pss_mb,
+            "load_count": self.load_count,
+            "unload_count": self.unload_count,
+            "last_load_seconds": self.last_load_seconds,
+            "idle_seconds": time.monotonic() - self._last_used,
+            "idle_unload_minutes": self.config.idle_unload_minutes,
+            "preload_hours": self.config.preload_hours,
+        }
+
+
+_services_by_model: Dict[str, EmbeddingService] = {}
+_services_lock = threading.Lock()
+
+
+def bundled_model_path(model_name: str) -> str:
+    """Каталог копии модели, собранной в образ (scripts/bundle_model.py), или "" если ее нет"""
+    from RAG.rag.config import DEFAULT_CONFIG
+
+    path = os.path.join(DEFAULT_CONFIG.reembed.models_dir, model_name.replace('/', '--'))
+    return path if os.path.isdir(path) else ""
+
+
+def get_embedding_service_for(model_name: str, base: EmbeddingService) -> EmbeddingService:
+    """Сервис для модели коллекции; для модели из конфигурации - сам базовый сервис"""
+    if model_name == base.config.model_name:
+        return base
+    with _services_lock:
+        service = _services_by_model.get(model_name)
+        if service is None:
+            # Общий сервер эмбеддингов обслуживает только базовую модель; копия другой модели
+            # берется из каталога дополнительных моделей образа, иначе - из HF Hub
+            service = EmbeddingService(replace(
+                base.config, model_name=model_name, model_path=bundled_model_path(model_name), backend="local"
+            ))
+            _services_by_model[model_name] = service
+        return service
+
+
+class CollectionEmbeddings:
+    """Эмбеддинги той модели, которой построена текущая коллекция
+
+    После миграции на другую модель алиас переключается на новую коллекцию, и
+    запросы должны кодироваться новой моделью, а после отката - снова прежней.
+    """
+
+    def __init__(self, vector_store, base: EmbeddingService):
+        self.vector_store = vector_store
+        self.base = base
+
+    @property
+    def service(self) -> EmbeddingService:
+        return get_embedding_service_for(self.vector_store.embedding_model, self.base)
+
+    def encode(self, texts: List[str], normalize: bool = None, batch_size: int = None,
+               show_progress: bool = False) -> np.ndarray:
+        return self.service.encode(texts, normalize, batch_size, show_progress)
+
+    def encode_query(self, query: str) -> np.ndarray:
+        return self.service.encode_query(query)
+
+    def encode_batch(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        return self.service.encode_batch(texts, batch_size)
 
+    def __getattr__(self, name):
+        return getattr(self.service, name)
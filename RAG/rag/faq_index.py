@@ -0,0 +1,189 @@
+from typing import Dict, List, Optional, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+import fcntl
+import json
+import os
+import threading
+import uuid
+import numpy as np
+from RAG.rag.config import FAQConfig
+
+
+class FAQIndex:
+    """Индекс курируемых FAQ: варианты вопроса -> канонический ответ
+
+    Совпадение ищется одним матричным произведением по заранее посчитанным
+    эмбеддингам вариантов вопросов, без векторной БД и LLM. faq.json общий для
+    воркеров pre-fork: правки идут под flock по свежей копии с диска, а чтения
+    перечитывают файл, если его изменил другой воркер.
+    """
+
+    def __init__(self, embedding_service, config: FAQConfig = None, path: str = None):
+        if config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            config = DEFAULT_CONFIG.faq
+        self.config = config
+        self.embedding_service = embedding_service
+        if path is None:
+            path = config.path or str(Path(os.getenv('CHROMA_DB_PATH', '/app/data/chroma_db')) / "faq.json")
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._file_state = None
+        self._entries: Dict[str, Dict] = self._load()
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_model: Optional[str] = None
+        self._row_entry_ids: List[str] = []
+        self.lookups = 0
+        self.hits = 0
+
+    def _stat(self) -> Optional[tuple]:
+        """Признак версии файла: os.replace меняет inode, правка - mtime и размер"""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self) -> Dict[str, Dict]:
+        self._file_state = self._stat()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return {entry["id"]: entry for entry in json.load(f)}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self):
+        """Атомарно сохраняет FAQ на диск и сбрасывает матрицу эмбеддингов"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(self._entries.values()), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+        self._file_state = self._stat()
+        self._matrix = None
+
+    def _refresh(self):
+        """Перечитывает FAQ, если файл изменил другой воркер (вызывается под self._lock)"""
+        if self._stat() != self._file_state:
+            self._entries = self._load()
+            self._matrix = None
+
+    @contextmanager
+    def _mutation(self):
+        """Правка FAQ: flock между воркерами и записи, перечитанные с диска под ним
+
+        Без этого воркер перезаписал бы faq.json своей устаревшей копией.
+        """
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path.with_suffix(".lock"), "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._entries = self._load()
+                self._matrix = None
+                yield
+
+    def _build_matrix(self):
+        """Кодирует все варианты вопросов в одну нормализованную матрицу"""
+        questions, row_ids = [], []
+        for entry in self._entries.values():
+            for question in entry["questions"]:
+                questions.append(question)
+                row_ids.append(entry["id"])
+        if questions:
+            matrix = np.asarray(self.embedding_service.encode_batch(questions), dtype=np.float32)
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-8
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        self._matrix = matrix
+        self._matrix_model = self.embedding_service.config.model_name
+        self._row_entry_ids = row_ids
+
+    def match(self, question: str, query_embedding: np.ndarray = None) -> Optional[Tuple[Dict, float]]:
+        """Ищет FAQ для вопроса; возвращает (запись, сходство) выше порога или None
+
+        query_embedding - уже посчитанный эмбеддинг вопроса (например, маршрутизатором интентов).
+        """
+        with self._lock:
+            self.lookups += 1
+            self._refresh()
+            if not self._entries:
+                return None
+            # После переключения коллекции на другую модель матрица пересчитывается
+            if self._matrix is None or self._matrix_model != self.embedding_service.config.model_name:
+                self._build_matrix()
+            matrix, row_ids = self._matrix, self._row_entry_ids
+
+        if query_embedding is None:
+            query_embedding = self.embedding_service.encode_query(question)
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        query_embedding = query_embedding / (np.linalg.norm(query_embedding) + 1e-8)
+        scores = matrix @ query_embedding
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        if score < self.config.threshold:
+            return None
+
+        with self._lock:
+            self.hits += 1
+            entry = self._entries.get(row_ids[best])
+        return (entry, score) if entry else None
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            self._refresh()
+            return list(self._entries.values())
+
+    def get(self, entry_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._refresh()
+            return self._entries.get(entry_id)
+
+    def create(self, questions: List[str], answer: str) -> Dict:
+        entry = {"id": uuid.uuid4().hex, "questions": questions, "answer": answer}
+        with self._mutation():
+            self._entries[entry["id"]] = entry
+            self._save()
+        return entry
+
+    def update(self, entry_id: str, questions: List[str] = None, answer: str = None) -> Optional[Dict]:
+        with self._mutation():
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                return None
+            if questions is not None:
+                entry["questions"] = questions
+            if answer is not None:
+                entry["answer"] = answer
+            self._save()
+        return entry
+
+    def delete(self, entry_id: str) -> bool:
+        with self._mutation():
+            if self._entries.pop(entry_id, None) is None:
+                return False
+            self._save()
+        return True
+
+    def reload(self):
+        """Перечитывает FAQ с диска (файл изменил другой процесс)"""
+        with self._lock:
+            self._entries = self._load()
+            self._matrix = None
+
+    def replace_entries(self, entries: List[Dict]):
+        """Заменяет все записи FAQ (восстановление из снапшота)"""
+        with self._mutation():
+            self._entries = {entry["id"]: entry for entry in entries}
+            self._save()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._refresh()
+        return {
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "threshold": self.config.threshold,
+        }
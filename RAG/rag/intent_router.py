@@ -0,0 +1,178 @@
+from typing import Dict, List, Optional
+from collections import Counter
+import random
+import re
+import threading
+import numpy as np
+from RAG.rag.config import IntentConfig
+
+WORD_RE = re.compile(r'\w+')
+
+# Интенты, на которые отвечает шаблон без поиска и LLM.
+# words - словарь правила: сообщение целиком из этих слов (и FILLER_WORDS) относится к интенту;
+# examples - фразы для центроида интента в пространстве эмбеддингов.
+INTENTS: Dict[str, Dict[str, List[str]]] = {
+    "greeting": {
+        "words": ["привет", "приветик", "здравствуйте", "здравствуй", "здрасте", "добрый", "доброе", "день",
+                  "утро", "вечер", "хай", "hi", "hello", "салют", "ку"],
+        "examples": ["привет", "здравствуйте", "добрый день", "доброе утро", "добрый вечер", "приветствую"],
+        "replies": [
+            "Здравствуйте! Я помогу с вопросами о школе программирования KiberOne: курсы, расписание, "
+            "стоимость и запись. Что вас интересует?",
+        ],
+    },
+    "thanks": {
+        "words": ["спасибо", "спс", "благодарю", "благодарствую", "thanks", "thx", "мерси", "пасиб"],
+        "examples": ["спасибо", "большое спасибо", "благодарю за помощь", "спасибо за ответ"],
+        "replies": ["Пожалуйста! Если появятся еще вопросы - пишите."],
+    },
+    "ack": {
+        "words": ["ок", "окей", "ok", "okay", "хорошо", "понятно", "ясно", "понял", "поняла", "ладно", "угу",
+                  "ага", "супер", "отлично", "класс", "круто", "норм"],
+        "examples": ["ок", "понятно", "хорошо", "ясно", "ладно", "отлично"],
+        "replies": ["Хорошо! Если нужно что-то уточнить о курсах KiberOne - спрашивайте."],
+    },
+    "goodbye": {
+        "words": ["пока", "до", "свидания", "встречи", "всего", "доброго", "bye"],
+        "examples": ["пока", "до свидания", "всего доброго", "до встречи"],
+        "replies": ["До свидания! Будем рады видеть вас в KiberOne."],
+    },
+    "small_talk": {
+        "words": [],
+        "examples": ["как дела", "как ты", "кто ты", "ты бот", "что ты умеешь", "как тебя зовут"],
+        "replies": [
+            "Я ассистент школы программирования KiberOne и с радостью расскажу о курсах, расписании "
+            "и стоимости обучения. Что вас интересует?",
+        ],
+    },
+    "out_of_scope": {
+        "words": [],
+        "examples": ["какая погода завтра", "расскажи анекдот", "напиши стихотворение", "кто выиграл матч",
+                     "посоветуй фильм", "реши уравнение"],
+        "replies": [
+            "Я отвечаю только на вопросы о школе программирования KiberOne. Спросите, например, "
+            "о курсах, расписании или стоимости обучения.",
+        ],
+    },
+}
+
+# Центроид обычных вопросов: ближайший к нему короткий запрос уходит в RAG
+QUERY_EXAMPLES = [
+    "сколько стоит обучение", "какие есть курсы", "как записаться на пробное занятие", "расписание занятий",
+    "где находится школа", "с какого возраста", "есть ли скидки", "чему учат на курсе",
+]
+
+# Слова, которые не меняют интент: "спасибо большое", "привет всем"
+FILLER_WORDS = {"большое", "огромное", "вам", "тебе", "всем", "очень", "и", "еще", "раз", "все", "а"}
+
+QUERY_INTENT = "query"
+
+
+class IntentRouter:
+    """Дешевая классификация сообщения до FAQ, поиска и LLM
+
+    Приветствия, благодарности и болтовня получают шаблонный ответ. Сначала
+    работают словарные правила (микросекунды), затем для коротких сообщений -
+    ближайший центроид по эмбеддингу запроса, который потом переиспользуется FAQ.
+    """
+
+    def __init__(self, embedding_service, config: IntentConfig = None):
+        if config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            config = DEFAULT_CONFIG.intents
+        self.config = config
+        self.embedding_service = embedding_service
+        self._word_intents: Dict[str, str] = {
+            word: intent for intent, spec in INTENTS.items() for word in spec["words"]
+        }
+        self._lock = threading.Lock()
+        self._centroids: Optional[np.ndarray] = None
+        self._centroids_model: Optional[str] = None
+        self._centroid_intents: List[str] = []
+        self.counts: Counter = Counter()
+        self.rule_hits = 0
+        self.centroid_hits = 0
+
+    def _match_rules(self, words: List[str]) -> Optional[str]:
+        """Интент по словарю: все значимые слова сообщения из словаря одного интента"""
+        if not words:
+            # Только эмодзи и знаки препинания
+            return "ack"
+        intents = Counter()
+        for word in words:
+            if word in FILLER_WORDS:
+                continue
+            intent = self._word_intents.get(word)
+            if intent is None:
+                return None
+            intents[intent] += 1
+        if not intents:
+            return None
+        return intents.most_common(1)[0][0]
+
+    def _build_centroids(self):
+        """Кодирует примеры интентов и усредняет их в нормализованные центроиды"""
+        groups = [(intent, spec["examples"]) for intent, spec in INTENTS.items()]
+        groups.append((QUERY_INTENT, QUERY_EXAMPLES))
+        centroids = []
+        for _, examples in groups:
+            embeddings = np.asarray(self.embedding_service.encode_batch(examples), dtype=np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-8
+            centroid = embeddings.mean(axis=0)
+            centroids.append(centroid / (np.linalg.norm(centroid) + 1e-8))
+        self._centroids = np.vstack(centroids)
+        self._centroids_model = self.embedding_service.config.model_name
+        self._centroid_intents = [intent for intent, _ in groups]
+
+    def route(self, question: str) -> Dict:
+        """Классифицирует сообщение
+
+        Возвращает {"intent", "reply", "score", "method", "embedding"}; intent == "query"
+        означает обычный вопрос для RAG (reply None). embedding - эмбеддинг запроса,
+        если он уже посчитан, чтобы FAQ и поиск не кодировали его повторно.
+        """
+        words = WORD_RE.findall(question.lower().replace('ё', 'е'))
+        intent = self._match_rules(words) if len(words) <= self.config.rule_max_words else None
+        if intent is not None:
+            return self._routed(intent, 1.0, "rules")
+
+        if not self.config.use_centroids or len(words) > self.config.centroid_max_words:
+            return self._routed(QUERY_INTENT, 0.0, None)
+
+        with self._lock:
+            # После переключения коллекции на другую модель центроиды пересчитываются
+            if self._centroids is None or self._centroids_model != self.embedding_service.config.model_name:
+                self._build_centroids()
+            centroids, centroid_intents = self._centroids, self._centroid_intents
+
+        embedding = np.asarray(self.embedding_service.encode_query(question), dtype=np.float32)
+        normalized = embedding / (np.linalg.norm(embedding) + 1e-8)
+        scores = centroids @ normalized
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        intent = centroid_intents[best]
+        if intent == QUERY_INTENT or score < self.config.threshold:
+            return self._routed(QUERY_INTENT, score, None, embedding)
+        return self._routed(intent, score, "centroid", embedding)
+
+    def _routed(self, intent: str, score: float, method: Optional[str], embedding: np.ndarray = None) -> Dict:
+        with self._lock:
+            self.counts[intent] += 1
+            if method == "rules":
+                self.rule_hits += 1
+            elif method == "centroid":
+                self.centroid_hits += 1
+        reply = random.choice(INTENTS[intent]["replies"]) if intent != QUERY_INTENT else None
+        return {"intent": intent, "reply": reply, "score": score, "method": method, "embedding": embedding}
+
+    def stats(self) -> Dict:
+        total = sum(self.counts.values())
+        handled = total - self.counts[QUERY_INTENT]
+        return {
+            "total": total,
+            "intents": dict(self.counts),
+            "rule_hits": self.rule_hits,
+            "centroid_hits": self.centroid_hits,
+            "handled_rate": handled / total if total else 0.0,
+            "threshold": self.config.threshold,
+        }
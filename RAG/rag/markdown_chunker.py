@@ -0,0 +1,198 @@
+from typing import Callable, Dict, List, Tuple
+from functools import lru_cache
+import os
+import re
+
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*)$')
+LIST_ITEM_RE = re.compile(r'^\s*([-*+]|\d+[.)])\s+')
+TABLE_SEPARATOR_RE = re.compile(r'^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?$')
+SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+')
+
+
+@lru_cache(maxsize=4)
+def get_token_counter(tokenizer_name: str) -> Callable[[str], int]:
+    """Возвращает функцию подсчета токенов токенизатором модели эмбеддингов"""
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer_name,
+        cache_dir=os.getenv('HF_HOME', '/app/data/models'),
+    )
+
+    def count_tokens(text: str) -> int:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    return count_tokens
+
+
+def parse_blocks(text: str) -> List[Tuple[str, str]]:
+    """Разбирает markdown на блоки (тип, текст): heading, table, list_item, code, paragraph"""
+    blocks = []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+
+        if not stripped:
+            i += 1
+            continue
+
+        if stripped.startswith('```'):
+            code = [line]
+            i += 1
+            while i < len(lines):
+                code.append(lines[i])
+                i += 1
+                if lines[i - 1].strip().startswith('```'):
+                    break
+            blocks.append(('code', '\n'.join(code)))
+            continue
+
+        if HEADING_RE.match(stripped):
+            blocks.append(('heading', stripped))
+            i += 1
+            continue
+
+        if stripped.startswith('|'):
+            rows = []
+            while i < len(lines) and lines[i].strip().startswith('|'):
+                rows.append(lines[i].strip())
+                i += 1
+            blocks.append(('table', '\n'.join(rows)))
+            continue
+
+        if LIST_ITEM_RE.match(line):
+            item = [line]
+            i += 1
+            # Продолжение пункта: строки с отступом, не являющиеся новым пунктом
+            while (i < len(lines) and lines[i].strip() and lines[i][:1].isspace()
+                   and not LIST_ITEM_RE.match(lines[i])):
+                item.append(lines[i])
+                i += 1
+            blocks.append(('list_item', '\n'.join(item)))
+            continue
+
+        paragraph = [line]
+        i += 1
+        while i < len(lines):
+            nxt = lines[i].strip()
+            if (not nxt or nxt.startswith('|') or nxt.startswith('```')
+                    or HEADING_RE.match(nxt) or LIST_ITEM_RE.match(lines[i])):
+                break
+            paragraph.append(lines[i])
+            i += 1
+        blocks.append(('paragraph', '\n'.join(paragraph)))
+
+    return blocks
+
+
+def _split_table(table: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """Режет таблицу по целым строкам, повторяя заголовок в каждой части"""
+    rows = table.split('\n')
+    header = []
+    if len(rows) >= 2 and TABLE_SEPARATOR_RE.match(rows[1]):
+        header, rows = rows[:2], rows[2:]
+    header_tokens = count_tokens('\n'.join(header)) if header else 0
+
+    parts, current, current_tokens = [], [], header_tokens
+    for row in rows:
+        row_tokens = count_tokens(row)
+        if current and current_tokens + row_tokens > max_tokens:
+            parts.append('\n'.join(header + current))
+            current, current_tokens = [], header_tokens
+        current.append(row)
+        current_tokens += row_tokens
+    if current or not parts:
+        parts.append('\n'.join(header + current))
+    return parts
+
+
+def _split_text(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """Режет слишком длинный блок по предложениям, слишком длинные предложения - по словам"""
+    pieces = SENTENCE_RE.split(text)
+    if len(pieces) == 1:
+        pieces = text.split()
+
+    parts, current, current_tokens = [], [], 0
+    for piece in pieces:
+        piece_tokens = count_tokens(piece)
+        if piece_tokens > max_tokens and len(piece.split()) > 1:
+            # Предложение не влезает в лимит целиком: модель молча обрезала бы его
+            if current:
+                parts.append(' '.join(current))
+                current, current_tokens = [], 0
+            parts.extend(_split_text(piece, max_tokens, count_tokens))
+            continue
+        if current and current_tokens + piece_tokens > max_tokens:
+            parts.append(' '.join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        parts.append(' '.join(current))
+    return parts
+
+
+def chunk_markdown(
+    text: str,
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+) -> List[Dict]:
+    """Разбивает markdown на чанки по структуре документа с лимитом в токенах
+
+    Заголовки начинают новый чанк, пункты списков и строки таблиц не разрезаются.
+    Возвращает список {"content", "heading_path", "tokens"}.
+    """
+    chunks = []
+    heading_stack: List[Tuple[int, str]] = []
+    current: List[str] = []
+    current_tokens = 0
+    current_path = ""
+    # Пока в чанке только заголовки, он не сбрасывается отдельно, а прилипает к следующему блоку
+    heading_only = False
+
+    def flush():
+        nonlocal current, current_tokens, heading_only
+        heading_only = False
+        if current:
+            chunks.append({
+                "content": '\n\n'.join(current),
+                "heading_path": current_path,
+                "tokens": current_tokens,
+            })
+        current, current_tokens = [], 0
+
+    for kind, block in parse_blocks(text):
+        if kind == 'heading':
+            flush()
+            level = len(HEADING_RE.match(block).group(1))
+            heading_stack = [h for h in heading_stack if h[0] < level]
+            heading_stack.append((level, HEADING_RE.match(block).group(2).strip()))
+            current_path = ' > '.join(h[1] for h in heading_stack)
+            current.append(block)
+            current_tokens += count_tokens(block)
+            heading_only = True
+            continue
+
+        # Заголовки в начале чанка занимают часть бюджета
+        budget = max_tokens - current_tokens if heading_only else max_tokens
+        block_tokens = count_tokens(block)
+        if block_tokens > budget:
+            if kind == 'table':
+                parts = _split_table(block, budget, count_tokens)
+            else:
+                parts = _split_text(block, budget, count_tokens)
+        else:
+            parts = [block]
+
+        for part in parts:
+            part_tokens = block_tokens if len(parts) == 1 else count_tokens(part)
+            if current and not heading_only and current_tokens + part_tokens > max_tokens:
+                flush()
+            current.append(part)
+            current_tokens += part_tokens
+            heading_only = False
+
+    flush()
+    return chunks
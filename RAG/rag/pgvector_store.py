@@ -0,0 +1,515 @@
+from typing import Dict, List, Optional
+from contextlib import contextmanager
+import hashlib
+import io
+import json
+import math
+import threading
+import time
+import numpy as np
+
+# Метаданные, вынесенные в отдельные колонки (индексируются и фильтруются без jsonb)
+COLUMN_FIELDS = {"document": "document", "chunk_id": "chunk_id"}
+
+SCHEMA_SQL = """
+CREATE EXTENSION IF NOT EXISTS vector;
+CREATE TABLE IF NOT EXISTS rag_collections (
+    name TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL UNIQUE,
+    metadata JSONB NOT NULL DEFAULT '{}',
+    dim INTEGER
+);
+CREATE TABLE IF NOT EXISTS rag_aliases (
+    alias TEXT PRIMARY KEY,
+    physical TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rag_versions (
+    alias TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS rag_projections (
+    physical TEXT PRIMARY KEY,
+    data BYTEA NOT NULL
+);
+CREATE SEQUENCE IF NOT EXISTS rag_aliases_revision;
+"""
+
+
+def _vector_literal(vector) -> str:
+    return "[" + ",".join(repr(float(x)) for x in vector) + "]"
+
+
+def _parse_vector(text: str) -> List[float]:
+    return [float(x) for x in text.strip("[]").split(",")] if text and text != "[]" else []
+
+
+def _copy_escape(value) -> str:
+    """Экранирование значения для COPY в текстовом формате"""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class PgVectorCollection:
+    """Коллекция в Postgres/pgvector с подмножеством API коллекции ChromaDB, которым пользуется VectorStore"""
+
+    def __init__(self, client: "PgVectorClient", name: str, table_name: str, metadata: Dict, dim: Optional[int]):
+        self.client = client
+        self.name = name
+        self.table_name = table_name
+        self.metadata = metadata
+        self.dim = dim
+
+    # --- служебное ---
+
+    def _read_dim(self, cur):
+        cur.execute("SELECT dim FROM rag_collections WHERE name = %s", (self.name,))
+        row = cur.fetchone()
+        if row and row[0] is not None:
+            self.dim = row[0]
+
+    def _has_table(self) -> bool:
+        """Есть ли таблица коллекции
+
+        Хэндл, открытый до первой записи, видит dim = None; таблицу мог создать
+        другой поток или экземпляр RAG, поэтому пустая размерность перечитывается.
+        """
+        if self.dim is None:
+            with self.client.cursor() as cur:
+                self._read_dim(cur)
+        return self.dim is not None
+
+    def _ensure_table(self, cur, dim: int):
+        """Таблица создается при первой записи, когда известна размерность"""
+        if self.dim is None:
+            self._read_dim(cur)
+        if self.dim is not None:
+            if self.dim != dim:
+                raise ValueError(f"Размерность {dim} не совпадает с размерностью коллекции {self.dim}")
+            return
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table_name} (
+                seq BIGSERIAL,
+                id TEXT PRIMARY KEY,
+                document TEXT,
+                chunk_id INTEGER,
+                content TEXT,
+                metadata JSONB NOT NULL DEFAULT '{{}}',
+                embedding vector({dim}) NOT NULL
+            )
+        """)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_document ON {self.table_name} (document)")
+        if self.client.index_type == "hnsw":
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table_name}_embedding ON {self.table_name} "
+                f"USING hnsw (embedding {self._opclass}) WITH (m = %s, ef_construction = %s)",
+                (int(self.metadata.get("hnsw:M", 16)), int(self.metadata.get("hnsw:construction_ef", 100))),
+            )
+        cur.execute("UPDATE rag_collections SET dim = %s WHERE name = %s", (dim, self.name))
+        self.dim = dim
+
+    @property
+    def _space(self) -> str:
+        return self.metadata.get("hnsw:space", "l2")
+
+    @property
+    def _opclass(self) -> str:
+        return {"cosine": "vector_cosine_ops", "ip": "vector_ip_ops"}.get(self._space, "vector_l2_ops")
+
+    @property
+    def _distance_sql(self) -> str:
+        """Расстояние в той же шкале, что отдает Chroma: 1 - cos, 1 - dot, квадрат L2"""
+        if self._space == "cosine":
+            return "embedding <=> %s::vector"
+        if self._space == "ip":
+            return "1 + (embedding <#> %s::vector)"
+        return "power(embedding <-> %s::vector, 2)"
+
+    def _ensure_ivfflat(self, cur):
+        """IVFFlat строится по данным, поэтому создается при первом поиске по заполненной таблице"""
+        if self.client.index_type != "ivfflat" or self.table_name in self.client._indexed:
+            return
+        cur.execute(f"SELECT count(*) FROM {self.table_name}")
+        rows = cur.fetchone()[0]
+        if rows:
+            lists = self.client.ivfflat_lists or max(1, int(math.sqrt(rows)))
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table_name}_embedding ON {self.table_name} "
+                f"USING ivfflat (embedding {self._opclass}) WITH (lists = {int(lists)})"
+            )
+            self.client._indexed.add(self.table_name)
+
+    @staticmethod
+    def _split_metadata(metadata: Optional[Dict]) -> tuple:
+        metadata = dict(metadata or {})
+        chunk_id = metadata.get("chunk_id")
+        return metadata.get("document"), int(chunk_id) if chunk_id is not None else None, json.dumps(metadata, ensure_ascii=False)
+
+    def _where_sql(self, where: Optional[Dict], where_document: Optional[Dict] = None) -> tuple:
+        """Перевод фильтров Chroma ($eq, $ne, $in, $nin, $and, $or, $contains) в SQL"""
+        clauses, params = [], []
+
+        def field_sql(key: str) -> str:
+            if key in COLUMN_FIELDS:
+                return COLUMN_FIELDS[key] + ("::text" if key == "chunk_id" else "")
+            params.append(key)
+            return "metadata->>%s"
+
+        def build(condition: Dict) -> str:
+            parts = []
+            for key, value in condition.items():
+                if key in ("$and", "$or"):
+                    joiner = " AND " if key == "$and" else " OR "
+                    parts.append("(" + joiner.join(build(c) for c in value) + ")")
+                    continue
+                operator, operand = next(iter(value.items())) if isinstance(value, dict) else ("$eq", value)
+                column = field_sql(key)
+                if operator in ("$in", "$nin"):
+                    params.append([str(v) for v in operand])
+                    parts.append(f"{'NOT ' if operator == '$nin' else ''}{column} = ANY(%s)")
+                elif operator in ("$eq", "$ne"):
+                    params.append(str(operand))
+                    parts.append(f"{column} {'=' if operator == '$eq' else '<>'} %s")
+                else:
+                    raise ValueError(f"Неподдерживаемый оператор фильтра: {operator}")
+            return " AND ".join(parts) if parts else "TRUE"
+
+        if where:
+            clauses.append(build(where))
+        if where_document and "$contains" in where_document:
+            clauses.append("strpos(content, %s) > 0")
+            params.append(where_document["$contains"])
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    # --- API коллекции ---
+
+    def count(self) -> int:
+        if not self._has_table():
+            return 0
+        with self.client.cursor() as cur:
+            cur.execute(f"SELECT count(*) FROM {self.table_name}")
+            return cur.fetchone()[0]
+
+    def add(self, ids: List[str], embeddings, metadatas: List[Dict] = None, documents: List[str] = None):
+        """Пакетная вставка через COPY; как в Chroma, записи с уже существующими id пропускаются"""
+        if not ids:
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        metadatas = metadatas or [{}] * len(ids)
+        documents = documents or [None] * len(ids)
+        buffer = io.StringIO()
+        for doc_id, content, metadata, embedding in zip(ids, documents, metadatas, embeddings):
+            document, chunk_id, metadata_json = self._split_metadata(metadata)
+            buffer.write("\t".join(_copy_escape(v) for v in (
+                doc_id, document, chunk_id, content, metadata_json, _vector_literal(embedding)
+            )) + "\n")
+        buffer.seek(0)
+        with self.client.cursor() as cur:
+            self._ensure_table(cur, embeddings.shape[1])
+            # COPY не умеет ON CONFLICT: грузим во временную таблицу и переносим одним INSERT
+            columns = "id, document, chunk_id, content, metadata, embedding"
+            cur.execute(
+                f"CREATE TEMP TABLE rag_copy_staging ON COMMIT DROP AS "
+                f"SELECT {columns} FROM {self.table_name} WITH NO DATA"
+            )
+            cur.copy_expert(f"COPY rag_copy_staging ({columns}) FROM STDIN", buffer)
+            cur.execute(
+                f"INSERT INTO {self.table_name} ({columns}) SELECT {columns} FROM rag_copy_staging "
+                "ON CONFLICT (id) DO NOTHING"
+            )
+
+    def upsert(self, ids: List[str], embeddings, metadatas: List[Dict] = None, documents: List[str] = None):
+        if not ids:
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        metadatas = metadatas or [{}] * len(ids)
+        documents = documents or [None] * len(ids)
+        rows = []
+        for doc_id, content, metadata, embedding in zip(ids, documents, metadatas, embeddings):
+            document, chunk_id, metadata_json = self._split_metadata(metadata)
+            rows.append((doc_id, document, chunk_id, content, metadata_json, _vector_literal(embedding)))
+        with self.client.cursor() as cur:
+            self._ensure_table(cur, embeddings.shape[1])
+            cur.executemany(
+                f"""INSERT INTO {self.table_name} (id, document, chunk_id, content, metadata, embedding)
+                    VALUES (%s, %s, %s, %s, %s, %s::vector)
+                    ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document, chunk_id = EXCLUDED.chunk_id,
+                        content = EXCLUDED.content, metadata = EXCLUDED.metadata, embedding = EXCLUDED.embedding""",
+                rows,
+            )
+
+    def update(self, ids: List[str], metadatas: List[Dict]):
+        if not ids or not self._has_table():
+            return
+        rows = []
+        for doc_id, metadata in zip(ids, metadatas):
+            document, chunk_id, metadata_json = self._split_metadata(metadata)
+            rows.append((document, chunk_id, metadata_json, doc_id))
+        with self.client.cursor() as cur:
+            cur.executemany(
+                f"UPDATE {self.table_name} SET document = %s, chunk_id = %s, metadata = %s WHERE id = %s", rows
+            )
+
+    def delete(self, ids: List[str] = None, where: Optional[Dict] = None):
+        if not self._has_table():
+            return
+        with self.client.cursor() as cur:
+            if ids is not None:
+                cur.execute(f"DELETE FROM {self.table_name} WHERE id = ANY(%s)", (list(ids),))
+            else:
+                where_sql, params = self._where_sql(where)
+                cur.execute(f"DELETE FROM {self.table_name}{where_sql}", params)
+
+    def get(self, ids: List[str] = None, where: Optional[Dict] = None, offset: int = None, limit: int = None,
+            include: List[str] = None) -> Dict:
+        include = ["documents", "metadatas"] if include is None else include
+        result = {"ids": [], "documents": None, "metadatas": None, "embeddings": None}
+        for key in ("documents", "metadatas", "embeddings"):
+            if key in include:
+                result[key] = []
+        if not self._has_table():
+            return result
+
+        where_sql, params = self._where_sql(where)
+        if ids is not None:
+            where_sql += (" AND " if where_sql else " WHERE ") + "id = ANY(%s)"
+            params.append(list(ids))
+        sql = f"SELECT id, content, metadata, embedding::text FROM {self.table_name}{where_sql} ORDER BY seq"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        if offset:
+            sql += f" OFFSET {int(offset)}"
+        with self.client.cursor() as cur:
+            cur.execute(sql, params)
+            for doc_id, content, metadata, embedding in cur.fetchall():
+                result["ids"].append(doc_id)
+                if result["documents"] is not None:
+                    result["documents"].append(content)
+                if result["metadatas"] is not None:
+                    result["metadatas"].append(metadata)
+                if result["embeddings"] is not None:
+                    result["embeddings"].append(_parse_vector(embedding))
+        return result
+
+    def query(self, query_embeddings: List[List[float]], n_results: int = 10, where: Optional[Dict] = None,
+              where_document: Optional[Dict] = None, include: List[str] = None) -> Dict:
+        include = include or ["documents", "metadatas", "distances"]
+        result = {key: [] for key in ("ids", "documents", "metadatas", "distances")}
+        with_embeddings = "embeddings" in include
+        if with_embeddings:
+            result["embeddings"] = []
+        if not self._has_table():
+            for _ in query_embeddings:
+                for key in result:
+                    result[key].append([])
+            return result
+
+        where_sql, where_params = self._where_sql(where, where_document)
+        sql = (
+            f"SELECT id, content, metadata, {self._distance_sql} AS distance"
+            f"{', embedding::text' if with_embeddings else ''} FROM {self.table_name}{where_sql} "
+            f"ORDER BY embedding {self._order_operator} %s::vector LIMIT %s"
+        )
+        with self.client.cursor() as cur:
+            self._ensure_ivfflat(cur)
+            if self.client.index_type == "hnsw":
+                cur.execute("SET LOCAL hnsw.ef_search = %s", (int(self.metadata.get("hnsw:search_ef", 40)),))
+            else:
+                cur.execute("SET LOCAL ivfflat.probes = %s", (self.client.ivfflat_probes,))
+            for embedding in query_embeddings:
+                literal = _vector_literal(embedding)
+                cur.execute(sql, [literal] + where_params + [literal, int(n_results)])
+                rows = cur.fetchall()
+                result["ids"].append([r[0] for r in rows])
+                result["documents"].append([r[1] for r in rows])
+                result["metadatas"].append([r[2] for r in rows])
+                result["distances"].append([float(r[3]) for r in rows])
+                if with_embeddings:
+                    result["embeddings"].append([_parse_vector(r[4]) for r in rows])
+        return result
+
+    @property
+    def _order_operator(self) -> str:
+        """Оператор сортировки должен совпадать с классом индекса, иначе индекс не используется"""
+        return {"cosine": "<=>", "ip": "<#>"}.get(self._space, "<->")
+
+
+class PgVectorClient:
+    """Клиент pgvector с подмножеством API PersistentClient ChromaDB
+
+    Кроме коллекций в Postgres хранятся алиасы, версии и проекции, поэтому
+    несколько экземпляров RAG видят один согласованный индекс.
+    """
+
+    def __init__(self, dsn: str, index_type: str = "hnsw", ivfflat_lists: int = 0, ivfflat_probes: int = 10,
+                 max_connections: int = 8):
+        from psycopg2.pool import ThreadedConnectionPool
+
+        if index_type not in ("hnsw", "ivfflat"):
+            raise ValueError(f"Неизвестный тип индекса pgvector: {index_type}")
+        self.index_type = index_type
+        self.ivfflat_lists = ivfflat_lists
+        self.ivfflat_probes = ivfflat_probes
+        self._pool = ThreadedConnectionPool(1, max_connections, dsn)
+        self._indexed = set()
+        self._aliases_cache = None
+        self._aliases_checked_at = 0.0
+        self._lock = threading.Lock()
+        with self.cursor() as cur:
+            # Параллельный старт нескольких экземпляров: схему создает один
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('rag_schema'))")
+            cur.execute(SCHEMA_SQL)
+
+    @contextmanager
+    def cursor(self):
+        """Курсор в отдельной транзакции: commit при успехе, rollback при ошибке"""
+        conn = self._pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.putconn(conn)
+
+    # --- коллекции ---
+
+    @staticmethod
+    def _table_name(name: str) -> str:
+        # Имена физических коллекций длиннее лимита идентификаторов Postgres (63)
+        return "rag_c_" + hashlib.md5(name.encode("utf-8")).hexdigest()[:20]
+
+    def _load(self, name: str) -> Optional[PgVectorCollection]:
+        with self.cursor() as cur:
+            cur.execute("SELECT table_name, metadata, dim FROM rag_collections WHERE name = %s", (name,))
+            row = cur.fetchone()
+        return PgVectorCollection(self, name, row[0], row[1], row[2]) if row else None
+
+    def create_collection(self, name: str, metadata: Dict = None) -> PgVectorCollection:
+        with self.cursor() as cur:
+            cur.execute(
+                "INSERT INTO rag_collections (name, table_name, metadata) VALUES (%s, %s, %s)",
+                (name, self._table_name(name), json.dumps(metadata or {})),
+            )
+        return PgVectorCollection(self, name, self._table_name(name), metadata or {}, None)
+
+    def get_or_create_collection(self, name: str, metadata: Dict = None) -> PgVectorCollection:
+        collection = self._load(name)
+        if collection is not None:
+            return collection
+        with self.cursor() as cur:
+            cur.execute(
+                "INSERT INTO rag_collections (name, table_name, metadata) VALUES (%s, %s, %s) "
+                "ON CONFLICT (name) DO NOTHING",
+                (name, self._table_name(name), json.dumps(metadata or {})),
+            )
+        return self._load(name)
+
+    def get_collection(self, name: str) -> PgVectorCollection:
+        collection = self._load(name)
+        if collection is None:
+            raise ValueError(f"Коллекция {name} не существует")
+        return collection
+
+    def delete_collection(self, name: str):
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM rag_collections WHERE name = %s RETURNING table_name", (name,))
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError(f"Коллекция {name} не существует")
+            cur.execute(f"DROP TABLE IF EXISTS {row[0]}")
+        self._indexed.discard(row[0])
+
+    def list_collections(self) -> List[PgVectorCollection]:
+        with self.cursor() as cur:
+            cur.execute("SELECT name, table_name, metadata, dim FROM rag_collections ORDER BY name")
+            rows = cur.fetchall()
+        return [PgVectorCollection(self, *row) for row in rows]
+
+    # --- алиасы, версии и проекции вместо файлов рядом с ChromaDB ---
+
+    def read_aliases(self) -> Dict[str, str]:
+        with self.cursor() as cur:
+            cur.execute("SELECT alias, physical FROM rag_aliases")
+            return dict(cur.fetchall())
+
+    def write_aliases(self, aliases: Dict[str, str]):
+        """Заменяет таблицу алиасов целиком в одной транзакции"""
+        with self.cursor() as cur:
+            cur.execute("LOCK TABLE rag_aliases IN EXCLUSIVE MODE")
+            cur.execute("DELETE FROM rag_aliases")
+            if aliases:
+                cur.executemany("INSERT INTO rag_aliases (alias, physical) VALUES (%s, %s)", list(aliases.items()))
+            cur.execute("SELECT nextval('rag_aliases_revision')")
+
+    def aliases_revision(self, max_age: float = 1.0) -> int:
+        """Номер ревизии алиасов; запрашивается не чаще раза в max_age секунд"""
+        with self._lock:
+            if self._aliases_cache is not None and time.monotonic() - self._aliases_checked_at < max_age:
+                return self._aliases_cache
+        with self.cursor() as cur:
+            cur.execute("SELECT last_value FROM rag_aliases_revision")
+            revision = cur.fetchone()[0]
+        with self._lock:
+            self._aliases_cache = revision
+            self._aliases_checked_at = time.monotonic()
+        return revision
+
+    def get_version(self, alias: str) -> int:
+        with self.cursor() as cur:
+            cur.execute("SELECT version FROM rag_versions WHERE alias = %s", (alias,))
+            row = cur.fetchone()
+        return int(row[0]) if row else 0
+
+    def bump_version(self, alias: str):
+        with self.cursor() as cur:
+            cur.execute(
+                "INSERT INTO rag_versions (alias, version) VALUES (%s, 1) "
+                "ON CONFLICT (alias) DO UPDATE SET version = rag_versions.version + 1",
+                (alias,),
+            )
+
+    @contextmanager
+    def advisory_lock(self, key: str):
+        """Сессионная advisory-блокировка на отдельном соединении (снимается и при обрыве соединения)"""
+        conn = self._pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (key,))
+            try:
+                yield
+            finally:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (key,))
+        finally:
+            conn.autocommit = False
+            self._pool.putconn(conn)
+
+    def load_projection(self, physical: str) -> Optional[bytes]:
+        with self.cursor() as cur:
+            cur.execute("SELECT data FROM rag_projections WHERE physical = %s", (physical,))
+            row = cur.fetchone()
+        return bytes(row[0]) if row else None
+
+    def save_projection(self, physical: str, data: bytes):
+        from psycopg2 import Binary
+
+        with self.cursor() as cur:
+            cur.execute(
+                "INSERT INTO rag_projections (physical, data) VALUES (%s, %s) "
+                "ON CONFLICT (physical) DO UPDATE SET data = EXCLUDED.data",
+                (physical, Binary(data)),
+            )
+
+    def delete_projection(self, physical: str):
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM rag_projections WHERE physical = %s", (physical,))
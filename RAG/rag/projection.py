@@ -0,0 +1,77 @@
+from typing import Optional
+from pathlib import Path
+import io
+import numpy as np
+
+
+class Projection:
+    """Понижение размерности эмбеддингов: PCA по корпусу или усечение (Matryoshka)
+
+    Матрица хранится рядом с физической коллекцией, поэтому запросы всегда
+    проецируются тем же преобразованием, которым строился индекс.
+    """
+
+    def __init__(self, kind: str, dim: int, mean: np.ndarray = None, components: np.ndarray = None):
+        self.kind = kind
+        self.dim = dim
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def fit(cls, kind: str, dim: int, embeddings: np.ndarray) -> Optional["Projection"]:
+        """Строит проекцию по эмбеддингам корпуса; None, если понижать нечего"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if not kind or dim <= 0 or dim >= embeddings.shape[1]:
+            return None
+        if kind == "truncate":
+            return cls(kind, dim)
+        if kind == "pca":
+            if embeddings.shape[0] < dim:
+                print(f"PCA: чанков ({embeddings.shape[0]}) меньше размерности {dim}, проекция не применяется")
+                return None
+            mean = embeddings.mean(axis=0)
+            # Главные компоненты через SVD центрированной матрицы
+            _, _, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+            return cls(kind, dim, mean=mean, components=vt[:dim].astype(np.float32))
+        raise ValueError(f"Неизвестный тип проекции: {kind}")
+
+    def apply(self, embeddings: np.ndarray) -> np.ndarray:
+        """Проецирует векторы и заново нормализует их"""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        if self.kind == "truncate":
+            projected = embeddings[:, :self.dim]
+        else:
+            projected = (embeddings - self.mean) @ self.components.T
+        norms = np.linalg.norm(projected, axis=1, keepdims=True) + 1e-8
+        return (projected / norms).astype(np.float32)
+
+    def to_bytes(self) -> bytes:
+        arrays = {"kind": np.array(self.kind), "dim": np.array(self.dim)}
+        if self.kind == "pca":
+            arrays.update(mean=self.mean, components=self.components)
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["Projection"]:
+        if not path.exists():
+            return None
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Projection":
+        data = np.load(io.BytesIO(data))
+        kind = str(data["kind"])
+        return cls(
+            kind,
+            int(data["dim"]),
+            mean=data["mean"] if kind == "pca" else None,
+            components=data["components"] if kind == "pca" else None,
+        )
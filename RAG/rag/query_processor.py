@@ -1,8 +1,11 @@
 from typing import List, Dict
+import numpy as np
 from RAG.rag.embedding_service import EmbeddingService
 from RAG.rag.vector_store import VectorStore
 from RAG.rag.reranker import Reranker
 from RAG.rag.config import RetrievalConfig
+from RAG.rag.retrieval_cache import get_retrieval_cache
+from RAG.rag.dedup import sources_filter
 
 
 class QueryProcessor:
@@ -22,6 +25,9 @@ class QueryProcessor:
             from RAG.rag.config import DEFAULT_CONFIG
             config = DEFAULT_CONFIG.retrieval
         self.config = config
+        self.result_cache = None
+        if config.use_result_cache:
+            self.result_cache = get_retrieval_cache(config.result_cache_bits, config.result_cache_size)
     
     def generate_query_variations(self, query: str, max_variations: int = 3) -> List[str]:
         """Генерирует варианты запроса для multi-query подхода"""
@@ -50,40 +56,78 @@ class QueryProcessor:
         
         return unique_variations[:max_variations]
     
-    def multi_query_search(self, query: str, n_results: int = None) -> List[Dict]:
-        """Multi-query поиск: объединяет результаты от разных вариантов запроса"""
+    def multi_query_search(self, query: str, n_results: int = None, query_embedding=None) -> List[Dict]:
+        """Multi-query поиск: объединяет результаты от разных вариантов запроса
+
+        query_embedding - уже посчитанный эмбеддинг исходного запроса (не кодируется повторно).
+        """
         if n_results is None:
             n_results = self.config.n_results
         
         if not self.config.use_multi_query:
-            query_embedding = self.embedding_service.encode_query(query)
+            if query_embedding is None:
+                query_embedding = self.embedding_service.encode_query(query)
+            query_embeddings = [np.asarray(query_embedding).tolist()]
             results = self.vector_store.search(
-                query_embeddings=[query_embedding.tolist()],
-                n_results=n_results
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                where=self._document_filter(query_embeddings)
             )
             return self._format_search_results(results)
         
-        # Multi-query поиск
+        # Multi-query поиск: все варианты кодируются одним батчем и ищутся одним запросом
         query_variations = self.generate_query_variations(query)
+        if not query_variations:
+            return []
+        if query_embedding is not None and query_variations[0] == query:
+            # Первый вариант - сам запрос, его эмбеддинг уже есть
+            rest = query_variations[1:]
+            query_embeddings = [np.asarray(query_embedding).tolist()]
+            if rest:
+                query_embeddings += self.embedding_service.encode(rest).tolist()
+        else:
+            query_embeddings = self.embedding_service.encode(query_variations).tolist()
+        var_results = self.vector_store.search(
+            query_embeddings=query_embeddings,
+            n_results=n_results * 2,  # Берем больше для объединения
+            where=self._document_filter(query_embeddings)
+        )
+        return self._merge_variation_results(query, query_variations, var_results, 0, n_results)
+    
+    def _document_filter(self, query_embeddings: List[List[float]]) -> Dict:
+        """Фильтр по документам, выбранным по центроидам (None - искать по всем)"""
+        if self.config.hierarchical_top_m <= 0:
+            return None
+        documents = self.vector_store.select_documents(query_embeddings, self.config.hierarchical_top_m)
+        if not documents:
+            return None
+        # Схлопнутый дубликат хранится под одним документом, но принадлежит всем своим источникам
+        return sources_filter(documents)
+    
+    def _merge_variation_results(
+        self,
+        query: str,
+        query_variations: List[str],
+        var_results: Dict,
+        offset: int,
+        n_results: int
+    ) -> List[Dict]:
+        """Объединяет результаты вариантов запроса (строки offset.. в ответе multi-vector поиска)"""
         all_results = []
         seen_docs = set()
         
-        # Ищем по каждому варианту запроса
-        for variation in query_variations:
-            query_embedding = self.embedding_service.encode_query(variation)
-            var_results = self.vector_store.search(
-                query_embeddings=[query_embedding.tolist()],
-                n_results=n_results * 2  # Берем больше для объединения
-            )
-            
-            # Добавляем результаты, избегая дубликатов
-            for i, doc in enumerate(var_results["documents"][0]):
+        # Добавляем результаты по каждому варианту запроса, избегая дубликатов
+        for j, variation in enumerate(query_variations):
+            row = offset + j
+            for i, doc in enumerate(var_results["documents"][row]):
                 doc_hash = hash(doc[:100])
                 if doc_hash not in seen_docs:
                     all_results.append({
+                        "id": var_results["ids"][row][i],
                         "document": doc,
-                        "metadata": var_results["metadatas"][0][i],
-                        "distance": var_results["distances"][0][i],
+                        "metadata": var_results["metadatas"][row][i],
+                        "distance": var_results["distances"][row][i],
+                        "embedding": self._result_embedding(var_results, row, i),
                         "query_variation": variation,
                     })
                     seen_docs.add(doc_hash)
@@ -105,39 +149,140 @@ class QueryProcessor:
                 orig_result = all_results[rerank_result["rank"]]
                 orig_result["similarity"] = rerank_result["similarity"]
                 orig_result["reranked"] = True
-            all_results.sort(key=lambda x: x.get("similarity", 1.0 / (1.0 + x["distance"])), reverse=True)
+            all_results.sort(key=lambda x: x.get("similarity", self.vector_store.distance_to_similarity(x["distance"])), reverse=True)
         else:
             all_results.sort(key=lambda x: x["distance"])
 
         return all_results[:n_results]
     
-    def _format_search_results(self, results: Dict) -> List[Dict]:
+    def _format_search_results(self, results: Dict, row: int = 0) -> List[Dict]:
         """Форматирует результаты поиска"""
         formatted = []
         for i, (doc, metadata, distance) in enumerate(zip(
-            results["documents"][0],
-            results["metadatas"][0],
-            results["distances"][0]
+            results["documents"][row],
+            results["metadatas"][row],
+            results["distances"][row]
         )):
-            similarity = 1.0 / (1.0 + distance)
+            similarity = self.vector_store.distance_to_similarity(distance)
             formatted.append({
+                "id": results["ids"][row][i],
                 "document": doc,
                 "metadata": metadata,
                 "distance": distance,
                 "similarity": similarity,
+                "embedding": self._result_embedding(results, row, i),
             })
         return formatted
+
+    @staticmethod
+    def _result_embedding(results: Dict, row: int, i: int):
+        """Вектор найденного чанка (None, если хранилище его не вернуло)"""
+        embeddings = results.get("embeddings")
+        return embeddings[row][i] if embeddings else None
     
-    def search(self, query: str, n_results: int = None, use_reranking: bool = None) -> List[Dict]:
-        """Основной метод поиска"""
+    def search(self, query: str, n_results: int = None, use_reranking: bool = None,
+               query_embedding=None) -> List[Dict]:
+        """Основной метод поиска
+
+        query_embedding - эмбеддинг запроса, если он уже посчитан (маршрутизатором интентов или для FAQ).
+        """
         if n_results is None:
             n_results = self.config.n_results
         if use_reranking is None:
             use_reranking = self.config.use_reranking
         
+        cache_key = None
+        if self.result_cache is not None:
+            if query_embedding is None:
+                query_embedding = self.embedding_service.encode_query(query)
+            cache_key = (
+                self.vector_store.collection_name,
+                self.vector_store.get_version(),
+                self.result_cache.signature(query_embedding),
+                n_results,
+                use_reranking,
+            )
+            cached = self._load_cached_results(cache_key)
+            if cached is not None:
+                return cached
+        
         # Multi-query поиск
-        results = self.multi_query_search(query, n_results * 2 if use_reranking else n_results)
+        results = self.multi_query_search(query, n_results * 2 if use_reranking else n_results, query_embedding)
+        results = self._finalize_results(query, results, n_results, use_reranking)
+        
+        if cache_key is not None:
+            # Храним только id и оценки, тексты подтягиваются из коллекции при попадании
+            self.result_cache.put(cache_key, [
+                {k: r[k] for k in ("id", "distance", "similarity", "reranked") if k in r}
+                for r in results
+            ])
+        return results
+    
+    def _load_cached_results(self, cache_key) -> List[Dict]:
+        """Восстанавливает результаты из кэша по сохраненным id чанков"""
+        entries = self.result_cache.get(cache_key)
+        if entries is None:
+            return None
+        chunks = self.vector_store.get_by_ids([e["id"] for e in entries])
+        if len(chunks) != len(entries):
+            return None
+        return [{**entry, **chunks[entry["id"]], "cached": True} for entry in entries]
+    
+    def search_batch(self, queries: List[str], n_results: int = None, use_reranking: bool = None) -> List[List[Dict]]:
+        """Пакетный поиск: одно батч-кодирование и один multi-vector запрос на все вопросы"""
+        if n_results is None:
+            n_results = self.config.n_results
+        if use_reranking is None:
+            use_reranking = self.config.use_reranking
+        if not queries:
+            return []
         
+        candidates_n = n_results * 2 if use_reranking else n_results
+        if self.config.use_multi_query:
+            variations = [self.generate_query_variations(q) for q in queries]
+        else:
+            variations = [[q] for q in queries]
+        flat = [v for query_variations in variations for v in query_variations]
+        if not flat:
+            return [[] for _ in queries]
+        
+        embeddings = self.embedding_service.encode(flat).tolist()
+        search_n = candidates_n * 2 if self.config.use_multi_query else candidates_n
+        # Если документов не больше top_m, фильтр не нужен и хватает одного multi-vector запроса
+        hierarchical = (
+            self.config.hierarchical_top_m > 0
+            and self.vector_store.centroids.count() > self.config.hierarchical_top_m
+        )
+        if not hierarchical:
+            raw = self.vector_store.search(query_embeddings=embeddings, n_results=search_n)
+        
+        all_results = []
+        offset = 0
+        for query, query_variations in zip(queries, variations):
+            if not query_variations:
+                all_results.append([])
+                continue
+            rows = embeddings[offset:offset + len(query_variations)]
+            if hierarchical:
+                # У каждого вопроса свой набор документов, поэтому поиск отдельный
+                query_raw = self.vector_store.search(
+                    query_embeddings=rows,
+                    n_results=search_n,
+                    where=self._document_filter(rows)
+                )
+                row = 0
+            else:
+                query_raw, row = raw, offset
+            if self.config.use_multi_query:
+                results = self._merge_variation_results(query, query_variations, query_raw, row, candidates_n)
+            else:
+                results = self._format_search_results(query_raw, row=row)
+            offset += len(query_variations)
+            all_results.append(self._finalize_results(query, results, n_results, use_reranking))
+        return all_results
+    
+    def _finalize_results(self, query: str, results: List[Dict], n_results: int, use_reranking: bool) -> List[Dict]:
+        """Дополнительный re-ranking и фильтрация по порогу релевантности"""
         # Дополнительный re-ranking если включен
         if use_reranking and self.reranker and len(results) > 1:
             documents = [r["document"] for r in results]
@@ -157,14 +302,14 @@ class QueryProcessor:
                     result["reranked"] = True
             
             # Пересортируем
-            results.sort(key=lambda x: x.get("similarity", 1.0 / (1.0 + x["distance"])), reverse=True)
+            results.sort(key=lambda x: x.get("similarity", self.vector_store.distance_to_similarity(x["distance"])), reverse=True)
         
         # Фильтрация по порогу релевантности
         filtered_results = []
         for result in results:
-            similarity = result.get("similarity", 1.0 / (1.0 + result["distance"]))
-            if similarity >= self.config.min_similarity_threshold:
+            similarity = result.get("similarity", self.vector_store.distance_to_similarity(result["distance"]))
+            space = "cosine" if result.get("reranked") else self.vector_store.distance_space
+            if similarity >= self.config.similarity_threshold(space):
                 filtered_results.append(result)
         
         return filtered_results[:n_results]
-
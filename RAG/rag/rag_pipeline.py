@@ -1,27 +1,57 @@
-from typing import Dict
+from typing import Dict, List, Optional
+from pathlib import Path
 import os
 from RAG.rag.config import RAGConfig, DEFAULT_CONFIG
 from RAG.rag.document_processor import document_to_markdown, split_document
-from RAG.rag.embedding_service import EmbeddingService
-from RAG.rag.vector_store import VectorStore
+from RAG.rag.embedding_service import EmbeddingService, CollectionEmbeddings
+from RAG.rag.vector_store import VectorStore, DEFAULT_COLLECTION
 from RAG.rag.query_processor import QueryProcessor
 from RAG.rag.reranker import Reranker
+from RAG.rag.dedup import collapse_near_duplicates, public_metadata
+from RAG.rag.faq_index import FAQIndex
+from RAG.rag.intent_router import IntentRouter
+from RAG.rag.table_index import TableIndex
+from RAG.rag.context_builder import ContextBuilder
 
 
 class RAGPipeline:
     """Главный класс RAG пайплайна"""
     
-    def __init__(self, config: RAGConfig = None):
+    def __init__(
+        self,
+        config: RAGConfig = None,
+        collection_name: str = DEFAULT_COLLECTION,
+        embedding_service: EmbeddingService = None,
+        client=None
+    ):
+        """
+        Args:
+            config: Конфигурация RAG
+            collection_name: Коллекция (тенант), с которой работает пайплайн
+            embedding_service: Общий сервис эмбеддингов, чтобы тенанты не дублировали модель
+            client: Общий клиент ChromaDB
+        """
         if config is None:
             config = DEFAULT_CONFIG
         
         self.config = config
-        self.embedding_service = EmbeddingService(config.embedding)
+        self.embedding_service = embedding_service or EmbeddingService(config.embedding)
 
         # Используем переменную окружения или путь по умолчанию
         db_path = os.getenv('CHROMA_DB_PATH', '/app/data/chroma_db')
         
-        self.vector_store = VectorStore(db_path=db_path, config=config.retrieval)
+        self.vector_store = VectorStore(
+            db_path=db_path,
+            collection_name=collection_name,
+            config=config.retrieval,
+            client=client,
+            embedding_config=config.embedding
+        )
+        # Запросы кодируются моделью текущей коллекции (она меняется после миграции эмбеддингов)
+        self.embedding_service = CollectionEmbeddings(self.vector_store, self.embedding_service)
+        if config.snapshot.role == "replica":
+            # Запросы в полете дочитывают старую коллекцию после подмены снапшота
+            self.vector_store.drop_grace_seconds = config.snapshot.swap_grace_seconds
         self.reranker = Reranker(self.embedding_service) if config.retrieval.use_reranking else None
         self.query_processor = QueryProcessor(
             self.embedding_service,
@@ -29,6 +59,19 @@ class RAGPipeline:
             self.reranker,
             config.retrieval
         )
+        self.context_builder = ContextBuilder(
+            self.embedding_service, config.context, config.chunking.tokenizer_name
+        )
+        # У каждого тенанта свой FAQ; у коллекции по умолчанию - прежний faq.json
+        faq_path = None
+        if collection_name != DEFAULT_COLLECTION and not config.faq.path:
+            faq_path = str(Path(self.vector_store.db_path) / f"faq_{collection_name}.json")
+        self.faq_index = FAQIndex(self.embedding_service, config.faq, path=faq_path)
+        self.intent_router = IntentRouter(self.embedding_service, config.intents)
+        tables_path = None
+        if collection_name != DEFAULT_COLLECTION and not config.tables.path:
+            tables_path = str(Path(self.vector_store.db_path) / f"tables_{collection_name}.sqlite")
+        self.table_index = TableIndex(config.tables, path=tables_path)
     
     def ingest_document(self, document_path: str, replace_all: bool = True) -> int:
         """Загружает документ в векторную БД с оптимизацией памяти
@@ -42,6 +85,10 @@ class RAGPipeline:
         # 1. Конвертация в текст
         document = document_to_markdown(document_path)
         
+        # Таблицы (прайсы, расписания) дополнительно индексируются построчно; индекс меняется
+        # только после публикации векторов, чтобы ошибка загрузки не оставила его без таблиц
+        tables = self.table_index.extract(document["content"]) if self.config.tables.enabled else None
+        
         # 2. Разбиение на чанки с метаданными
         chunks = split_document(document, self.config.chunking)
         print(f"Документ разбит на {len(chunks)} чанков")
@@ -50,17 +97,31 @@ class RAGPipeline:
         del document
         gc.collect()
         
+        # Схлопывание почти-дубликатов до эмбеддинга: внутри документа и с уже загруженными
+        if self.config.dedup.enabled:
+            find_candidates = None if replace_all else self.vector_store.find_near_duplicate_candidates
+            chunks, attach = collapse_near_duplicates(chunks, self.config.dedup, find_candidates)
+            if not chunks:
+                self.vector_store.add_chunk_sources(attach)
+                self._index_tables(document_path, tables, replace_all)
+                return self.vector_store.get_collection_stats()["count"]
+        else:
+            attach = {}
+        
         # 3. Создание эмбеддингов (уже оптимизировано в encode_batch)
         documents_text = [chunk["content"] for chunk in chunks]
         embeddings = self.embedding_service.encode_batch(documents_text)
         print(f"Создано {len(embeddings)} эмбеддингов")
         
-        # 4. Загрузка в векторную БД
-        if replace_all:
-            count = self.vector_store.upload_documents(documents_text, embeddings, chunks, replace_all=True)
-        else:
-            count = self.vector_store.add_documents(documents_text, embeddings, chunks)
+        # 4. Загрузка в векторную БД: привязка дубликатов и новые чанки одним изменением для снапшотов
+        with self.vector_store.write_lock():
+            self.vector_store.add_chunk_sources(attach)
+            if replace_all:
+                count = self.vector_store.upload_documents(documents_text, embeddings, chunks, replace_all=True)
+            else:
+                count = self.vector_store.add_documents(documents_text, embeddings, chunks)
         print(f"Загружено {count} документов в векторную БД")
+        self._index_tables(document_path, tables, replace_all)
         
         # Финальная очистка памяти
         del documents_text, embeddings
@@ -68,9 +129,12 @@ class RAGPipeline:
         
         return count
     
+    def _index_tables(self, document_path: str, tables: Optional[List[Dict]], replace_all: bool):
+        if tables is not None:
+            self.table_index.index_tables(Path(document_path).name, tables, replace_all=replace_all)
+    
     def update_document(self, document_path: str) -> int:
         """Обновляет документ: удаляет старый и добавляет новый"""
-        from pathlib import Path
         doc_name = Path(document_path).name
         
         # Удаляем старый документ
@@ -82,6 +146,7 @@ class RAGPipeline:
     
     def delete_document(self, document_name: str) -> int:
         """Удаляет документ по имени"""
+        self.table_index.delete_document(document_name)
         return self.vector_store.delete_document_by_name(document_name)
     
     def list_documents(self):
@@ -92,21 +157,73 @@ class RAGPipeline:
         self, 
         question: str, 
         n_results: int = None,
-        return_full_context: bool = True
+        return_full_context: bool = True,
+        query_embedding=None
     ) -> Dict:
-        """Выполняет запрос к RAG системе"""
+        """Выполняет запрос к RAG системе
+
+        query_embedding - уже посчитанный эмбеддинг вопроса, чтобы поиск не кодировал его повторно.
+        """
         if n_results is None:
             n_results = self.config.retrieval.n_results
         
+        table_match = self._match_tables(question)
+        if self._is_direct_table_match(table_match):
+            # Строки таблицы совпали значениями ячеек в нескольких колонках: точный ответ без векторного поиска
+            return self._build_result(question, [], return_full_context, table_match)
+        
         # Поиск релевантных чанков
-        results = self.query_processor.search(question, n_results=n_results)
+        results = self.query_processor.search(question, n_results=n_results, query_embedding=query_embedding)
+        return self._build_result(question, results, return_full_context, table_match)
+    
+    def query_batch(
+        self,
+        questions: List[str],
+        n_results: int = None,
+        return_full_context: bool = True
+    ) -> List[Dict]:
+        """Выполняет пакет запросов одним батч-кодированием и одним поиском"""
+        if n_results is None:
+            n_results = self.config.retrieval.n_results
         
+        batch_results = self.query_processor.search_batch(questions, n_results=n_results)
+        return [
+            self._build_result(question, results, return_full_context, self._match_tables(question))
+            for question, results in zip(questions, batch_results)
+        ]
+    
+    def _match_tables(self, question: str) -> Optional[Dict]:
+        return self.table_index.lookup(question) if self.config.tables.enabled else None
+    
+    def _is_direct_table_match(self, table_match: Optional[Dict]) -> bool:
+        """Достаточно ли совпадения таблицы для ответа без векторного поиска (считаются только ячейки целиком)"""
+        direct_min_columns = self.config.tables.direct_min_columns
+        return bool(table_match) and bool(direct_min_columns) and table_match["matched_columns"] >= direct_min_columns
+    
+    def _build_result(
+        self,
+        question: str,
+        results: List[Dict],
+        return_full_context: bool,
+        table_match: Optional[Dict] = None
+    ) -> Dict:
+        """Формирует ответ пайплайна из найденных чанков и строк таблиц"""
+        if table_match:
+            result = self._build_result(question, results, return_full_context)
+            table_context = self.table_index.format_context(table_match)
+            result["table_rows"] = table_match["tables"]
+            # Только точное совпадение отвечает само по себе; частичное лишь дополняет найденные чанки
+            result["table_direct"] = self._is_direct_table_match(table_match)
+            result["answer"] = f"{table_context}\n\n{result['answer']}" if results else table_context
+            return result
+
         if not results:
             return {
                 "question": question,
                 "answer": "К сожалению, не найдено релевантной информации.",
                 "sources": [],
-                "similarity_scores": []
+                "similarity_scores": [],
+                "avg_similarity": 0.0
             }
         
         # Форматирование результатов
@@ -114,18 +231,17 @@ class RAGPipeline:
         similarities = []
         
         for i, result in enumerate(results):
-            similarity = result.get("similarity", 1.0 / (1.0 + result["distance"]))
+            similarity = result.get("similarity", self.vector_store.distance_to_similarity(result["distance"]))
             sources.append({
                 "content": result["document"],
-                "metadata": result.get("metadata", {}),
+                "metadata": public_metadata(result.get("metadata")),
                 "similarity": similarity,
                 "rank": i + 1
             })
             similarities.append(similarity)
 
         if return_full_context and len(sources) > 0:
-            context_parts = [src["content"] for src in sources[:3]]
-            answer = "\n\n".join(context_parts)
+            answer = self.context_builder.build(sources, [result.get("embedding") for result in results])
         else:
             answer = sources[0]["content"] if sources else ""
         
@@ -0,0 +1,336 @@
+from typing import Dict, Optional
+from datetime import datetime, timezone
+from pathlib import Path
+import fcntl
+import json
+import os
+import threading
+import time
+import numpy as np
+from RAG.rag.config import ReembedConfig
+from RAG.rag.embedding_service import EmbeddingService, get_embedding_service_for
+
+CHECKPOINT_PREFIX = "reembed_"
+# Пока миграция в этих состояниях, она ссылается на физические коллекции алиаса
+ALIAS_LOCKED_STATUSES = ("running", "ready", "switched")
+
+
+class ReembedError(Exception):
+    """Миграцию нельзя запустить или переключить в текущем состоянии"""
+
+
+class ReembedMigration:
+    """Фоновая миграция коллекции на другую модель эмбеддингов
+
+    Тексты чанков перекодируются новой моделью в параллельную физическую
+    коллекцию батчами с паузами; после каждого батча пишется контрольная точка,
+    поэтому после перезапуска миграция продолжается с того же места. Запросы
+    читают старую коллекцию, пока миграция не завершена; после переключения
+    старая коллекция остается для отката до явной очистки.
+
+    Состояния: running -> ready -> switched -> finished, а также rolled_back, failed, cancelled.
+    """
+
+    def __init__(self, vector_store, base_service: EmbeddingService, config: ReembedConfig = None):
+        if config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            config = DEFAULT_CONFIG.reembed
+        self.vector_store = vector_store
+        self.base_service = base_service
+        self.config = config
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def _checkpoint_path(self) -> Path:
+        return Path(self.vector_store.db_path) / f"{CHECKPOINT_PREFIX}{self.vector_store.collection_name}.json"
+
+    def _acquire_lock(self):
+        """Блокировка миграции коллекции: среди воркеров pre-fork ее выполняет только один"""
+        lock_file = open(self._checkpoint_path.with_suffix(".lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _running_somewhere(self) -> bool:
+        lock_file = self._acquire_lock()
+        if lock_file is None:
+            return True
+        lock_file.close()
+        return False
+
+    def status(self) -> Optional[Dict]:
+        try:
+            with open(self._checkpoint_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        state["active"] = self._running_somewhere()
+        return state
+
+    def _save(self, state: Dict):
+        state["updated_at"] = datetime.now(timezone.utc).isoformat()
+        state.pop("active", None)
+        tmp_path = self._checkpoint_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def start(self, model_name: str) -> Dict:
+        """Запускает миграцию на модель (или продолжает начатую на ту же модель)"""
+        state = self.status()
+        if state and state["active"]:
+            raise ReembedError("Миграция уже выполняется")
+        if state and state["status"] in ("running", "ready") and state["target_model"] != model_name:
+            raise ReembedError(
+                f"Не завершена миграция на {state['target_model']}: отмените ее перед запуском новой"
+            )
+        if state and state["status"] == "switched":
+            raise ReembedError("Предыдущая миграция переключена: выполните очистку или откат")
+        if model_name == self.vector_store.embedding_model:
+            raise ReembedError(f"Коллекция уже построена моделью {model_name}")
+        self._check_model(model_name)
+
+        if (state and state["status"] in ("running", "ready", "failed")
+                and state["source"] != self.vector_store.resolve_collection_name()):
+            # Коллекцию под алиасом заменили после запуска: перекодирование начинается заново с новой
+            print(f"Коллекция {state['source']} заменена, миграция перезапускается")
+            self.vector_store.drop_physical(state["target"])
+            state = None
+        if state and state["status"] == "failed" and state["target_model"] != model_name:
+            self.vector_store.drop_physical(state["target"])
+        if not state or state["status"] not in ("running", "ready", "failed") or state["target_model"] != model_name:
+            state = {
+                "collection": self.vector_store.collection_name,
+                "source": self.vector_store.resolve_collection_name(),
+                "source_model": self.vector_store.embedding_model,
+                "target": self.vector_store.create_physical(model_name),
+                "target_model": model_name,
+                "offset": 0,
+                "total": self.vector_store.collection.count(),
+                "status": "running",
+                "started_at": datetime.now(timezone.utc).isoformat(),
+            }
+        else:
+            print(f"Миграция эмбеддингов продолжается с чанка {state['offset']}")
+            state["status"] = "running"
+            state.pop("error", None)
+        self._save(state)
+        self.resume()
+        return self.status()
+
+    def ensure_alias_free(self):
+        """Запрещает замену коллекции под алиасом (полная загрузка, снапшот, migrate_index)
+
+        Миграция закреплена за физическими коллекциями source и target: замена удалила бы
+        source, и перекодирование или откат потеряли бы данные.
+        """
+        state = self.status()
+        if state and state["status"] in ALIAS_LOCKED_STATUSES:
+            raise ReembedError(
+                f"Не завершена миграция коллекции на {state['target_model']} (статус {state['status']}): "
+                "завершите ее (переключение и очистка) или отмените/откатите"
+            )
+
+    def ensure_incremental_writes(self):
+        """Запрещает дозагрузку, обновление и удаление документов, пока миграция ждет переключения
+
+        Во время перекодирования изменения догоняются сверкой в конце, после переключения
+        пишутся в новую коллекцию; в состоянии ready они попали бы только в старую.
+        """
+        state = self.status()
+        if state and state["status"] == "ready":
+            raise ReembedError(
+                f"Миграция на {state['target_model']} ждет переключения: переключите или отмените ее "
+                "перед изменением документов"
+            )
+
+    def resume(self):
+        """Продолжает миграцию в фоне после перезапуска (если она была прервана)"""
+        state = self.status()
+        if not state or state["status"] != "running":
+            return
+        lock_file = self._acquire_lock()
+        if lock_file is None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(lock_file,), daemon=True)
+        self._thread.start()
+
+    def cancel(self) -> Dict:
+        """Останавливает миграцию и удаляет недостроенную коллекцию"""
+        state = self.status()
+        if not state or state["status"] not in ("running", "ready", "failed"):
+            raise ReembedError("Нет незавершенной миграции")
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._running_somewhere():
+            raise ReembedError("Миграцию выполняет другой воркер, повторите отмену позже")
+        self.vector_store.drop_physical(state["target"])
+        state["status"] = "cancelled"
+        self._save(state)
+        return state
+
+    def _check_model(self, model_name: str):
+        """Загружает новую модель до создания коллекции, чтобы миграция не упала уже в фоне
+
+        Образ работает офлайн (HF_HUB_OFFLINE), поэтому модель должна быть собрана
+        в него: docker build --build-arg EXTRA_EMBEDDING_MODELS="<org>/<name> ..."
+        """
+        try:
+            self._target_service(model_name).model
+        except Exception as e:
+            raise ReembedError(
+                f"Модель {model_name} не загружается: {e}. Соберите ее в образ "
+                f"(--build-arg EXTRA_EMBEDDING_MODELS={model_name}) или проверьте имя модели"
+            )
+
+    def _target_service(self, model_name: str) -> EmbeddingService:
+        return get_embedding_service_for(model_name, self.base_service)
+
+    def _reembed_batch(self, target, service: EmbeddingService, batch: Dict):
+        embeddings = service.encode_batch(batch["documents"])
+        target.upsert(
+            ids=batch["ids"],
+            embeddings=np.asarray(embeddings, dtype=np.float32).tolist(),
+            metadatas=batch["metadatas"],
+            documents=batch["documents"],
+        )
+
+    def _run(self, lock_file):
+        state = self.status()
+        try:
+            source = self.vector_store.open_physical(state["source"])
+            target = self.vector_store.open_physical(state["target"])
+            service = self._target_service(state["target_model"])
+            batch_size = self.config.batch_size
+            # upsert делает шаги идемпотентными: батч после последней контрольной точки можно повторить
+            while not self._stop.is_set():
+                batch = source.get(offset=state["offset"], limit=batch_size, include=["documents", "metadatas"])
+                if not batch["ids"]:
+                    break
+                self._reembed_batch(target, service, batch)
+                state["offset"] += len(batch["ids"])
+                state["total"] = max(state["total"], state["offset"])
+                self._save(state)
+                time.sleep(self.config.pause_seconds)
+            if self._stop.is_set():
+                return
+
+            self._reconcile(source, target, service)
+            self.vector_store.rebuild_centroids(physical_name=state["target"])
+            state["status"] = "ready"
+            state["finished_at"] = datetime.now(timezone.utc).isoformat()
+            self._save(state)
+            print(f"Миграция эмбеддингов {state['collection']} на {state['target_model']} завершена: "
+                  f"{target.count()} чанков")
+            if self.config.auto_switch:
+                # Блокировка миграции уже у этого потока
+                self._switch_locked(state)
+        except Exception as e:
+            state["status"] = "failed"
+            state["error"] = str(e)
+            self._save(state)
+            print(f"Миграция эмбеддингов прервана с ошибкой: {e}")
+        finally:
+            lock_file.close()
+
+    def _reconcile(self, source, target, service: EmbeddingService) -> bool:
+        """Догоняет изменения исходной коллекции, сделанные во время миграции; True - были изменения"""
+        source_rows = source.get(include=["documents", "metadatas"])
+        target_ids = set(target.get(include=[])["ids"])
+        source_ids = set(source_rows["ids"])
+
+        stale = list(target_ids - source_ids)
+        if stale:
+            target.delete(ids=stale)
+        missing = [i for i, doc_id in enumerate(source_rows["ids"]) if doc_id not in target_ids]
+        for start in range(0, len(missing), self.config.batch_size):
+            rows = missing[start:start + self.config.batch_size]
+            self._reembed_batch(target, service, {
+                "ids": [source_rows["ids"][i] for i in rows],
+                "documents": [source_rows["documents"][i] for i in rows],
+                "metadatas": [source_rows["metadatas"][i] for i in rows],
+            })
+        # Метаданные (например, источники схлопнутых дубликатов) могли измениться без смены текста
+        for start in range(0, len(source_rows["ids"]), 500):
+            target.update(
+                ids=source_rows["ids"][start:start + 500],
+                metadatas=source_rows["metadatas"][start:start + 500],
+            )
+        if stale or missing:
+            print(f"Миграция: догнано изменений - удалено {len(stale)}, добавлено {len(missing)}")
+        return bool(stale or missing)
+
+    def _locked(self, action):
+        """Выполняет action под блокировкой миграции (ее держит и фоновый поток перекодирования)"""
+        lock_file = self._acquire_lock()
+        if lock_file is None:
+            raise ReembedError("Миграцию выполняет другой воркер, повторите позже")
+        try:
+            return action()
+        finally:
+            lock_file.close()
+
+    def _catch_up(self, source_name: str, target_name: str, model_name: str):
+        """Переносит в target изменения source (эмбеддинги - моделью target) и обновляет центроиды"""
+        source = self.vector_store.open_physical(source_name)
+        target = self.vector_store.open_physical(target_name)
+        if self._reconcile(source, target, self._target_service(model_name)):
+            self.vector_store.rebuild_centroids(physical_name=target_name)
+
+    def switch(self) -> Dict:
+        """Переключает запросы на новую коллекцию; старая сохраняется для отката"""
+        def switch_locked():
+            state = self.status()
+            if not state or state["status"] != "ready":
+                raise ReembedError("Миграция не завершена: переключение возможно только в состоянии ready")
+            return self._switch_locked(state)
+
+        return self._locked(switch_locked)
+
+    def _switch_locked(self, state: Dict) -> Dict:
+        # В состоянии ready дозагрузки отклоняются, но изменения между последней сверкой
+        # в _run и переключением (auto_switch) переносятся здесь
+        self._catch_up(state["source"], state["target"], state["target_model"])
+        self.vector_store.switch_alias(state["target"])
+        state["status"] = "switched"
+        state["switched_at"] = datetime.now(timezone.utc).isoformat()
+        self._save(state)
+        print(f"Коллекция {state['collection']} переключена на модель {state['target_model']}")
+        return state
+
+    def rollback(self) -> Dict:
+        """Возвращает запросы на старую коллекцию и модель
+
+        Изменения, сделанные после переключения (они есть только в новой коллекции),
+        переносятся обратно и кодируются прежней моделью.
+        """
+        def rollback_locked():
+            state = self.status()
+            if not state or state["status"] != "switched":
+                raise ReembedError("Откатывать нечего: миграция не переключена")
+            self._catch_up(state["target"], state["source"], state["source_model"])
+            self.vector_store.switch_alias(state["source"])
+            state["status"] = "rolled_back"
+            self._save(state)
+            print(f"Коллекция {state['collection']} возвращена на модель {state['source_model']}")
+            return state
+
+        return self._locked(rollback_locked)
+
+    def cleanup(self) -> Dict:
+        """Удаляет коллекцию, ставшую ненужной: старую после переключения или новую после отката"""
+        state = self.status()
+        if not state or state["status"] not in ("switched", "rolled_back"):
+            raise ReembedError("Очистка возможна после переключения или отката")
+        self.vector_store.drop_physical(state["source"] if state["status"] == "switched" else state["target"])
+        state["status"] = "finished" if state["status"] == "switched" else "cancelled"
+        self._save(state)
+        return state
@@ -0,0 +1,130 @@
+from typing import Callable, Dict, List
+from pathlib import Path
+import fcntl
+import json
+import os
+import threading
+import time
+from RAG.rag.config import SnapshotConfig
+from RAG.rag.snapshot import export_snapshot, import_snapshot, latest_snapshot
+
+REPLICA_STATE_FILE = "replica_state.json"
+
+
+class SnapshotPublisher:
+    """Писатель: публикует снапшот коллекции после изменений, серии изменений склеиваются"""
+
+    def __init__(self, config: SnapshotConfig):
+        self.config = config
+        self._timers: Dict[str, threading.Timer] = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, pipeline):
+        """Откладывает публикацию на publish_delay_seconds; новое изменение сдвигает срок"""
+        alias = pipeline.vector_store.collection_name
+        with self._lock:
+            timer = self._timers.get(alias)
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(self.config.publish_delay_seconds, self._publish, args=(pipeline,))
+            timer.daemon = True
+            self._timers[alias] = timer
+            timer.start()
+
+    def _publish(self, pipeline):
+        alias = pipeline.vector_store.collection_name
+        with self._lock:
+            self._timers.pop(alias, None)
+        try:
+            export_snapshot(
+                pipeline.vector_store, pipeline.faq_index, pipeline.config.embedding, self.config, pipeline.table_index
+            )
+        except Exception as e:
+            print(f"Не удалось опубликовать снапшот {alias}: {e}")
+
+
+class SnapshotFollower:
+    """Реплика только для чтения: подтягивает новые снапшоты из общего каталога
+
+    Загрузка идет в теневую коллекцию с атомарным переключением алиаса, старая
+    коллекция удаляется с задержкой, поэтому запросы в полете не обрываются.
+    """
+
+    def __init__(self, get_pipeline: Callable, config: SnapshotConfig, db_path: str):
+        self.get_pipeline = get_pipeline
+        self.config = config
+        self.db_path = Path(db_path)
+        self._thread = None
+        self._applied: Dict[str, str] = {}
+        self.last_error = None
+
+    @property
+    def _state_path(self) -> Path:
+        return self.db_path / REPLICA_STATE_FILE
+
+    def state(self) -> Dict[str, str]:
+        """Какой снапшот загружен для каждой коллекции (общее для всех воркеров)"""
+        try:
+            with open(self._state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_state(self, state: Dict[str, str]):
+        tmp_path = self._state_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self._state_path)
+
+    def published_collections(self) -> List[str]:
+        return sorted(
+            path.name[:-len(".latest.json")] for path in Path(self.config.dir).glob("*.latest.json")
+        )
+
+    def sync(self, alias: str) -> bool:
+        """Загружает последний снапшот коллекции, если он новее загруженного; False - снапшотов нет"""
+        latest = latest_snapshot(self.config, alias)
+        if latest is None:
+            return False
+        if self._applied.get(alias) == latest["file"]:
+            return True
+
+        self.db_path.mkdir(parents=True, exist_ok=True)
+        # Воркеры pre-fork делят локальную БД: загружает один, остальные видят готовое состояние
+        with open(self.db_path / "replica.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = self.state()
+            pipeline = self.get_pipeline(alias)
+            if state.get(alias) != latest["file"]:
+                import_snapshot(
+                    Path(self.config.dir) / latest["file"],
+                    pipeline.vector_store,
+                    pipeline.faq_index,
+                    pipeline.config.embedding,
+                    allow_other_model=True,
+                    table_index=pipeline.table_index,
+                )
+                state[alias] = latest["file"]
+                self._write_state(state)
+                print(f"Реплика: коллекция {alias} переключена на снапшот {latest['file']}")
+            else:
+                # Снапшот загрузил другой воркер: коллекция подхватится по алиасу, FAQ - с диска
+                pipeline.faq_index.reload()
+            self._applied[alias] = latest["file"]
+        return True
+
+    def _loop(self):
+        while True:
+            time.sleep(self.config.poll_seconds)
+            for alias in self.published_collections():
+                try:
+                    self.sync(alias)
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = f"{alias}: {e}"
+                    print(f"Реплика: не удалось загрузить снапшот {alias}: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
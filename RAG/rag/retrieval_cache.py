@@ -0,0 +1,75 @@
+from typing import Dict, Hashable, List, Optional
+from collections import OrderedDict
+import threading
+import numpy as np
+
+
+class RetrievalCache:
+    """LRU-кэш результатов поиска с ключом по LSH-сигнатуре эмбеддинга запроса
+
+    Сигнатура - знаки проекций на случайные гиперплоскости (random-hyperplane LSH).
+    Чем больше бит, тем точнее совпадение и ниже доля попаданий.
+    """
+
+    def __init__(self, bits: int = 16, max_size: int = 1024, seed: int = 0):
+        self.bits = bits
+        self.max_size = max_size
+        self.seed = seed
+        self.hits = 0
+        self.misses = 0
+        self._hyperplanes: Optional[np.ndarray] = None
+        self._entries: "OrderedDict[Hashable, List[Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def signature(self, embedding: np.ndarray) -> bytes:
+        """LSH-сигнатура эмбеддинга запроса"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self._hyperplanes is None or self._hyperplanes.shape[1] != embedding.shape[0]:
+            rng = np.random.RandomState(self.seed)
+            self._hyperplanes = rng.standard_normal((self.bits, embedding.shape[0])).astype(np.float32)
+        return np.packbits(self._hyperplanes @ embedding > 0).tobytes()
+
+    def get(self, key: Hashable) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, value: List[Dict]):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bits": self.bits,
+        }
+
+
+# Кэш живет на уровне процесса, чтобы переживать пересоздание пайплайна на каждый запрос
+_caches: Dict[tuple, RetrievalCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_retrieval_cache(bits: int, max_size: int) -> RetrievalCache:
+    """Возвращает общий для процесса кэш с заданными параметрами"""
+    key = (bits, max_size)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = RetrievalCache(bits=bits, max_size=max_size)
+        return _caches[key]
@@ -0,0 +1,195 @@
+from typing import Dict, List, Optional
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+import numpy as np
+from RAG.rag.config import EmbeddingConfig, SnapshotConfig
+from RAG.rag.projection import Projection
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_SUFFIX = ".ragsnap"
+
+
+class SnapshotError(Exception):
+    """Снапшот несовместим с текущей конфигурацией или поврежден"""
+
+
+def _latest_pointer(snapshot_dir: Path, alias: str) -> Path:
+    return snapshot_dir / f"{alias}.latest.json"
+
+
+def read_manifest(path: Path) -> Dict:
+    """Читает манифест снапшота без распаковки данных"""
+    with zipfile.ZipFile(path) as zf:
+        return json.loads(zf.read("manifest.json"))
+
+
+def list_snapshots(config: SnapshotConfig, alias: str) -> List[Dict]:
+    """Снапшоты коллекции, от новых к старым"""
+    snapshot_dir = Path(config.dir)
+    snapshots = []
+    for path in snapshot_dir.glob(f"{alias}-v*{SNAPSHOT_SUFFIX}"):
+        try:
+            manifest = read_manifest(path)
+        except (zipfile.BadZipFile, KeyError, json.JSONDecodeError):
+            continue
+        snapshots.append({"file": path.name, "size_bytes": path.stat().st_size, **manifest})
+    return sorted(snapshots, key=lambda s: s["created_at"], reverse=True)
+
+
+def latest_snapshot(config: SnapshotConfig, alias: str) -> Optional[Dict]:
+    """Указатель на последний опубликованный снапшот коллекции: {"file", "version", "created_at"}"""
+    try:
+        with open(_latest_pointer(Path(config.dir), alias), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_json_atomic(path: Path, data: Dict):
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _npy_bytes(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _consistent_records(vector_store) -> Dict:
+    """Выгрузка коллекции вместе с ее версией под блокировкой записи
+
+    Загрузка, удаление и переключение алиаса ждут окончания выгрузки (и наоборот),
+    поэтому снапшот не может захватить многобатчевую загрузку наполовину.
+    """
+    with vector_store.write_lock():
+        records = vector_store.export_records()
+        records["version"] = vector_store.get_version()
+    return records
+
+
+def export_snapshot(vector_store, faq_index, embedding_config: EmbeddingConfig, config: SnapshotConfig,
+                    table_index=None) -> Dict:
+    """Пишет согласованный сжатый снапшот коллекции и публикует его как последний
+
+    Снапшот содержит чанки с эмбеддингами и метаданными, центроиды, проекцию,
+    каталог документов, FAQ, таблицы и идентификатор модели. Файл появляется атомарно.
+    """
+    started = time.perf_counter()
+    records = _consistent_records(vector_store)
+    chunks, centroids, projection = records["chunks"], records["centroids"], records["projection"]
+    alias = vector_store.collection_name
+    created_at = datetime.now(timezone.utc)
+
+    catalog = Counter(metadata.get("document") for metadata in chunks["metadatas"])
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "collection": alias,
+        "version": records["version"],
+        "created_at": created_at.isoformat(),
+        "model_name": vector_store.embedding_model,
+        "normalize_embeddings": embedding_config.normalize_embeddings,
+        "dim": int(chunks["embeddings"].shape[1]) if len(chunks["ids"]) else 0,
+        "projection": {"kind": projection.kind, "dim": projection.dim} if projection is not None else None,
+        "distance_space": vector_store.distance_space,
+        "chunks": len(chunks["ids"]),
+        "documents": dict(sorted(catalog.items())),
+    }
+
+    snapshot_dir = Path(config.dir)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    name = f"{alias}-v{records['version']}-{created_at.strftime('%Y%m%dT%H%M%S')}{SNAPSHOT_SUFFIX}"
+    path = snapshot_dir / name
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+        for key, data in (("chunks", chunks), ("centroids", centroids)):
+            zf.writestr(f"{key}.json", json.dumps(
+                {"ids": data["ids"], "documents": data["documents"], "metadatas": data["metadatas"]},
+                ensure_ascii=False,
+            ))
+            zf.writestr(f"{key}.npy", _npy_bytes(data["embeddings"]))
+        zf.writestr("faq.json", json.dumps(faq_index.list(), ensure_ascii=False))
+        if table_index is not None:
+            zf.writestr("tables.json", json.dumps(table_index.export_tables(), ensure_ascii=False))
+        if projection is not None:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                projection_path = Path(tmp_dir) / "projection.npz"
+                projection.save(projection_path)
+                zf.write(projection_path, "projection.npz")
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    _write_json_atomic(_latest_pointer(snapshot_dir, alias), {
+        "file": name, "version": records["version"], "created_at": manifest["created_at"],
+    })
+    _prune(config, alias)
+    print(f"Снапшот {name}: {manifest['chunks']} чанков, "
+          f"{path.stat().st_size / (1024 * 1024):.1f} MB за {time.perf_counter() - started:.1f} с")
+    return {"file": name, "size_bytes": path.stat().st_size, **manifest}
+
+
+def _prune(config: SnapshotConfig, alias: str):
+    """Удаляет старые снапшоты коллекции сверх config.keep (последний опубликованный не трогается)"""
+    latest = latest_snapshot(config, alias) or {}
+    paths = sorted(Path(config.dir).glob(f"{alias}-v*{SNAPSHOT_SUFFIX}"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in paths[max(1, config.keep):]:
+        if path.name != latest.get("file"):
+            path.unlink(missing_ok=True)
+
+
+def import_snapshot(path: Path, vector_store, faq_index, embedding_config: EmbeddingConfig,
+                    allow_other_model: bool = False, table_index=None) -> Dict:
+    """Загружает снапшот в коллекцию без пересчета эмбеддингов (blue/green, атомарно)
+
+    allow_other_model - принять снапшот коллекции, переведенной писателем на другую модель (реплики).
+    Таблицы загружаются, только если они есть в снапшоте (старые снапшоты их не содержат).
+    """
+    started = time.perf_counter()
+    with zipfile.ZipFile(path) as zf:
+        manifest = json.loads(zf.read("manifest.json"))
+        if manifest.get("format") != SNAPSHOT_FORMAT:
+            raise SnapshotError(f"Неподдерживаемый формат снапшота: {manifest.get('format')}")
+        known_models = (embedding_config.model_name, vector_store.embedding_model)
+        if manifest["model_name"] not in known_models and not allow_other_model:
+            # Векторы другой модели несопоставимы с эмбеддингами запросов
+            raise SnapshotError(
+                f"Снапшот построен моделью {manifest['model_name']}, "
+                f"а сервис использует {embedding_config.model_name}"
+            )
+
+        records = {}
+        for key in ("chunks", "centroids"):
+            records[key] = json.loads(zf.read(f"{key}.json"))
+            records[key]["embeddings"] = np.load(io.BytesIO(zf.read(f"{key}.npy")), allow_pickle=False)
+        if len(records["chunks"]["ids"]) != manifest["chunks"]:
+            raise SnapshotError("Число чанков не совпадает с манифестом, снапшот поврежден")
+        faq_entries = json.loads(zf.read("faq.json"))
+        tables = json.loads(zf.read("tables.json")) if "tables.json" in zf.namelist() else None
+
+        projection = None
+        if "projection.npz" in zf.namelist():
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                projection_path = Path(zf.extract("projection.npz", tmp_dir))
+                projection = Projection.load(projection_path)
+
+    count = vector_store.replace_with_records(
+        records["chunks"], records["centroids"], projection, embedding_model=manifest["model_name"]
+    )
+    faq_index.replace_entries(faq_entries)
+    if table_index is not None and tables is not None:
+        table_index.replace_tables(tables)
+    print(f"Снапшот {Path(path).name} загружен: {count} чанков за {time.perf_counter() - started:.1f} с")
+    return manifest
@@ -0,0 +1,303 @@
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import json
+import os
+import re
+import sqlite3
+import threading
+from RAG.rag.config import TableConfig
+from RAG.rag.markdown_chunker import HEADING_RE, TABLE_SEPARATOR_RE, parse_blocks
+
+WORD_RE = re.compile(r'\w+')
+# MarkItDown выводит пустые ячейки xlsx как NaN, а безымянные колонки как "Unnamed: N"
+EMPTY_CELLS = {"nan", "none", "-", "—"}
+UNNAMED_RE = re.compile(r'^Unnamed: \d+$')
+
+
+def _split_row(row: str) -> List[str]:
+    row = row.strip()
+    if row.startswith('|'):
+        row = row[1:]
+    if row.endswith('|'):
+        row = row[:-1]
+    cells = [cell.strip() for cell in row.split('|')]
+    return ["" if cell.lower() in EMPTY_CELLS else cell for cell in cells]
+
+
+def extract_tables(text: str, min_rows: int = 1) -> List[Dict]:
+    """Находит в markdown таблицы с заголовком: [{"heading_path", "header", "rows"}]"""
+    tables = []
+    heading_stack: List[Tuple[int, str]] = []
+    for kind, block in parse_blocks(text):
+        if kind == 'heading':
+            match = HEADING_RE.match(block)
+            level = len(match.group(1))
+            heading_stack = [h for h in heading_stack if h[0] < level]
+            heading_stack.append((level, match.group(2).strip()))
+            continue
+        if kind != 'table':
+            continue
+        lines = block.split('\n')
+        if len(lines) < 2 or not TABLE_SEPARATOR_RE.match(lines[1]):
+            continue
+        header = ["" if UNNAMED_RE.match(cell) else cell for cell in _split_row(lines[0])]
+        rows = []
+        for line in lines[2:]:
+            cells = _split_row(line)
+            cells = (cells + [""] * len(header))[:len(header)]
+            if any(cells):
+                rows.append(cells)
+        if len(rows) >= min_rows:
+            tables.append({
+                "heading_path": ' > '.join(h[1] for h in heading_stack),
+                "header": header,
+                "rows": rows,
+            })
+    return tables
+
+
+class TableIndex:
+    """Структурированный индекс таблиц из загруженных документов
+
+    Строки таблиц хранятся целиком в SQLite, а нормализованные значения
+    текстовых ячеек (курс, возрастная группа, филиал) - в B-tree индексе.
+    Совпадение слов запроса с ключами дает точные строки за O(log n) на ключ,
+    без векторного поиска по фрагментам таблиц.
+    """
+
+    def __init__(self, config: TableConfig = None, path: str = None):
+        if config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            config = DEFAULT_CONFIG.tables
+        self.config = config
+        if path is None:
+            path = config.path or str(Path(os.getenv('CHROMA_DB_PATH', '/app/data/chroma_db')) / "tables.sqlite")
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS tables ("
+            "id INTEGER PRIMARY KEY, document TEXT NOT NULL, heading_path TEXT NOT NULL, header TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_tables_document ON tables(document);"
+            "CREATE TABLE IF NOT EXISTS table_rows ("
+            "id INTEGER PRIMARY KEY, table_id INTEGER NOT NULL, position INTEGER NOT NULL, cells TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_table_rows_table ON table_rows(table_id);"
+            "CREATE TABLE IF NOT EXISTS table_keys ("
+            "key TEXT NOT NULL, column_index INTEGER NOT NULL, row_id INTEGER NOT NULL, "
+            "exact INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_table_keys_key ON table_keys(key);"
+            "CREATE INDEX IF NOT EXISTS idx_table_keys_row ON table_keys(row_id);"
+        )
+        self._conn.commit()
+        self.lookups = 0
+        self.hits = 0
+
+    def normalize(self, text: str) -> List[str]:
+        """Слова в нижнем регистре, ё -> е, усеченные до stem_length (грубая замена стемминга)"""
+        words = WORD_RE.findall(text.lower().replace('ё', 'е'))
+        if self.config.stem_length:
+            words = [w if w.isdigit() else w[:self.config.stem_length] for w in words]
+        return words
+
+    def _cell_keys(self, cell: str) -> List[Tuple[str, int]]:
+        """Ключи ячейки (ключ, exact): значение целиком (exact = 1) и его значимые слова (exact = 0)
+
+        Пусто для чисел и длинного текста.
+        """
+        if not cell or len(cell) > self.config.max_key_length:
+            return []
+        words = self.normalize(cell)
+        if not words or len(words) > self.config.max_key_words or all(w.isdigit() for w in words):
+            return []
+        key = ' '.join(words)
+        keys = [(key, 1)] if len(key) >= 3 else []
+        if len(words) > 1:
+            # "Программирование на Python" находится и по "python", но это лишь частичное совпадение
+            keys.extend((w, 0) for w in words if len(w) >= 4 and not w.isdigit())
+        return keys
+
+    def _insert_keys(self, row_id: int, cells: List[str]):
+        keys = {(key, column, exact) for column, cell in enumerate(cells) for key, exact in self._cell_keys(cell)}
+        self._conn.executemany(
+            "INSERT INTO table_keys (key, column_index, row_id, exact) VALUES (?, ?, ?, ?)",
+            [(key, column, row_id, exact) for key, column, exact in keys],
+        )
+
+    def _insert_table(self, document: str, table: Dict) -> int:
+        cursor = self._conn.execute(
+            "INSERT INTO tables (document, heading_path, header) VALUES (?, ?, ?)",
+            (document, table["heading_path"], json.dumps(table["header"], ensure_ascii=False)),
+        )
+        table_id = cursor.lastrowid
+        for position, cells in enumerate(table["rows"]):
+            row_id = self._conn.execute(
+                "INSERT INTO table_rows (table_id, position, cells) VALUES (?, ?, ?)",
+                (table_id, position, json.dumps(cells, ensure_ascii=False)),
+            ).lastrowid
+            self._insert_keys(row_id, cells)
+        return len(table["rows"])
+
+    def _delete_where(self, condition: str, params: tuple):
+        table_ids = f"SELECT id FROM tables WHERE {condition}"
+        self._conn.execute(
+            f"DELETE FROM table_keys WHERE row_id IN (SELECT id FROM table_rows WHERE table_id IN ({table_ids}))",
+            params,
+        )
+        self._conn.execute(f"DELETE FROM table_rows WHERE table_id IN ({table_ids})", params)
+        self._conn.execute(f"DELETE FROM tables WHERE {condition}", params)
+
+    def extract(self, markdown: str) -> List[Dict]:
+        """Таблицы документа для последующей index_tables (сам индекс не меняется)"""
+        return extract_tables(markdown, self.config.min_rows)
+
+    def index_tables(self, document: str, tables: List[Dict], replace_all: bool = False) -> int:
+        """Заменяет таблицы документа (или все таблицы) извлеченными одной транзакцией; возвращает число строк"""
+        with self._lock:
+            if replace_all:
+                self._delete_where("1 = 1", ())
+            else:
+                self._delete_where("document = ?", (document,))
+            rows = sum(self._insert_table(document, table) for table in tables)
+            self._conn.commit()
+        if tables:
+            print(f"Проиндексировано таблиц: {len(tables)}, строк: {rows}")
+        return rows
+
+    def delete_document(self, document: str):
+        with self._lock:
+            self._delete_where("document = ?", (document,))
+            self._conn.commit()
+
+    def _query_keys(self, question: str) -> List[str]:
+        """Все n-граммы слов вопроса длиной до max_key_words - кандидаты в ключи"""
+        words = self.normalize(question)
+        grams = {
+            ' '.join(words[start:start + size])
+            for size in range(1, self.config.max_key_words + 1)
+            for start in range(len(words) - size + 1)
+        }
+        return [gram for gram in grams if len(gram) >= 3]
+
+    def lookup(self, question: str) -> Optional[Dict]:
+        """Строки таблиц, совпавшие с вопросом по наибольшему числу колонок
+
+        Возвращает {"tables": [{"document", "heading_path", "header", "rows"}], "matched_columns",
+        "partial_columns", "rows"} или None, если ни один ключ не совпал. matched_columns - колонки,
+        совпавшие значением ячейки целиком; partial_columns - колонки, совпавшие только отдельным словом.
+        """
+        keys = self._query_keys(question)
+        with self._lock:
+            self.lookups += 1
+            if not keys:
+                return None
+            matches = self._conn.execute(
+                f"SELECT row_id, column_index, exact FROM table_keys WHERE key IN ({','.join('?' * len(keys))})",
+                keys,
+            ).fetchall()
+            if not matches:
+                return None
+
+            # Строка тем точнее, чем больше разных колонок совпало (курс + возраст + филиал);
+            # колонки, совпавшие значением целиком, важнее совпавших одним словом
+            exact_columns: Dict[int, set] = {}
+            columns: Dict[int, set] = {}
+            for row_id, column, exact in matches:
+                columns.setdefault(row_id, set()).add(column)
+                exact_columns.setdefault(row_id, set())
+                if exact:
+                    exact_columns[row_id].add(column)
+            scores = {row_id: (len(exact_columns[row_id]), len(c)) for row_id, c in columns.items()}
+            best = max(scores.values())
+            row_ids = sorted(row_id for row_id, score in scores.items() if score == best)[:self.config.max_rows]
+            rows = self._conn.execute(
+                "SELECT r.table_id, r.cells, t.document, t.heading_path, t.header "
+                "FROM table_rows r JOIN tables t ON t.id = r.table_id "
+                f"WHERE r.id IN ({','.join('?' * len(row_ids))}) ORDER BY r.table_id, r.position",
+                row_ids,
+            ).fetchall()
+            self.hits += 1
+
+        tables: Dict[int, Dict] = {}
+        for table_id, cells, document, heading_path, header in rows:
+            table = tables.setdefault(table_id, {
+                "document": document, "heading_path": heading_path, "header": json.loads(header), "rows": [],
+            })
+            table["rows"].append(json.loads(cells))
+        return {
+            "tables": list(tables.values()),
+            "matched_columns": best[0],
+            "partial_columns": best[1] - best[0],
+            "rows": len(rows),
+        }
+
+    @staticmethod
+    def format_context(match: Dict) -> str:
+        """Компактный контекст для LLM: только заголовок и совпавшие строки каждой таблицы"""
+        parts = []
+        for table in match["tables"]:
+            title = table["heading_path"] or "Таблица"
+            # Пустые в совпавших строках колонки только тратят токены
+            columns = [i for i in range(len(table["header"])) if any(row[i] for row in table["rows"])]
+            lines = [f"{title} ({table['document']}):", "| " + " | ".join(table["header"][i] for i in columns) + " |"]
+            lines.extend("| " + " | ".join(row[i] for i in columns) + " |" for row in table["rows"])
+            parts.append("\n".join(lines))
+        return "\n\n".join(parts)
+
+    def export_tables(self) -> List[Dict]:
+        """Все таблицы со строками (для снапшота)"""
+        with self._lock:
+            tables = self._conn.execute(
+                "SELECT id, document, heading_path, header FROM tables ORDER BY id"
+            ).fetchall()
+            result = []
+            for table_id, document, heading_path, header in tables:
+                rows = self._conn.execute(
+                    "SELECT cells FROM table_rows WHERE table_id = ? ORDER BY position", (table_id,)
+                ).fetchall()
+                result.append({
+                    "document": document,
+                    "heading_path": heading_path,
+                    "header": json.loads(header),
+                    "rows": [json.loads(cells) for (cells,) in rows],
+                })
+        return result
+
+    def replace_tables(self, tables: List[Dict]):
+        """Заменяет все таблицы (восстановление из снапшота), ключи строятся заново"""
+        with self._lock:
+            self._delete_where("1 = 1", ())
+            for table in tables:
+                self._insert_table(table["document"], table)
+            self._conn.commit()
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT t.document, t.heading_path, t.header, COUNT(r.id) FROM tables t "
+                "LEFT JOIN table_rows r ON r.table_id = t.id GROUP BY t.id ORDER BY t.id"
+            ).fetchall()
+        return [
+            {"document": document, "heading_path": heading_path, "header": json.loads(header), "rows": count}
+            for document, heading_path, header, count in rows
+        ]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            tables = self._conn.execute("SELECT COUNT(*) FROM tables").fetchone()[0]
+            rows = self._conn.execute("SELECT COUNT(*) FROM table_rows").fetchone()[0]
+            keys = self._conn.execute("SELECT COUNT(DISTINCT key) FROM table_keys").fetchone()[0]
+        return {
+            "tables": tables,
+            "rows": rows,
+            "keys": keys,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,15 +1,48 @@
 from typing import List, Dict, Optional
-import chromadb
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
+import fcntl
 import numpy as np
+import json
 import os
-from RAG.rag.config import RetrievalConfig
+import threading
+import time
+import uuid
+from RAG.rag.config import RetrievalConfig, EmbeddingConfig
+from RAG.rag.projection import Projection
+from RAG.rag.dedup import (
+    BAND_KEY_PREFIX, SIGNATURE_KEY, public_metadata, set_sources, sources_filter, split_sources,
+)
+
+DEFAULT_COLLECTION = os.getenv('RAG_DEFAULT_COLLECTION', 'k1_about')
+# "chroma" - локальный PersistentClient, "pgvector" - общий Postgres (несколько экземпляров RAG)
+VECTOR_STORE_BACKEND = os.getenv('VECTOR_STORE_BACKEND', 'chroma')
+PGVECTOR_URL = os.getenv('PGVECTOR_URL', os.getenv('DATABASE_URL', ''))
+ALIASES_FILE = "aliases.json"
+VERSIONS_FILE = "versions.json"
+
+
+def _writes(method):
+    """Выполняет метод под блокировкой записи коллекции (см. VectorStore.write_lock)"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock():
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class VectorStore:
     """Класс для работы с векторной базой данных"""
 
-    def __init__(self, db_path: str = None, collection_name: str = "k1_about", config: RetrievalConfig = None):
+    def __init__(
+            self,
+            db_path: str = None,
+            collection_name: str = DEFAULT_COLLECTION,
+            config: RetrievalConfig = None,
+            client=None,
+            embedding_config: EmbeddingConfig = None,
+    ):
         # Используем переменную окружения или путь по умолчанию
         if db_path is None:
             db_path = os.getenv('CHROMA_DB_PATH', '/app/data/chroma_db')
@@ -18,6 +51,42 @@ class VectorStore:
         db_path = str(Path(db_path).resolve())
         Path(db_path).mkdir(parents=True, exist_ok=True)
         
+        # Клиент можно передать снаружи, чтобы несколько коллекций делили одно подключение
+        self.client = client if client is not None else self.create_client(db_path)
+        self.db_path = db_path
+        # collection_name - это алиас; физическая коллекция определяется через aliases.json
+        self.collection_name = collection_name
+        if config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            config = DEFAULT_CONFIG.retrieval
+        self.config = config
+        if embedding_config is None:
+            from RAG.rag.config import DEFAULT_CONFIG
+            embedding_config = DEFAULT_CONFIG.embedding
+        self.embedding_config = embedding_config
+        self._projections: Dict[str, Optional[Projection]] = {}
+        self._collection = None
+        self._physical_name = None
+        self._aliases_mtime = None
+        # Задержка удаления старой коллекции после переключения алиаса (для запросов в полете)
+        self.drop_grace_seconds = config.drop_grace_seconds
+        self._write_depth = threading.local()
+
+    @staticmethod
+    def create_client(db_path: str):
+        """Создает PersistentClient ChromaDB для каталога или клиент pgvector (VECTOR_STORE_BACKEND)"""
+        if VECTOR_STORE_BACKEND == "pgvector":
+            from RAG.rag.pgvector_store import PgVectorClient
+            return PgVectorClient(
+                PGVECTOR_URL,
+                index_type=os.getenv('PGVECTOR_INDEX', 'hnsw'),
+                ivfflat_lists=int(os.getenv('PGVECTOR_IVFFLAT_LISTS', '0')),
+                ivfflat_probes=int(os.getenv('PGVECTOR_IVFFLAT_PROBES', '10')),
+            )
+
+        # chromadb импортируется только для локального бэкенда: с pgvector он не нужен
+        import chromadb
+
         # Оптимизация ChromaDB для ограниченной памяти
         # Используем настройки для экономии памяти и отключения телеметрии
         try:
@@ -26,86 +95,549 @@ class VectorStore:
                 anonymized_telemetry=False,
                 allow_reset=True,
             )
-            self.client = chromadb.PersistentClient(path=db_path, settings=settings)
+            return chromadb.PersistentClient(path=db_path, settings=settings)
         except Exception:
             # Fallback на стандартный клиент если настройки не поддерживаются
-            self.client = chromadb.PersistentClient(path=db_path)
-        self.collection_name = collection_name
-        if config is None:
-            from RAG.rag.config import DEFAULT_CONFIG
-            config = DEFAULT_CONFIG.retrieval
-        self.config = config
-        self._collection = None
+            return chromadb.PersistentClient(path=db_path)
+
+    @property
+    def _shared_metadata(self) -> bool:
+        """Алиасы, версии и проекции хранит сам клиент (pgvector), а не файлы рядом с БД"""
+        return hasattr(self.client, "read_aliases")
+
+    def list_aliases(self) -> List[str]:
+        """Имена логических коллекций (тенантов) в этой БД"""
+        names = set(self._read_aliases().keys())
+        for collection in self.client.list_collections():
+            name = collection.name
+            if "__" not in name and not name.endswith("_centroids"):
+                names.add(name)
+        return sorted(names)
+
+    @property
+    def _aliases_path(self) -> Path:
+        return Path(self.db_path) / ALIASES_FILE
+
+    def _read_aliases(self) -> Dict[str, str]:
+        """Читает таблицу алиасов (алиас -> физическая коллекция)"""
+        if self._shared_metadata:
+            return self.client.read_aliases()
+        try:
+            with open(self._aliases_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_aliases(self, aliases: Dict[str, str]):
+        """Атомарно записывает таблицу алиасов через os.replace"""
+        if self._shared_metadata:
+            return self.client.write_aliases(aliases)
+        tmp_path = self._aliases_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(aliases, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._aliases_path)
+
+    def resolve_collection_name(self) -> str:
+        """Возвращает имя физической коллекции, на которую указывает алиас"""
+        return self._read_aliases().get(self.collection_name, self.collection_name)
+
+    @property
+    def _versions_path(self) -> Path:
+        return Path(self.db_path) / VERSIONS_FILE
+
+    def get_version(self) -> int:
+        """Версия содержимого коллекции, увеличивается при каждом изменении"""
+        if self._shared_metadata:
+            return self.client.get_version(self.collection_name)
+        try:
+            with open(self._versions_path, 'r', encoding='utf-8') as f:
+                return int(json.load(f).get(self.collection_name, 0))
+        except (FileNotFoundError, json.JSONDecodeError, ValueError):
+            return 0
+
+    def _bump_version(self):
+        """Увеличивает версию коллекции (инвалидирует кэши результатов поиска)"""
+        if self._shared_metadata:
+            return self.client.bump_version(self.collection_name)
+        try:
+            with open(self._versions_path, 'r', encoding='utf-8') as f:
+                versions = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            versions = {}
+        versions[self.collection_name] = int(versions.get(self.collection_name, 0)) + 1
+        tmp_path = self._versions_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(versions, f)
+        os.replace(tmp_path, self._versions_path)
+
+    @contextmanager
+    def write_lock(self):
+        """Блокировка записи коллекции, общая для изменений и выгрузки снапшота
+
+        Версия меняется один раз в конце многобатчевой загрузки, поэтому по ней нельзя
+        понять, что выгрузка захватила загрузку наполовину; блокировка это исключает.
+        Действует между процессами (flock рядом с БД или advisory-блокировка Postgres),
+        повторный вход в том же потоке не блокируется.
+        """
+        depth = getattr(self._write_depth, "value", 0)
+        self._write_depth.value = depth + 1
+        try:
+            if depth:
+                yield
+            elif self._shared_metadata:
+                with self.client.advisory_lock(f"rag_write:{self.collection_name}"):
+                    yield
+            else:
+                with open(Path(self.db_path) / f"write_{self.collection_name}.lock", "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    yield
+        finally:
+            self._write_depth.value = depth
+
+    def _aliases_changed(self) -> bool:
+        """Проверяет по mtime (или ревизии в Postgres), не переключил ли алиас другой процесс"""
+        if self._shared_metadata:
+            mtime = self.client.aliases_revision()
+        else:
+            try:
+                mtime = self._aliases_path.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+        if mtime != self._aliases_mtime:
+            self._aliases_mtime = mtime
+            return True
+        return False
 
     @property
     def collection(self):
-        """Ленивая загрузка коллекции"""
-        if self._collection is None:
-            self._collection = self.client.get_or_create_collection(
-                name=self.collection_name,
-                metadata={"description": "RAG Knowledge Base"}
-            )
+        """Ленивая загрузка коллекции, на которую указывает алиас"""
+        if self._collection is None or self._aliases_changed():
+            physical_name = self.resolve_collection_name()
+            if self._collection is None or physical_name != self._physical_name:
+                self._collection = self.client.get_or_create_collection(
+                    name=physical_name,
+                    metadata=self._collection_metadata(self.embedding_config.model_name)
+                )
+                self._physical_name = physical_name
         return self._collection
 
-    def upload_documents(
+    def _projection_path(self, physical_name: str) -> Path:
+        return Path(self.db_path) / "projections" / f"{physical_name}.npz"
+
+    def _projection_for(self, physical_name: str) -> Optional[Projection]:
+        """Проекция, с которой построена физическая коллекция (None - полная размерность)"""
+        if physical_name not in self._projections:
+            if self._shared_metadata:
+                data = self.client.load_projection(physical_name)
+                self._projections[physical_name] = Projection.from_bytes(data) if data else None
+            else:
+                self._projections[physical_name] = Projection.load(self._projection_path(physical_name))
+        return self._projections[physical_name]
+
+    def _save_projection(self, physical_name: str, projection: Projection):
+        if self._shared_metadata:
+            self.client.save_projection(physical_name, projection.to_bytes())
+        else:
+            projection.save(self._projection_path(physical_name))
+        self._projections[physical_name] = projection
+
+    @property
+    def projection(self) -> Optional[Projection]:
+        self.collection
+        return self._projection_for(self._physical_name)
+
+    def project(self, embeddings) -> np.ndarray:
+        """Приводит эмбеддинги модели к пространству текущей коллекции"""
+        projection = self.projection
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        return projection.apply(embeddings) if projection is not None else embeddings
+
+    def _collection_metadata(self, embedding_model: str = None) -> Dict:
+        """Метаданные коллекции с параметрами HNSW из конфигурации и моделью, которой построены векторы"""
+        metadata = {
+            "description": "RAG Knowledge Base",
+            "hnsw:space": self.config.distance_space,
+            "hnsw:M": self.config.hnsw_m,
+            "hnsw:construction_ef": self.config.hnsw_ef_construction,
+            "hnsw:search_ef": self.config.hnsw_ef_search,
+        }
+        if embedding_model:
+            metadata["embedding_model"] = embedding_model
+        return metadata
+
+    @property
+    def embedding_model(self) -> str:
+        """Модель эмбеддингов текущей коллекции (старые коллекции - модель из конфигурации)"""
+        return (self.collection.metadata or {}).get("embedding_model") or self.embedding_config.model_name
+
+    @property
+    def distance_space(self) -> str:
+        """Метрика фактической коллекции (старые коллекции созданы с l2)"""
+        return (self.collection.metadata or {}).get("hnsw:space", "l2")
+
+    def distance_to_similarity(self, distance: float) -> float:
+        """Переводит расстояние Chroma в сходство с учетом метрики коллекции"""
+        if self.distance_space in ("cosine", "ip"):
+            # Chroma отдает 1 - cos (или 1 - dot), сходство можно сравнивать с порогом напрямую
+            return 1.0 - distance
+        return 1.0 / (1.0 + distance)
+
+    def index_settings_match(self) -> bool:
+        """Совпадают ли параметры индекса текущей коллекции с конфигурацией"""
+        current = self.collection.metadata or {}
+        expected = self._collection_metadata()
+        return all(
+            current.get(key, "l2" if key == "hnsw:space" else None) == value
+            for key, value in expected.items() if key.startswith("hnsw:")
+        )
+
+    @_writes
+    def migrate_index(self, batch_size: int = 500) -> int:
+        """Перестраивает коллекцию с текущими параметрами HNSW без пересчета эмбеддингов
+
+        Данные копируются в новую коллекцию, затем алиас атомарно переключается.
+        """
+        source = self.collection
+        source_name = self._physical_name
+        target_name = f"{self.collection_name}__{time.time_ns()}"
+        target = self.client.create_collection(
+            name=target_name, metadata=self._collection_metadata(self.embedding_model)
+        )
+        try:
+            self._copy_collection(source, target, batch_size)
+            self._copy_collection(
+                self._centroids_for(source_name), self._centroids_for(target_name), batch_size
+            )
+            source_projection = self._projection_for(source_name)
+            if source_projection is not None:
+                self._save_projection(target_name, source_projection)
+        except Exception:
+            self._drop_collection(target_name)
+            raise
+
+        self._swap_alias(target_name)
+        self._collection = target
+        self._physical_name = target_name
+        if source_name != target_name:
+            self._drop_later(source_name)
+        self._bump_version()
+        print(f"Коллекция {self.collection_name} перестроена с метрикой {self.config.distance_space}")
+        return target.count()
+
+    @staticmethod
+    def _centroids_name(physical_name: str) -> str:
+        return f"{physical_name}_centroids"
+
+    def _centroids_for(self, physical_name: str):
+        """Коллекция центроидов документов, парная физической коллекции чанков"""
+        return self.client.get_or_create_collection(
+            name=self._centroids_name(physical_name),
+            metadata=self._collection_metadata()
+        )
+
+    @property
+    def centroids(self):
+        """Коллекция центроидов документов для текущего алиаса"""
+        self.collection
+        return self._centroids_for(self._physical_name)
+
+    @staticmethod
+    def _chunk_sources(metadata: Dict) -> List[str]:
+        """Все документы чанка: схлопнутый дубликат входит в центроид каждого источника"""
+        return split_sources(metadata.get("sources")) or [metadata.get("document")]
+
+    @classmethod
+    def _accumulate_centroids(cls, sums: Dict[str, np.ndarray], counts: Dict[str, int], metadatas, embeddings,
+                              only: set = None):
+        for metadata, embedding in zip(metadatas, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            for document_name in cls._chunk_sources(metadata):
+                if only is not None and document_name not in only:
+                    continue
+                sums[document_name] = sums.get(document_name, 0) + vector
+                counts[document_name] = counts.get(document_name, 0) + 1
+
+    @staticmethod
+    def _write_centroids(centroids_collection, sums: Dict[str, np.ndarray], counts: Dict[str, int]) -> int:
+        if not sums:
+            return 0
+        names = list(sums.keys())
+        vectors = [(sums[n] / (np.linalg.norm(sums[n]) + 1e-8)).tolist() for n in names]
+        centroids_collection.upsert(
+            ids=names,
+            embeddings=vectors,
+            metadatas=[{"document": n, "chunks": counts[n]} for n in names],
+        )
+        return len(names)
+
+    def _upsert_centroids(self, centroids_collection, embeddings: np.ndarray, chunks: List[Dict]):
+        """Пересчитывает центроиды документов по эмбеддингам их чанков"""
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        self._accumulate_centroids(sums, counts, [chunk.get("metadata", {}) for chunk in chunks], embeddings)
+        self._write_centroids(centroids_collection, sums, counts)
+
+    def _refresh_centroids(self, document_names: List[str]):
+        """Пересчитывает центроиды документов по всем их сохраненным чанкам, включая общие"""
+        names = set(document_names)
+        if not names:
+            return
+        results = self.collection.get(where=sources_filter(sorted(names)), include=["metadatas", "embeddings"])
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        self._accumulate_centroids(sums, counts, results["metadatas"], results["embeddings"], only=names)
+        self._write_centroids(self.centroids, sums, counts)
+
+    @_writes
+    def rebuild_centroids(self, batch_size: int = 500, physical_name: str = None) -> int:
+        """Пересчитывает центроиды всех документов по сохраненным эмбеддингам чанков"""
+        source = self.open_physical(physical_name) if physical_name else self.collection
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        total = source.count()
+        for offset in range(0, total, batch_size):
+            batch = source.get(offset=offset, limit=batch_size, include=["metadatas", "embeddings"])
+            self._accumulate_centroids(sums, counts, batch["metadatas"], batch["embeddings"])
+        centroids = self._centroids_for(physical_name) if physical_name else self.centroids
+        return self._write_centroids(centroids, sums, counts)
+
+    def select_documents(self, query_embeddings: List[List[float]], top_m: int) -> Optional[List[str]]:
+        """Первый уровень иерархического поиска: top-M документов по близости центроидов
+
+        Возвращает None, если документов не больше top_m и фильтр не нужен.
+        """
+        centroids = self.centroids
+        if top_m <= 0 or centroids.count() <= top_m:
+            return None
+        results = centroids.query(query_embeddings=self.project(query_embeddings).tolist(), n_results=top_m, include=["distances"])
+        selected = []
+        for row in results["ids"]:
+            for document_name in row:
+                if document_name not in selected:
+                    selected.append(document_name)
+        return selected or None
+
+    def _copy_collection(self, source, target, batch_size: int):
+        """Копирует записи коллекции вместе с эмбеддингами"""
+        total = source.count()
+        for offset in range(0, total, batch_size):
+            batch = source.get(
+                offset=offset,
+                limit=batch_size,
+                include=["documents", "metadatas", "embeddings"],
+            )
+            target.add(
+                ids=batch["ids"],
+                documents=batch["documents"],
+                metadatas=batch["metadatas"],
+                embeddings=batch["embeddings"],
+            )
+
+    def _swap_alias(self, physical_name: str) -> Optional[str]:
+        """Переключает алиас на новую коллекцию и возвращает имя предыдущей"""
+        aliases = self._read_aliases()
+        previous = aliases.get(self.collection_name, self.collection_name)
+        aliases[self.collection_name] = physical_name
+        self._write_aliases(aliases)
+        return previous
+
+    def _drop_later(self, physical_name: str):
+        """Удаляет коллекцию, с которой ушел алиас, через drop_grace_seconds"""
+        if self.drop_grace_seconds > 0:
+            timer = threading.Timer(self.drop_grace_seconds, self._drop_collection, args=(physical_name,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._drop_collection(physical_name)
+
+    def _drop_collection(self, physical_name: str):
+        """Удаляет физическую коллекцию вместе с центроидами и проекцией, игнорируя отсутствующие"""
+        for name in (physical_name, self._centroids_name(physical_name)):
+            try:
+                self.client.delete_collection(name)
+            except Exception as e:
+                print(f"Не удалось удалить коллекцию {name}: {e}")
+        if self._shared_metadata:
+            self.client.delete_projection(physical_name)
+        else:
+            self._projection_path(physical_name).unlink(missing_ok=True)
+        self._projections.pop(physical_name, None)
+
+    def _add_batches(
             self,
+            collection,
             documents: List[str],
             embeddings: np.ndarray,
             chunks: List[Dict],
-            replace_all: bool = True,
-            batch_size: int = 100  # Загружаем батчами для экономии памяти
+            batch_size: int,
+            id_prefix: str = "doc_",
     ):
-        """Загружает документы в векторную БД батчами для оптимизации памяти
-        
-        Args:
-            documents: Список текстов документов
-            embeddings: Массив эмбеддингов
-            chunks: Список чанков с метаданными
-            replace_all: Если True, удаляет всю коллекцию перед добавлением (по умолчанию True)
-            batch_size: Размер батча для загрузки (по умолчанию 100)
-        """
+        """Загружает документы в коллекцию батчами"""
         import gc
-        
-        if replace_all:
-            try:
-                self.client.delete_collection(self.collection_name)
-                self._collection = None  # Сбрасываем кэш
-            except:
-                pass
-
-        self.collection
 
-        # Загружаем батчами для экономии памяти
         total_docs = len(documents)
         for batch_start in range(0, total_docs, batch_size):
             batch_end = min(batch_start + batch_size, total_docs)
             batch_docs = documents[batch_start:batch_end]
             batch_embeddings = embeddings[batch_start:batch_end]
             batch_chunks = chunks[batch_start:batch_end]
-            
+
             metadatas = []
             ids = []
             for i, chunk in enumerate(batch_chunks):
-                metadata = chunk.get("metadata", {})
+                metadata = chunk.setdefault("metadata", {})
                 metadata["document"] = Path(chunk["source"]).name
+                if "sources" not in metadata:
+                    set_sources(metadata, [metadata["document"]])
                 metadata["chunk_id"] = chunk.get("chunk_id", batch_start + i)
                 metadatas.append(metadata)
-                ids.append(f"doc_{batch_start + i}")
+                ids.append(f"{id_prefix}{batch_start + i}")
 
             # Загрузка батча в БД
-            self.collection.add(
+            collection.add(
                 documents=batch_docs,
                 embeddings=batch_embeddings.tolist(),
                 metadatas=metadatas,
                 ids=ids,
             )
-            
+
             # Очистка памяти после каждого батча
             del batch_docs, batch_embeddings, batch_chunks, metadatas, ids
             if batch_start % (batch_size * 4) == 0:
                 gc.collect()
 
-        return self.collection.count()
+    @_writes
+    def upload_documents(
+            self,
+            documents: List[str],
+            embeddings: np.ndarray,
+            chunks: List[Dict],
+            replace_all: bool = True,
+            batch_size: int = 100  # Загружаем батчами для экономии памяти
+    ):
+        """Загружает документы в векторную БД батчами для оптимизации памяти
+        
+        Args:
+            documents: Список текстов документов
+            embeddings: Массив эмбеддингов
+            chunks: Список чанков с метаданными
+            replace_all: Если True, собирает новую коллекцию и атомарно переключает на нее алиас (по умолчанию True)
+            batch_size: Размер батча для загрузки (по умолчанию 100)
+        """
+        if not replace_all:
+            return self.add_documents(documents, embeddings, chunks, batch_size=batch_size)
+
+        def fill(shadow, shadow_name):
+            # Проекция обучается на полном корпусе новой коллекции и версионируется вместе с ней
+            nonlocal embeddings
+            projection = Projection.fit(
+                self.embedding_config.projection, self.embedding_config.projection_dim, embeddings
+            )
+            if projection is not None:
+                self._save_projection(shadow_name, projection)
+                embeddings = projection.apply(embeddings)
+                print(f"Эмбеддинги спроецированы ({projection.kind}) до {projection.dim} измерений")
+            self._projections[shadow_name] = projection
+            self._add_batches(shadow, documents, embeddings, chunks, batch_size)
+            self._upsert_centroids(self._centroids_for(shadow_name), embeddings, chunks)
+
+        return self._publish_shadow(fill)
+
+    def _publish_shadow(self, fill, embedding_model: str = None) -> int:
+        """Blue/green: наполняет теневую коллекцию, пока запросы читают текущую, и переключает алиас"""
+        shadow_name = f"{self.collection_name}__{time.time_ns()}"
+        shadow = self.client.create_collection(
+            name=shadow_name,
+            metadata=self._collection_metadata(embedding_model or self.embedding_model)
+        )
+        try:
+            fill(shadow, shadow_name)
+        except Exception:
+            self._drop_collection(shadow_name)
+            raise
+
+        # Атомарное переключение алиаса, старая коллекция удаляется после
+        previous = self._swap_alias(shadow_name)
+        self._collection = shadow
+        self._physical_name = shadow_name
+        if previous != shadow_name:
+            self._drop_later(previous)
+        self._bump_version()
+
+        return shadow.count()
+
+    def create_physical(self, embedding_model: str) -> str:
+        """Создает пустую физическую коллекцию для модели, не трогая алиас"""
+        name = f"{self.collection_name}__{time.time_ns()}"
+        self.client.create_collection(name=name, metadata=self._collection_metadata(embedding_model))
+        return name
+
+    def open_physical(self, physical_name: str):
+        return self.client.get_collection(physical_name)
+
+    @_writes
+    def switch_alias(self, physical_name: str) -> str:
+        """Переключает алиас на готовую коллекцию, сохраняя предыдущую (для отката); возвращает ее имя"""
+        previous = self._swap_alias(physical_name)
+        self._collection = self.open_physical(physical_name)
+        self._physical_name = physical_name
+        self._bump_version()
+        return previous
+
+    def drop_physical(self, physical_name: str):
+        self._drop_collection(physical_name)
+
+    @_writes
+    def export_records(self, batch_size: int = 500) -> Dict:
+        """Выгружает чанки и центроиды текущей физической коллекции вместе с эмбеддингами"""
+        collection = self.collection
+        physical_name = self._physical_name
+        records = {"physical_name": physical_name}
+        for key, source in (("chunks", collection), ("centroids", self._centroids_for(physical_name))):
+            ids, documents, metadatas, embeddings = [], [], [], []
+            total = source.count()
+            for offset in range(0, total, batch_size):
+                batch = source.get(
+                    offset=offset,
+                    limit=batch_size,
+                    include=["documents", "metadatas", "embeddings"],
+                )
+                ids.extend(batch["ids"])
+                documents.extend(batch["documents"])
+                metadatas.extend(batch["metadatas"])
+                embeddings.extend(batch["embeddings"])
+            records[key] = {
+                "ids": ids,
+                "documents": documents,
+                "metadatas": metadatas,
+                "embeddings": np.asarray(embeddings, dtype=np.float32),
+            }
+        records["projection"] = self._projection_for(physical_name)
+        return records
+
+    @_writes
+    def replace_with_records(self, chunks: Dict, centroids: Dict, projection: Optional[Projection] = None,
+                             batch_size: int = 500, embedding_model: str = None) -> int:
+        """Загружает готовые записи (из снапшота) в новую коллекцию без пересчета эмбеддингов"""
+        def fill(shadow, shadow_name):
+            if projection is not None:
+                self._save_projection(shadow_name, projection)
+            self._projections[shadow_name] = projection
+            for target, records in ((shadow, chunks), (self._centroids_for(shadow_name), centroids)):
+                for start in range(0, len(records["ids"]), batch_size):
+                    end = start + batch_size
+                    # У центроидов нет текстов, Chroma отдает их как None
+                    documents = records["documents"][start:end]
+                    target.add(
+                        ids=records["ids"][start:end],
+                        documents=documents if any(d is not None for d in documents) else None,
+                        metadatas=records["metadatas"][start:end],
+                        embeddings=np.asarray(records["embeddings"][start:end]).tolist(),
+                    )
+
+        return self._publish_shadow(fill, embedding_model)
 
     def search(
             self,
@@ -119,50 +651,129 @@ class VectorStore:
             n_results = self.config.n_results
 
         return self.collection.query(
-            query_embeddings=query_embeddings,
+            query_embeddings=self.project(query_embeddings).tolist(),
             n_results=n_results,
             where=where,
             where_document=where_document,
-            include=["documents", "metadatas", "distances"],
+            # Векторы чанков нужны MMR при сборке контекста, чтобы не кодировать пассажи заново
+            include=["documents", "metadatas", "distances", "embeddings"],
         )
 
+    def get_by_ids(self, ids: List[str]) -> Dict[str, Dict]:
+        """Получает чанки по ID: id -> {"document", "metadata", "embedding"}"""
+        if not ids:
+            return {}
+        results = self.collection.get(ids=ids, include=["documents", "metadatas", "embeddings"])
+        return {
+            doc_id: {"document": doc, "metadata": metadata, "embedding": embedding}
+            for doc_id, doc, metadata, embedding in zip(
+                results["ids"], results["documents"], results["metadatas"], results["embeddings"]
+            )
+        }
+
     def get_collection_stats(self) -> Dict:
         """Получает статистику коллекции"""
         return {
-            "name": self.collection.name,
+            "name": self.collection_name,
+            "collection": self.collection.name,
             "count": self.collection.count(),
         }
     
+    @_writes
     def delete_document_by_name(self, document_name: str) -> int:
-        """Удаляет все чанки документа по имени файла"""
+        """Удаляет все чанки документа по имени файла
+        
+        Общие чанки (схлопнутые дубликаты) остаются, если на них ссылаются другие документы.
+        """
         try:
-            results = self.collection.get(
-                where={"document": document_name},
-                include=["metadatas"]
-            )
-            if results["ids"]:
-                self.collection.delete(ids=results["ids"])
-                return len(results["ids"])
-            return 0
+            results = self.collection.get(where=sources_filter([document_name]), include=["metadatas"])
+            delete_ids = []
+            update_ids, update_metadatas = [], []
+            for doc_id, metadata in zip(results["ids"], results["metadatas"]):
+                sources = split_sources(metadata.get("sources")) or [metadata.get("document")]
+                remaining = [s for s in sources if s != document_name]
+                if not remaining:
+                    delete_ids.append(doc_id)
+                    continue
+                set_sources(metadata, remaining, removed=[document_name])
+                if metadata.get("document") == document_name:
+                    metadata["document"] = remaining[0]
+                update_ids.append(doc_id)
+                update_metadatas.append(metadata)
+            if delete_ids:
+                self.collection.delete(ids=delete_ids)
+            self.centroids.delete(ids=[document_name])
+            if update_ids:
+                self.collection.update(ids=update_ids, metadatas=update_metadatas)
+            if delete_ids or update_ids:
+                self._bump_version()
+            return len(delete_ids)
         except Exception as e:
             print(f"Ошибка при удалении документа {document_name}: {e}")
             return 0
     
+    def get_all_chunk_texts(self) -> List[tuple]:
+        """Возвращает пары (id, текст) всех чанков коллекции"""
+        results = self.collection.get(include=["documents"])
+        return list(zip(results["ids"], results["documents"]))
+
+    def find_near_duplicate_candidates(self, band_hashes: Dict[int, List[int]], batch_size: int = 200) -> List[tuple]:
+        """Чанки, совпавшие хотя бы по одной полосе LSH: пары (id, метаданные с сигнатурой MinHash)
+
+        Полосы хранятся в метаданных lsh_<N>, поэтому кандидаты выбираются фильтром where,
+        а не чтением и перехэшированием всего корпуса.
+        """
+        candidates = {}
+        for band, hashes in band_hashes.items():
+            hashes = list(dict.fromkeys(hashes))
+            for start in range(0, len(hashes), batch_size):
+                results = self.collection.get(
+                    where={f"{BAND_KEY_PREFIX}{band}": {"$in": hashes[start:start + batch_size]}},
+                    include=["metadatas"],
+                )
+                for doc_id, metadata in zip(results["ids"], results["metadatas"]):
+                    if metadata and metadata.get(SIGNATURE_KEY):
+                        candidates[doc_id] = metadata
+        return list(candidates.items())
+    
+    @_writes
+    def add_chunk_sources(self, sources_by_id: Dict[str, List[str]]):
+        """Добавляет документы-источники к уже сохраненным чанкам"""
+        if not sources_by_id:
+            return
+        ids = list(sources_by_id.keys())
+        results = self.collection.get(ids=ids, include=["metadatas"])
+        metadatas = []
+        for doc_id, metadata in zip(results["ids"], results["metadatas"]):
+            current = split_sources(metadata.get("sources")) or [metadata.get("document")]
+            set_sources(metadata, current + sources_by_id[doc_id])
+            metadatas.append(metadata)
+        self.collection.update(ids=results["ids"], metadatas=metadatas)
+        self._refresh_centroids([name for names in sources_by_id.values() for name in names])
+        self._bump_version()
+    
+    @_writes
     def delete_document_by_id(self, doc_id: str) -> bool:
         """Удаляет документ по ID"""
         try:
             self.collection.delete(ids=[doc_id])
+            self._bump_version()
             return True
         except Exception as e:
             print(f"Ошибка при удалении документа с ID {doc_id}: {e}")
             return False
     
+    @_writes
     def delete_all(self) -> int:
         """Удаляет все документы из коллекции"""
         try:
             count = self.collection.count()
-            self.client.delete_collection(self.collection_name)
+            self._drop_collection(self.resolve_collection_name())
+            aliases = self._read_aliases()
+            if aliases.pop(self.collection_name, None) is not None:
+                self._write_aliases(aliases)
             self._collection = None  # Сбрасываем кэш
+            self._bump_version()
             return count
         except Exception as e:
             print(f"Ошибка при удалении всех документов: {e}")
@@ -176,6 +787,7 @@ class VectorStore:
             for metadata in results.get("metadatas", []):
                 if metadata and "document" in metadata:
                     documents.add(metadata["document"])
+                    documents.update(split_sources(metadata.get("sources")))
             return sorted(list(documents))
         except Exception as e:
             print(f"Ошибка при получении списка документов: {e}")
@@ -197,13 +809,14 @@ class VectorStore:
                 chunks.append({
                     "id": doc_id,
                     "content": doc,
-                    "metadata": metadata
+                    "metadata": public_metadata(metadata)
                 })
             return chunks
         except Exception as e:
             print(f"Ошибка при получении чанков документа {document_name}: {e}")
             return []
     
+    @_writes
     def add_documents(
         self,
         documents: List[str],
@@ -212,38 +825,13 @@ class VectorStore:
         batch_size: int = 100
     ) -> int:
         """Добавляет документы без удаления существующих"""
-        import gc
-        
-        # Загружаем батчами для экономии памяти
-        total_docs = len(documents)
-        for batch_start in range(0, total_docs, batch_size):
-            batch_end = min(batch_start + batch_size, total_docs)
-            batch_docs = documents[batch_start:batch_end]
-            batch_embeddings = embeddings[batch_start:batch_end]
-            batch_chunks = chunks[batch_start:batch_end]
-            
-            metadatas = []
-            ids = []
-            # Генерируем уникальные ID на основе текущего количества + индекс
-            current_count = self.collection.count()
-            for i, chunk in enumerate(batch_chunks):
-                metadata = chunk.get("metadata", {})
-                metadata["document"] = Path(chunk["source"]).name
-                metadata["chunk_id"] = chunk.get("chunk_id", batch_start + i)
-                metadatas.append(metadata)
-                ids.append(f"doc_{current_count + batch_start + i}")
-
-            # Загрузка батча в БД
-            self.collection.add(
-                documents=batch_docs,
-                embeddings=batch_embeddings.tolist(),
-                metadatas=metadatas,
-                ids=ids,
-            )
-            
-            # Очистка памяти после каждого батча
-            del batch_docs, batch_embeddings, batch_chunks, metadatas, ids
-            if batch_start % (batch_size * 4) == 0:
-                gc.collect()
-
+        embeddings = self.project(embeddings)
+        # Уникальный префикс пакета: после удаления документов нумерация по count() совпала бы с живыми ID
+        self._add_batches(
+            self.collection, documents, embeddings, chunks, batch_size,
+            id_prefix=f"doc_{uuid.uuid4().hex[:12]}_",
+        )
+        # Центроид нового документа включает и уже сохраненные чанки, к которым он присоединен как источник
+        self._refresh_centroids([name for chunk in chunks for name in self._chunk_sources(chunk["metadata"])])
+        self._bump_version()
         return self.collection.count()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Сборка локальной копии модели эмбеддингов для офлайн-запуска (вызывается при сборке образа)
+
+Использование: python -m RAG.scripts.bundle_model <model_name> <output_dir>
+"""
+
+import sys
+from pathlib import Path
+
+
+def bundle_model(model_name: str, output_dir: str):
+    """Скачивает модель и сохраняет ее в каталог с весами в safetensors"""
+    from sentence_transformers import SentenceTransformer
+
+    output = Path(output_dir)
+    model = SentenceTransformer(model_name, device="cpu")
+    model.save(str(output))
+
+    # Перезаписываем веса трансформера в safetensors: быстрее грузятся (mmap) и без pickle
+    transformer = model._first_module()
+    transformer.auto_model.save_pretrained(str(output), safe_serialization=True)
+    for pickled in output.glob("pytorch_model*.bin"):
+        pickled.unlink()
+
+    print(f"Модель {model_name} сохранена в {output}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    bundle_model(sys.argv[1], sys.argv[2])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Оценка потерь recall при понижении размерности эмбеддингов
+
+Для выборки чанков коллекции сравнивает top-k соседей в полной размерности
+с top-k после PCA и усечения (Matryoshka) до разных размерностей.
+
+Использование: python -m RAG.scripts.eval_projection [--collection k1_about] [--dims 64,128,192,256] [--k 5]
+"""
+
+import argparse
+import numpy as np
+from RAG.rag.projection import Projection
+
+
+def top_k_neighbors(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k ближайших соседей по косинусу (сам запрос исключается)"""
+    scores = queries @ vectors.T
+    np.fill_diagonal(scores[:, :len(queries)], -np.inf)
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall_at_k(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Доля соседей из полной размерности, найденных после проекции"""
+    hits = [len(set(r) & set(c)) for r, c in zip(reference, candidate)]
+    return float(np.sum(hits)) / reference.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--collection", default=None)
+    parser.add_argument("--dims", default="64,128,192,256")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200, help="Сколько чанков использовать как запросы")
+    args = parser.parse_args()
+
+    from RAG.rag.rag_pipeline import RAGPipeline
+    from RAG.rag.vector_store import DEFAULT_COLLECTION
+
+    pipeline = RAGPipeline(collection_name=args.collection or DEFAULT_COLLECTION)
+    texts = [text for _, text in pipeline.vector_store.get_all_chunk_texts()]
+    if len(texts) <= args.k:
+        print("Слишком мало чанков для оценки")
+        return
+
+    # Полные векторы берем из модели (через кэш эмбеддингов), а не из коллекции
+    full = np.asarray(pipeline.embedding_service.encode_batch(texts), dtype=np.float32)
+    full /= np.linalg.norm(full, axis=1, keepdims=True) + 1e-8
+    rng = np.random.RandomState(0)
+    order = rng.permutation(len(full))
+    # Запросы ставим первыми, чтобы исключить совпадение запроса с самим собой
+    full = full[order]
+    n_queries = min(args.queries, len(full))
+    reference = top_k_neighbors(full, full[:n_queries], args.k)
+
+    print(f"Чанков: {len(full)}, запросов: {n_queries}, k={args.k}, исходная размерность: {full.shape[1]}")
+    print(f"{'метод':<10}{'dim':>6}{'recall@k':>10}{'байт/вектор':>13}")
+    print(f"{'full':<10}{full.shape[1]:>6}{1.0:>10.3f}{full.shape[1] * 4:>13}")
+    for dim in (int(d) for d in args.dims.split(",")):
+        for kind in ("pca", "truncate"):
+            projection = Projection.fit(kind, dim, full)
+            if projection is None:
+                continue
+            projected = projection.apply(full)
+            candidate = top_k_neighbors(projected, projected[:n_queries], args.k)
+            print(f"{kind:<10}{dim:>6}{recall_at_k(reference, candidate):>10.3f}{dim * 4:>13}")
+
+
+if __name__ == "__main__":
+    main()
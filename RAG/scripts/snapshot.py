@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Снапшоты индекса из командной строки: бэкап и разворачивание нового узла без API
+
+Использование:
+  python -m RAG.scripts.snapshot export [--collection k1_about]
+  python -m RAG.scripts.snapshot restore [--collection k1_about] [--file путь.ragsnap]
+"""
+
+import argparse
+from pathlib import Path
+
+from RAG.rag.snapshot import export_snapshot, import_snapshot, latest_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "restore"])
+    parser.add_argument("--collection", default=None)
+    parser.add_argument("--file", default=None, help="Файл снапшота (по умолчанию последний опубликованный)")
+    args = parser.parse_args()
+
+    from RAG.rag.rag_pipeline import RAGPipeline
+    from RAG.rag.vector_store import DEFAULT_COLLECTION
+
+    # Модель эмбеддингов загружается лениво и для снапшотов не нужна
+    pipeline = RAGPipeline(collection_name=args.collection or DEFAULT_COLLECTION)
+    # Процесс завершится сразу после загрузки: отложенное удаление старой коллекции не успело бы сработать
+    pipeline.vector_store.drop_grace_seconds = 0.0
+    config = pipeline.config
+    if args.command == "export":
+        manifest = export_snapshot(
+            pipeline.vector_store, pipeline.faq_index, config.embedding, config.snapshot, pipeline.table_index
+        )
+        print(f"Записан {Path(config.snapshot.dir) / manifest['file']}")
+        return
+
+    from RAG.rag.reembed import ReembedError, ReembedMigration
+
+    try:
+        ReembedMigration(pipeline.vector_store, pipeline.embedding_service.service, config.reembed).ensure_alias_free()
+    except ReembedError as e:
+        raise SystemExit(str(e))
+
+    path = Path(args.file) if args.file else None
+    if path is None:
+        latest = latest_snapshot(config.snapshot, pipeline.vector_store.collection_name)
+        if latest is None:
+            raise SystemExit(f"В {config.snapshot.dir} нет снапшотов коллекции")
+        path = Path(config.snapshot.dir) / latest["file"]
+    import_snapshot(path, pipeline.vector_store, pipeline.faq_index, config.embedding,
+                    table_index=pipeline.table_index)
+
+
+if __name__ == "__main__":
+    main()
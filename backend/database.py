@@ -51,7 +51,10 @@ def migrate_db():
             ("child_age", "INTEGER"),
             ("child_name", "VARCHAR"),
             ("onboarding_completed", "INTEGER DEFAULT 0"),
-            ("onboarding_data", "TEXT")
+            ("onboarding_data", "TEXT"),
+            # Скользящее краткое содержание диалога
+            ("history_summary", "TEXT"),
+            ("history_summary_upto", "INTEGER")
         ]
         
         for field_name, field_type in onboarding_fields:
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Depends, HTTPException, Query, UploadFile, File, Form, Request
+from fastapi import FastAPI, Depends, HTTPException, Query, UploadFile, File, Form, Request, BackgroundTasks
 from starlette.requests import Request as StarletteRequest
 from starlette.middleware.sessions import SessionMiddleware
 from sqlalchemy.orm import Session
@@ -9,7 +9,7 @@ from typing import List, Optional
 from datetime import datetime
 from passlib.context import CryptContext
 
-from backend.database import get_db, init_db
+from backend.database import get_db, init_db, SessionLocal
 from backend.models import User, Message, ScheduledBroadcast, AdminUser
 from backend.schemas import (
     UserCreate, UserUpdate, UserResponse,
@@ -42,6 +42,14 @@ SITE_URL = os.getenv("SITE_URL", "http://localhost:3000")
 ADMIN_TELEGRAM_IDS = os.getenv("ADMIN_TELEGRAM_IDS", "").split(",") if os.getenv("ADMIN_TELEGRAM_IDS") else []
 ADMIN_TELEGRAM_IDS = [int(uid.strip()) for uid in ADMIN_TELEGRAM_IDS if uid.strip().isdigit()]
 
+# Бюджет истории диалога в промпте: свежие сообщения дословно, старые - в кратком содержании
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "600"))
+HISTORY_CHARS_PER_TOKEN = 3  # Грубая оценка для кириллицы
+HISTORY_MESSAGE_MAX_CHARS = 600  # Длинные ответы (например, анкета onboarding) обрезаются
+HISTORY_FETCH_LIMIT = 50
+HISTORY_FOLD_MIN_MESSAGES = 4  # Сворачиваем пачками, чтобы не вызывать LLM на каждый вопрос
+HISTORY_SUMMARY_MAX_SHARE = 0.5  # Краткое содержание длиннее этой доли бюджета обрезается в промпте
+
 
 # Вспомогательные функции для аутентификации
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -177,8 +185,92 @@ def get_user_messages(telegram_id: int, db: Session = Depends(get_db)):
     return messages
 
 
+def build_conversation_history(db: Session, user: User):
+    """Собрать историю в пределах бюджета токенов
+    
+    Возвращает историю для RAG (краткое содержание + свежие сообщения) и сообщения,
+    которые выпали из бюджета и должны быть свернуты в краткое содержание.
+    """
+    query = db.query(Message).filter(Message.user_id == user.id)
+    if user.history_summary_upto:
+        query = query.filter(Message.id > user.history_summary_upto)
+    # Новые сообщения в обратном порядке (от новых к старым)
+    recent_messages = query.order_by(Message.id.desc()).limit(HISTORY_FETCH_LIMIT).all()
+    
+    budget_chars = HISTORY_TOKEN_BUDGET * HISTORY_CHARS_PER_TOKEN
+    summary = user.history_summary
+    if summary:
+        # Разросшееся краткое содержание не должно вытеснять все свежие сообщения
+        summary_max_chars = int(budget_chars * HISTORY_SUMMARY_MAX_SHARE)
+        if len(summary) > summary_max_chars:
+            summary = summary[:summary_max_chars] + "…"
+        budget_chars = max(0, budget_chars - len(summary))
+    
+    kept = []
+    used_chars = 0
+    for index, msg in enumerate(recent_messages):
+        text = msg.text
+        if len(text) > HISTORY_MESSAGE_MAX_CHARS:
+            text = text[:HISTORY_MESSAGE_MAX_CHARS] + "…"
+        if used_chars + len(text) > budget_chars:
+            break
+        kept.append({"role": "assistant" if msg.is_bot == 1 else "user", "text": text})
+        used_chars += len(text)
+    else:
+        index = len(recent_messages)
+    
+    # Все, что старше сохраненного окна, сворачивается в краткое содержание (от старых к новым).
+    # Сворачивание идет от history_summary_upto, а не от загруженного окна: иначе сообщения
+    # старше HISTORY_FETCH_LIMIT пропускались бы, когда сводка перескакивает через них
+    messages_to_fold = []
+    if recent_messages:
+        fold_before = recent_messages[index - 1].id if index else recent_messages[0].id + 1
+        fold_query = query.filter(Message.id < fold_before).order_by(Message.id.asc()).limit(HISTORY_FETCH_LIMIT)
+        messages_to_fold = [
+            {"id": msg.id, "role": "assistant" if msg.is_bot == 1 else "user", "text": msg.text}
+            for msg in fold_query.all()
+        ]
+    
+    conversation_history = []
+    if summary:
+        conversation_history.append({"role": "summary", "text": summary})
+    conversation_history.extend(reversed(kept))
+    return conversation_history, messages_to_fold
+
+
+async def update_history_summary(user_id: int, messages: List[dict]):
+    """Инкрементально обновить краткое содержание диалога пользователя через LLM Service"""
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.id == user_id).first()
+        if not user:
+            return
+        # Пока шел запрос, сводку мог обновить параллельный запрос
+        messages = [m for m in messages if m["id"] > (user.history_summary_upto or 0)]
+        if not messages:
+            return
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                f"{LLM_SERVICE_URL}/summarize",
+                json={
+                    "previous_summary": user.history_summary,
+                    "messages": [{"role": m["role"], "text": m["text"]} for m in messages]
+                },
+                timeout=60.0
+            )
+            response.raise_for_status()
+        user.history_summary = response.json()["summary"]
+        user.history_summary_upto = messages[-1]["id"]
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Ошибка обновления краткого содержания диалога: {str(e)}")
+    finally:
+        db.close()
+
+
 @app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest, db: Session = Depends(get_db)):
+async def query(request: QueryRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """Запрос к RAG API с сохранением сообщения"""
     # Получаем или создаем пользователя
     user = db.query(User).filter(User.telegram_id == request.telegram_id).first()
@@ -188,23 +280,9 @@ async def query(request: QueryRequest, db: Session = Depends(get_db)):
         db.commit()
         db.refresh(user)
     
-    # Получаем последние 10 сообщений (5 пар вопрос-ответ) для контекста
-    # Исключаем текущий вопрос, получая сообщения до текущего момента
-    recent_messages = db.query(Message).filter(
-        Message.user_id == user.id
-    ).order_by(Message.created_at.desc()).limit(10).all()
-    
-    # Формируем conversation_history в обратном порядке (от старых к новым)
-    conversation_history = []
-    if recent_messages:
-        # Переворачиваем список, чтобы получить хронологический порядок
-        messages_chronological = list(reversed(recent_messages))
-        for msg in messages_chronological:
-            role = "assistant" if msg.is_bot == 1 else "user"
-            conversation_history.append({
-                "role": role,
-                "text": msg.text
-            })
+    conversation_history, messages_to_fold = build_conversation_history(db, user)
+    if len(messages_to_fold) >= HISTORY_FOLD_MIN_MESSAGES:
+        background_tasks.add_task(update_history_summary, user.id, messages_to_fold)
     
     # Запрос к RAG API
     async with httpx.AsyncClient() as client:
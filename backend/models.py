@@ -22,6 +22,10 @@ class User(Base):
     child_name = Column(String, nullable=True)
     onboarding_completed = Column(Integer, default=0)  # 0 - не завершен, 1 - завершен
     onboarding_data = Column(Text, nullable=True)  # JSON с полными данными
+    
+    # Скользящее краткое содержание старой части диалога
+    history_summary = Column(Text, nullable=True)
+    history_summary_upto = Column(Integer, nullable=True)  # id последнего учтенного сообщения
 
     messages = relationship("Message", back_populates="user")
 
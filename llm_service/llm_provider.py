@@ -35,3 +35,7 @@ class LLMProvider:
             logger.error(f"Ошибка при обработке промпта: {e}")
             raise
 
+    def check_token(self) -> bool:
+        """Проверяет, что клиент может получить валидный токен (легкий запрос списка моделей)"""
+        self.giga.get_models()
+        return True
@@ -6,12 +6,16 @@ LLM Service - отдельный сервис для работы с LLM
 import os
 import json
 import re
+import threading
+import time
 from pathlib import Path
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from llm_service.llm_provider import LLMProvider
 from llm_service.schemas import (
     ProcessRequest, ProcessResponse,
-    OnboardingExtractRequest, OnboardingExtractResponse, ExtractedData
+    OnboardingExtractRequest, OnboardingExtractResponse, ExtractedData,
+    SummarizeRequest, SummarizeResponse
 )
 from typing import Optional, Dict, Any
 
@@ -20,6 +24,46 @@ app = FastAPI(title="LLM Service", description="Сервис для работы
 # Определяем путь к промптам относительно файла main.py
 PROMPTS_DIR = Path(__file__).parent / "prompts"
 
+# Состояние готовности для /readyz
+LLM_TOKEN_CHECK_INTERVAL = 20 * 60  # Токен GigaChat живет 30 минут
+readiness = {"llm": False, "error": None, "checked_at": 0.0}
+
+
+def check_llm() -> bool:
+    """Проверяет токен LLM не чаще раза в LLM_TOKEN_CHECK_INTERVAL"""
+    if readiness["llm"] and time.monotonic() - readiness["checked_at"] < LLM_TOKEN_CHECK_INTERVAL:
+        return True
+    try:
+        LLMProvider().check_token()
+        readiness.update(llm=True, error=None, checked_at=time.monotonic())
+    except Exception as e:
+        readiness.update(llm=False, error=str(e))
+    return readiness["llm"]
+
+
+@app.on_event("startup")
+def start_warm_up():
+    def warm_up():
+        while not check_llm():
+            time.sleep(5)
+    threading.Thread(target=warm_up, daemon=True).start()
+
+
+@app.get("/healthz")
+def healthz():
+    """Liveness: процесс жив"""
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: у клиента LLM есть валидный токен"""
+    ready = check_llm()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not ready", "llm": ready, "error": readiness["error"]},
+    )
+
 
 def load_prompt(filename: str) -> str:
     """Загрузить промпт из файла"""
@@ -186,9 +230,33 @@ async def extract_onboarding_all(request: OnboardingExtractRequest):
         raise HTTPException(status_code=500, detail=f"Ошибка извлечения данных: {str(e)}")
 
 
+@app.post("/summarize", response_model=SummarizeResponse)
+async def summarize(request: SummarizeRequest):
+    """Инкрементально обновить краткое содержание диалога новыми сообщениями"""
+    try:
+        system_prompt = load_prompt("summarize_system_prompt.txt")
+        user_prompt_template = load_prompt("summarize_user_prompt.txt")
+        
+        lines = []
+        for msg in request.messages:
+            role = "Ассистент" if msg.get("role") == "assistant" else "Пользователь"
+            lines.append(f"{role}: {msg.get('text', '')}")
+        
+        user_prompt = user_prompt_template.format(
+            previous_summary=request.previous_summary or "нет",
+            messages="\n".join(lines)
+        )
+        
+        llm = LLMProvider(system_prompt=system_prompt)
+        summary = llm.process_prompt(user_prompt).strip()
+        return SummarizeResponse(summary=summary)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка суммаризации: {str(e)}")
+
+
 @app.get("/")
 def root():
-    return {"message": "LLM Service", "endpoints": ["POST /process", "POST /extract_onboarding"]}
+    return {"message": "LLM Service", "endpoints": ["POST /process", "POST /extract_onboarding", "POST /summarize", "GET /healthz", "GET /readyz"]}
 
 
 if __name__ == "__main__":
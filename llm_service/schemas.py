@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 
 class ProcessRequest(BaseModel):
@@ -29,3 +29,12 @@ class OnboardingExtractResponse(BaseModel):
     needs_clarification: bool
     clarification_question: Optional[str] = None
 
+
+
+class SummarizeRequest(BaseModel):
+    previous_summary: Optional[str] = None
+    messages: List[Dict[str, str]]
+
+
+class SummarizeResponse(BaseModel):
+    summary: str